@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from database import pick_granularity
+
+#Headless side of the analytics window: the KPIs are computed here, the charts are drawn by main.py
+
+#Tables every analytics result is computed from (rollup inputs + the rate history)
+ANALYTICS_TABLES = ["daily_sales", "daily_metrics", "exchange_rates"]
+
+
+#Conversion rate (%), average transaction value and index (both in USD) from summed figures
+#sales_usd is already converted day by day (see RATE_ON), so past days keep their own rate
+def kpis(sales, receipts, footfall, sales_usd):
+    return {
+        "sales": sales,
+        "sales_usd": sales_usd,
+        "receipts": receipts,
+        "footfall": footfall,
+        "conversion": receipts / footfall * 100 if footfall > 0 else 0.0,
+        "atv_usd": sales_usd / receipts if receipts > 0 else 0.0,
+        "index_usd": sales_usd / footfall if footfall > 0 else 0.0,
+    }
+
+
+#Branches summed together, one row per period
+#With a refreshed ColumnarMirror (columnar.py) the figures come from its arrays instead of the rollup
+#Returns (granularity, rows, totals): rows are [period start, sales, receipts, footfall, index_usd], totals is a kpis() dict
+def branch_report(db, branches, start_date, end_date, granularity="auto", mirror=None):
+    granularity = pick_granularity(start_date, end_date, granularity)
+
+    if mirror is not None:
+        #Branches summed per period, like get_daily_rollup
+        periods = {}
+        for _, period, *values in mirror.branch_rollup(branches, start_date, end_date, granularity):
+            periods[period] = [a + b for a, b in zip(periods.get(period, [0, 0, 0, 0]), values)]
+        source = [(period, *periods[period]) for period in sorted(periods)]
+    else:
+        source = db.get_daily_rollup(branches, start_date, end_date, granularity)
+
+    rows = []
+    sales_usd_total = 0
+    for period, sales, receipts, footfall, sales_usd in source:
+        sales, receipts, footfall, sales_usd = sales or 0, receipts or 0, footfall or 0, sales_usd or 0
+        rows.append([period, sales, receipts, footfall, kpis(sales, receipts, footfall, sales_usd)["index_usd"]])
+        sales_usd_total += sales_usd
+
+    totals = kpis(sum(row[1] for row in rows), sum(row[2] for row in rows), sum(row[3] for row in rows), sales_usd_total)
+    return granularity, rows, totals
+
+
+#Every branch from one grouped query over the rollup (or one scan of the mirror arrays)
+#Returns (granularity, ranking, series): ranking is one kpis() dict per branch (best index first),
+#series is {branch: [(period start, kpis)]} for the small multiples
+def compare_branches(db, branches, start_date, end_date, granularity="auto", mirror=None):
+    granularity = pick_granularity(start_date, end_date, granularity)
+
+    source = (mirror.branch_rollup if mirror is not None else db.get_branch_rollup)(branches, start_date, end_date, granularity)
+    totals = {}
+    series = {}
+    for branch, period, sales, receipts, footfall, sales_usd in source:
+        sales, receipts, footfall, sales_usd = sales or 0, receipts or 0, footfall or 0, sales_usd or 0
+        series.setdefault(branch, []).append((period, kpis(sales, receipts, footfall, sales_usd)))
+
+        total = totals.setdefault(branch, [0, 0, 0, 0])
+        total[0] += sales
+        total[1] += receipts
+        total[2] += footfall
+        total[3] += sales_usd
+
+    ranking = [{"branch": branch, **kpis(*total)} for branch, total in totals.items()]
+    ranking.sort(key=lambda row: row["index_usd"], reverse=True)
+    return granularity, ranking, series
+
+
+#Where the money of one type went over the range: [(category, total in USD)], biggest first
+#With a refreshed ColumnarMirror (columnar.py) it is a vectorized scan of the arrays, otherwise one grouped SQL query
+def category_breakdown(db, branches, start_date, end_date, t_type="Expense", mirror=None):
+    if mirror is not None:
+        return mirror.category_totals(branches, start_date, end_date, t_type)
+    return [(category, total or 0) for category, total in db.get_category_totals(branches, start_date, end_date, t_type)]
+
+
+#LRU cache of analytics results, valid as long as the data versions of their tables did not move
+#With a path, results are also kept in a sidecar SQLite file so they survive a restart
+#Values have to be JSON friendly (tuples come back as lists from the sidecar)
+class AnalyticsCache:
+    def __init__(self, db, max_entries=64, path=None, max_persisted=512):
+        self.db = db
+        self.max_entries = max_entries
+        self.max_persisted = max_persisted
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = None
+        if path:
+            try:
+                self.conn = sqlite3.connect(path)
+                self.conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                  key TEXT PRIMARY KEY,
+                                  versions TEXT,
+                                  value TEXT,
+                                  used REAL)""")
+                self.conn.commit()
+            except sqlite3.Error as e:
+                #The cache is only an accelerator, run in memory if the sidecar is unusable
+                print(f"Analytics cache: sidecar disabled ({e})")
+                self.conn = None
+
+    #Returns the cached value for key, or compute() when there is none or the data changed since
+    def get(self, key, compute, tables=ANALYTICS_TABLES):
+        key = json.dumps(key)
+        versions = list(self.db.get_data_versions(tables))
+
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == versions:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        value = self.load(key, versions)
+        if value is None:
+            self.misses += 1
+            value = compute()
+            self.save(key, versions, value)
+        else:
+            self.hits += 1
+
+        self.entries[key] = (versions, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+    def load(self, key, versions):
+        if self.conn is None:
+            return None
+        row = self.conn.execute("SELECT versions, value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or json.loads(row[0]) != versions:
+            return None
+        self.conn.execute("UPDATE cache SET used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return json.loads(row[1])
+
+    def save(self, key, versions, value):
+        if self.conn is None:
+            return
+        self.conn.execute("INSERT OR REPLACE INTO cache (key, versions, value, used) VALUES (?,?,?,?)",
+                          (key, json.dumps(versions), json.dumps(value), time.time()))
+        #Same LRU rule on disk, oldest use goes first
+        self.conn.execute("DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY used DESC LIMIT ?)", (self.max_persisted,))
+        self.conn.commit()
+
+    def clear(self):
+        self.entries.clear()
+        if self.conn is not None:
+            self.conn.execute("DELETE FROM cache")
+            self.conn.commit()
+
+
+#Sidecar next to the database: store.db -> store_cache.db
+def sidecar_path(db_name):
+    return f"{os.path.splitext(db_name)[0]}_cache.db"
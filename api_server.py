@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from database import DatabaseManager, StaleRecordError, ClosedPeriodError, PHYSICAL_BRANCHES
+from analytics import branch_report, compare_branches
+from sync import FORMAT as SYNC_FORMAT, merge_changeset, sync_position
+
+#Headless HTTP/JSON access to the ledger for the POS and reporting scripts (no Tk needed)
+#Usage: python api_server.py --db store.db --port 8765 [--token secret]
+#
+#  GET  /health
+#  GET  /balances
+#  GET  /daily-metrics?branch=City Mall&date=2024-05-01
+#  GET  /analytics/report?branch=All&start=2024-01-01&end=2024-12-31&granularity=auto
+#  GET  /analytics/compare?start=2024-01-01&end=2024-12-31&granularity=auto
+#  POST /transactions        one raw row (add_transactions, no derived legs)
+#  POST /postings            one posting with its derived legs (post_transaction)
+#  POST /batch/postings      {"postings": [...]} in one transaction
+#  POST /daily-metrics       {"branch", "date", "receipts", "footfall"}
+#  POST /batch/daily         {"days": [...]} reconciled branch-days (post_daily_batch)
+#  GET  /sync/state?site=..  last change of a site merged here (null before its first sync)
+#  POST /sync/changeset      a site's changeset from sync.py (Content-Encoding: gzip)
+
+MAX_BODY = 10 * 1024 * 1024
+POOL_SIZE = 4
+
+STATUS_TEXT = {200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+               405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+#A few DatabaseManager instances shared by the requests, each one used by a single worker thread at a time
+class ConnectionPool:
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.queue = asyncio.Queue()
+        for _ in range(size):
+            self.queue.put_nowait(DatabaseManager(db_path, check_same_thread=False))
+
+    #Runs func(db) in a worker thread so SQLite never blocks the event loop
+    async def run(self, func):
+        db = await self.queue.get()
+        try:
+            return await asyncio.to_thread(func, db)
+        finally:
+            self.queue.put_nowait(db)
+
+    async def close(self):
+        while not self.queue.empty():
+            self.queue.get_nowait().conn.close()
+
+
+def require(body, *fields):
+    missing = [field for field in fields if body.get(field) in (None, "")]
+    if missing:
+        raise ApiError(400, f"Missing field(s): {', '.join(missing)}")
+
+
+def to_amount(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, f"Invalid amount: {value!r}")
+
+
+def post_one(db, item):
+    require(item, "store", "date", "type", "category", "amount", "currency", "method")
+    parent_id = db.post_transaction(item["store"], item["date"], item["type"], item["category"], to_amount(item["amount"]),
+                                    item["currency"], item["method"], description=item.get("description"),
+                                    apply_main=item.get("apply_main", True))
+    if parent_id is None:
+        raise ApiError(404, f"Store not found: {item['store']}")
+    return parent_id
+
+
+class ApiServer:
+    def __init__(self, db_path, pool_size=POOL_SIZE, token=None):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.token = token
+        self.pool = None
+        self.server = None
+
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("GET", "/balances"): self.balances,
+            ("GET", "/daily-metrics"): self.get_daily_metrics,
+            ("GET", "/analytics/report"): self.analytics_report,
+            ("GET", "/analytics/compare"): self.analytics_compare,
+            ("POST", "/transactions"): self.add_transaction,
+            ("POST", "/postings"): self.add_posting,
+            ("POST", "/batch/postings"): self.add_postings_batch,
+            ("POST", "/daily-metrics"): self.save_daily_metrics,
+            ("POST", "/batch/daily"): self.post_daily_batch,
+            ("GET", "/sync/state"): self.sync_state,
+            ("POST", "/sync/changeset"): self.sync_changeset,
+        }
+
+    #port=0 picks a free port (handy against a temp database), the real one is in self.port
+    async def start(self, host="127.0.0.1", port=8765):
+        self.pool = ConnectionPool(self.db_path, self.pool_size)
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        print(f"API listening on http://{host}:{self.port} (db: {self.db_path})")
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.pool.close()
+
+    # ==========================================
+    # HTTP plumbing
+    # ==========================================
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, 400, {"error": "Malformed request line"}, keep_alive=False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                #Without a usable length the body can't be told from the next request, so the connection is closed
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    await self.respond(writer, 400, {"error": "Malformed Content-Length"}, keep_alive=False)
+                    break
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, {"error": "Body too large"}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                status, payload = await self.dispatch(method, target, headers, body)
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload, keep_alive):
+        data = json.dumps(payload, default=str).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def dispatch(self, method, target, headers, body):
+        started = time.perf_counter()
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            if self.token and headers.get("authorization") != f"Bearer {self.token}":
+                raise ApiError(401, "Missing or wrong token")
+
+            handler = self.routes.get((method, url.path))
+            if handler is None:
+                if any(path == url.path for _, path in self.routes):
+                    raise ApiError(405, f"{method} not allowed on {url.path}")
+                raise ApiError(404, f"No route for {url.path}")
+
+            try:
+                if headers.get("content-encoding", "").lower() == "gzip":
+                    body = gzip.decompress(body)
+                data = json.loads(body) if body else {}
+            except (ValueError, OSError, EOFError):
+                raise ApiError(400, "Body is not valid JSON")
+
+            status, payload = await handler(query, data)
+        except ApiError as e:
+            status, payload = e.status, {"error": str(e)}
+        except (StaleRecordError, ClosedPeriodError) as e:
+            status, payload = 409, {"error": str(e)}
+        #Malformed dates are refused by the database layer when it turns them into day numbers
+        except ValueError as e:
+            status, payload = 400, {"error": f"Invalid value: {e}"}
+        except Exception as e:
+            print(f"API Error on {method} {url.path}: {e}")
+            status, payload = 500, {"error": "Internal error"}
+
+        print(f"{method} {url.path} -> {status} ({(time.perf_counter() - started) * 1000:.1f} ms)")
+        return status, payload
+
+    # ==========================================
+    # Endpoints
+    # ==========================================
+    async def health(self, query, data):
+        return 200, {"status": "ok"}
+
+    async def balances(self, query, data):
+        rows = await self.pool.run(lambda db: db.get_balance_summary())
+        return 200, {"balances": [{"store": store, "currency": currency, "method": method, "balance": balance}
+                                  for store, currency, method, balance in rows]}
+
+    async def get_daily_metrics(self, query, data):
+        require(query, "branch", "date")
+        receipts, footfall = await self.pool.run(lambda db: db.get_daily_metrics(query["branch"], query["date"]))
+        if receipts == "":
+            raise ApiError(404, "No metrics for this branch and date")
+        return 200, {"branch": query["branch"], "date": query["date"], "receipts": receipts, "footfall": footfall}
+
+    async def save_daily_metrics(self, query, data):
+        require(data, "branch", "date", "receipts", "footfall")
+        try:
+            receipts, footfall = int(data["receipts"]), int(data["footfall"])
+        except (TypeError, ValueError):
+            raise ApiError(400, "Receipts and footfall must be whole numbers")
+        store_id = await self.pool.run(lambda db: db.save_daily_metrics(data["branch"], data["date"], receipts, footfall))
+        if store_id is None:
+            raise ApiError(404, f"Store not found: {data['branch']}")
+        return 201, {"saved": True}
+
+    async def analytics_report(self, query, data):
+        require(query, "start", "end")
+        branch = query.get("branch", "All")
+        branches = PHYSICAL_BRANCHES if branch == "All" else [branch]
+        granularity, rows, totals = await self.pool.run(
+            lambda db: branch_report(db, branches, query["start"], query["end"], query.get("granularity", "auto")))
+        return 200, {"granularity": granularity, "totals": totals,
+                     "rows": [dict(zip(["period", "sales", "receipts", "footfall", "index_usd"], row)) for row in rows]}
+
+    async def analytics_compare(self, query, data):
+        require(query, "start", "end")
+        granularity, ranking, series = await self.pool.run(
+            lambda db: compare_branches(db, PHYSICAL_BRANCHES, query["start"], query["end"], query.get("granularity", "auto")))
+        return 200, {"granularity": granularity, "ranking": ranking,
+                     "series": {branch: [{"period": period, **values} for period, values in points] for branch, points in series.items()}}
+
+    async def add_transaction(self, query, data):
+        require(data, "store", "date", "type", "category", "amount", "currency", "method")
+        row_id = await self.pool.run(lambda db: db.add_transactions(
+            data["store"], data["date"], data["type"], data["category"], to_amount(data["amount"]), data["currency"], data["method"],
+            description=data.get("description")))
+        if row_id is None:
+            raise ApiError(404, f"Store not found: {data['store']}")
+        return 201, {"id": row_id}
+
+    async def add_posting(self, query, data):
+        parent_id = await self.pool.run(lambda db: post_one(db, data))
+        return 201, {"id": parent_id}
+
+    #All postings or none: the nested post_transaction calls join one write transaction
+    async def add_postings_batch(self, query, data):
+        postings = data.get("postings")
+        if not isinstance(postings, list) or not postings:
+            raise ApiError(400, "Expected a non empty 'postings' list")
+
+        def work(db):
+            with db.write(f"API batch of {len(postings)} postings"):
+                return [post_one(db, item) for item in postings]
+
+        ids = await self.pool.run(work)
+        return 201, {"ids": ids}
+
+    async def post_daily_batch(self, query, data):
+        days = data.get("days")
+        if not isinstance(days, list) or not days:
+            raise ApiError(400, "Expected a non empty 'days' list")
+        for day in days:
+            require(day, "branch", "date", "target")
+            day.setdefault("receipts", None)
+            day.setdefault("footfall", None)
+            day["amounts"] = [(a["currency"], a["method"], to_amount(a["amount"])) for a in day.get("amounts", [])]
+
+        try:
+            count = await self.pool.run(lambda db: db.post_daily_batch(days, apply_main=data.get("apply_main", True)))
+        except KeyError as e:
+            raise ApiError(404, f"Store not found: {e}")
+        return 201, {"rows": count}
+
+    async def sync_state(self, query, data):
+        require(query, "site")
+        try:
+            site = int(query["site"])
+        except ValueError:
+            raise ApiError(400, f"Invalid site: {query['site']!r}")
+        last_seq = await self.pool.run(lambda db: sync_position(db, site))
+        return 200, {"site_id": site, "last_seq": last_seq}
+
+    #Merged in one transaction, sending the same changeset again is a no-op
+    async def sync_changeset(self, query, data):
+        if data.get("format") != SYNC_FORMAT:
+            raise ApiError(400, f"Unknown changeset format: {data.get('format')}")
+        require(data, "site_id", "changes")
+
+        def work(db):
+            try:
+                return merge_changeset(db, data)
+            except ValueError as e:
+                raise ApiError(409, str(e))
+
+        applied, skipped = await self.pool.run(work)
+        return 201, {"applied": applied, "skipped": skipped}
+
+
+async def serve(args):
+    server = await ApiServer(args.db, pool_size=args.pool, token=args.token).start(args.host, args.port)
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON API over store.db")
+    parser.add_argument("--db", default="store.db")
+    parser.add_argument("--host", default="127.0.0.1", help="Keep it on localhost unless a token is set")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--pool", type=int, default=POOL_SIZE, help="Database connections shared by the requests")
+    parser.add_argument("--token", default=os.environ.get("STORE_API_TOKEN", ""), help="Require 'Authorization: Bearer <token>'")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print("API stopped")
+
+
+if __name__ == "__main__":
+    main()
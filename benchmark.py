@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import time
+from datetime import date, datetime
+
+from database import DatabaseManager, PHYSICAL_BRANCHES, LEDGER_SORTS, LEDGER_PAGE_SIZE, pick_granularity
+from analytics import branch_report, category_breakdown
+from ledger_cache import LedgerCache
+import columnar
+from datagen import LedgerGenerator, EXPENSE_CATEGORIES, parse_count
+
+#Headless benchmark for the DatabaseManager hot paths (no Tk needed)
+#Usage: python benchmark.py --scales 10k,1m --out bench.json
+
+CURRENCIES = ["USD ($)", "Lira (LBP)"]
+METHODS = ["Cash", "Card"]
+
+#Filter combinations the ledger screen can produce (type, category, currency, method, from, to)
+VIEW_FILTERS = {
+    "all": ("All", "All", "All", "All", "", ""),
+    "income_sales": ("Income", "Sales", "All", "All", "", ""),
+    "expense_usd_cash": ("Expense", "All", "USD ($)", "Cash", "", ""),
+    "fuzzy_category": ("All", "TVA", "All", "All", "", ""),
+    "exchange_pair": ("All", "Exchange In/Out", "All", "All", "", ""),
+    "one_month": ("All", "All", "All", "All", "2024-03-01", "2024-03-31"),
+    "month_lbp_card": ("All", "All", "Lira (LBP)", "Card", "2024-03-01", "2024-03-31"),
+}
+
+#Date ranges the analytics window is typically asked for
+ANALYTICS_RANGES = {
+    "month": ("2024-03-01", "2024-03-31"),
+    "year": ("2024-01-01", "2024-12-31"),
+}
+
+
+#Fill an empty store.db with about `count` transactions spread over the default branches
+def build_database(path, count, seed=42, days=365):
+    db = DatabaseManager(path)
+    LedgerGenerator(db, seed=seed, start=date(2024, 1, 1), days=days).run(count)
+    db.conn.close()
+
+
+def time_op(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "repeat": repeat,
+        "min_ms": round(min(samples), 3),
+        "median_ms": round(statistics.median(samples), 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "max_ms": round(max(samples), 3),
+    }
+
+
+def run_scale(path, scale_name, repeat):
+    db = DatabaseManager(path)
+    rng = random.Random(7)
+    results = []
+
+    store_names = db.get_store_names()
+    branches = [b for b in PHYSICAL_BRANCHES if b in store_names]
+
+    def record(op, func, n=repeat):
+        stats = time_op(func, n)
+        stats.update({"scale": scale_name, "op": op})
+        results.append(stats)
+        print(f"  {op:<38} median {stats['median_ms']:>10.3f} ms  (min {stats['min_ms']:.3f}, max {stats['max_ms']:.3f})")
+
+    #Everything added by the write benchmarks is removed at the end so the file can be reused
+    db.c.execute("SELECT IFNULL(MAX(id), 0) FROM transactions")
+    high_water = db.c.fetchone()[0]
+    db.c.execute("SELECT IFNULL(MAX(id), 0) FROM journal_batches")
+    batch_high_water = db.c.fetchone()[0]
+
+    record("add_transactions", lambda: db.add_transactions(
+        rng.choice(branches), "2024-06-15", "Expense", rng.choice(EXPENSE_CATEGORIES),
+        round(rng.uniform(5, 500), 2), rng.choice(CURRENCIES), rng.choice(METHODS)))
+
+    record("submit_sale_posting", lambda: db.post_transaction(
+        rng.choice(branches), "2024-06-15", "Income", "Sales", round(rng.uniform(5, 500), 2), rng.choice(CURRENCIES), rng.choice(METHODS)))
+
+    #A posting with its legs, then the undo that takes it back
+    record("post_and_undo", lambda: (db.post_transaction(
+        rng.choice(branches), "2024-06-15", "Income", "Sales", round(rng.uniform(5, 500), 2), rng.choice(CURRENCIES), rng.choice(METHODS)), db.undo()))
+
+    for branch in ["City Mall", "Main Vault"]:
+        record(f"get_transactions[{branch}]", lambda: db.get_transactions(branch))
+
+    record("get_balance_summary", db.get_balance_summary)
+
+    for name, (start, end) in ANALYTICS_RANGES.items():
+        granularity = pick_granularity(start, end)
+        record(f"analytics[{name}/{granularity}]", lambda: db.get_daily_rollup(branches, start, end, granularity))
+
+    for name, (start, end) in ANALYTICS_RANGES.items():
+        record(f"category_breakdown[{name}/sql]", lambda: category_breakdown(db, branches, start, end))
+        record(f"branch_report[{name}/sql]", lambda: branch_report(db, branches, start, end))
+
+    #The mirror is rebuilt from scratch once (timed), then scanned
+    if columnar.available():
+        mirror_dir = columnar.mirror_path(path)
+        if os.path.exists(mirror_dir):
+            shutil.rmtree(mirror_dir)
+        mirror = columnar.ColumnarMirror(db, mirror_dir)
+        record("mirror_full_refresh", mirror.refresh, n=1)
+        record("mirror_noop_refresh", mirror.refresh)
+        for name, (start, end) in ANALYTICS_RANGES.items():
+            record(f"category_breakdown[{name}/mirror]", lambda: category_breakdown(db, branches, start, end, mirror=mirror))
+            record(f"branch_report[{name}/mirror]", lambda: branch_report(db, branches, start, end, mirror=mirror))
+
+    for name, (f_type, f_cat, f_curr, f_paym, start, end) in VIEW_FILTERS.items():
+        record(f"view_records[{name}]", lambda: db.get_ledger_rows(
+            "City Mall", f_type, f_cat, f_curr, f_paym, start, end, match_from=False))
+
+    for name, (f_type, f_cat, f_curr, f_paym, start, end) in VIEW_FILTERS.items():
+        record(f"ledger_totals[{name}]", lambda: db.get_ledger_totals(
+            "City Mall", f_type, f_cat, f_curr, f_paym, start, end, match_from=False))
+
+    #First page of the ledger for every sortable heading (what a heading click costs)
+    for sort in LEDGER_SORTS:
+        record(f"ledger_page[{sort}]", lambda: db.get_ledger_rows(
+            "City Mall", sort=sort, descending=sort in ("date", "amount"), limit=LEDGER_PAGE_SIZE + 1))
+
+    #Switching back to a branch already on screen: only the data version check runs
+    cache = LedgerCache(db)
+    query = ("City Mall", "All", "All", "All", "All", "", "", False)
+    record("ledger_switch[cold]", lambda: (cache.views.clear(), cache.page(query, "date", True, 0), cache.totals(query)))
+    record("ledger_switch[cached]", lambda: (cache.page(query, "date", True, 0), cache.totals(query)))
+
+    record("view_records[main_vault_from]", lambda: db.get_ledger_rows(
+        "Main Vault", "Income", "City Mall", "All", "All", "", "", match_from=True))
+
+    record("check_integrity", db.check_integrity, n=1)
+
+    db.c.execute("DELETE FROM transactions WHERE id > ?", (high_water,))
+    db.c.execute("DELETE FROM journal WHERE batch_id > ?", (batch_high_water,))
+    db.c.execute("DELETE FROM journal_batches WHERE id > ?", (batch_high_water,))
+    db.bump_version("transactions")
+    db.conn.commit()
+    db.conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DatabaseManager hot paths on synthetic store.db files")
+    parser.add_argument("--scales", default="10k", help="Comma separated transaction counts, ex: 10k,1m,10m")
+    parser.add_argument("--dir", default="benchmark_dbs", help="Where the synthetic databases are kept")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs per operation")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--rebuild", action="store_true", help="Regenerate the databases even if they exist")
+    parser.add_argument("--out", default="", help="Write the JSON results to this file (stdout otherwise)")
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    results = []
+
+    for scale_name in args.scales.split(","):
+        scale_name = scale_name.strip()
+        count = parse_count(scale_name)
+        path = os.path.join(args.dir, f"store_{scale_name}_seed{args.seed}.db")
+
+        if args.rebuild and os.path.exists(path):
+            os.remove(path)
+
+        if not os.path.exists(path):
+            print(f"Building {path} with {count:,} transactions...")
+            start = time.perf_counter()
+            build_database(path, count, seed=args.seed)
+            print(f"  built in {time.perf_counter() - start:.1f}s")
+
+        print(f"Scale {scale_name}:")
+        results += run_scale(path, scale_name, args.repeat)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "results": results,
+    }
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.out}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
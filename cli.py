@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+#Headless entry point for cron / scheduled tasks: no Tk, pandas or matplotlib is imported
+#Usage: python cli.py [--db store.db] <command> ...
+#
+#  backup   [--dir backups] [--keep 30]
+#  balances [--json]
+#  export   --store "City Mall" [--type ..] [--category ..] [--currency ..] [--method ..] [--from ..] [--to ..] [--out file.csv]
+#  import   file.csv [--store "City Mall"] [--post]
+#  rollup   rebuild
+#  archive  YEAR [--dir archives] [--vacuum]
+#  mirror   refresh
+#  categories --from .. --to .. [--branch ..] [--type Expense] [--mirror] [--json]
+#  integrity [--limit 20] [--fix] [--json]
+#  journal  [--after 0] [--limit 1000]
+#  sync     [sync.py options]
+#  benchmark [benchmark.py options]
+
+EXPORT_HEADERS = ["ID", "Date", "Type", "Category", "Amount", "Currency", "Method", "Description"]
+
+
+def open_db(args):
+    #Imported here so "--help" does not even touch SQLite
+    from database import DatabaseManager
+    return DatabaseManager(args.db)
+
+
+def cmd_backup(args):
+    db = open_db(args)
+    os.makedirs(args.dir, exist_ok=True)
+    backup_file = os.path.join(args.dir, f"backup_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.db")
+    db.backup_to(backup_file)
+    print(f"Backup written to {backup_file}")
+
+    #Oldest backups go first once there are more than --keep of them
+    if args.keep > 0:
+        backups = sorted(name for name in os.listdir(args.dir) if name.startswith("backup_") and name.endswith(".db"))
+        for name in backups[:-args.keep]:
+            os.remove(os.path.join(args.dir, name))
+            print(f"Removed old backup {name}")
+
+
+def cmd_balances(args):
+    rows = open_db(args).get_balance_summary()
+
+    if args.json:
+        print(json.dumps([{"store": store, "currency": currency, "method": method, "balance": balance}
+                          for store, currency, method, balance in rows], indent=2))
+        return
+
+    print(f"{'Store':<20} {'Currency':<12} {'Method':<8} {'Balance':>20}")
+    for store, currency, method, balance in rows:
+        print(f"{store:<20} {currency:<12} {method:<8} {balance:>20,.2f}")
+
+
+def cmd_export(args):
+    import csv
+    from database import SYSTEM_ACCOUNTS
+
+    db = open_db(args)
+    rows = db.get_ledger_rows(args.store, args.type, args.category, args.currency, args.method, args.date_from, args.date_to,
+                              match_from=args.store in SYSTEM_ACCOUNTS)
+
+    file = open(args.out, "w", newline="", encoding="utf-8") if args.out else sys.stdout
+    try:
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_HEADERS)
+        writer.writerows(rows)
+    finally:
+        if args.out:
+            file.close()
+
+    print(f"Exported {len(rows):,} rows" + (f" to {args.out}" if args.out else ""), file=sys.stderr)
+
+
+#Reads the export format (the ID column is ignored), an optional Store column overrides --store
+#Rows are written as they are, or with --post as new postings that get their derived legs
+#Everything is imported in one transaction: a bad row leaves the database untouched
+def cmd_import(args):
+    import csv
+
+    db = open_db(args)
+    with open(args.file, newline="", encoding="utf-8-sig") as file:
+        rows = [{key.strip().lower(): (value or "").strip() for key, value in row.items() if key} for row in csv.DictReader(file)]
+
+    count = 0
+    with db.write():
+        for line, row in enumerate(rows, start=2):
+            store = row.get("store") or args.store
+            if not store:
+                raise SystemExit(f"Line {line}: no store (add a Store column or pass --store)")
+
+            try:
+                amount = float(row["amount"].replace(",", ""))
+                values = (store, row["date"], row["type"], row["category"], amount, row["currency"], row["method"])
+            except (KeyError, ValueError) as e:
+                raise SystemExit(f"Line {line}: invalid row ({e})")
+
+            if args.post:
+                row_id = db.post_transaction(*values, description=row.get("description") or None)
+            else:
+                row_id = db.add_transactions(*values, description=row.get("description") or None)
+
+            if row_id is None:
+                raise SystemExit(f"Line {line}: store not found: {store}")
+            count += 1
+
+    print(f"Imported {count:,} rows from {args.file}")
+
+
+def cmd_rollup(args):
+    db = open_db(args)
+    db.rebuild_rollup()
+    print("Daily rollup rebuilt")
+
+
+#Moves a closed year to archives/store_YEAR.db (back that file up once, it never changes afterwards)
+def cmd_archive(args):
+    db = open_db(args)
+    try:
+        db.archive_year(args.year, archive_dir=args.dir)
+    except (ValueError, RuntimeError) as e:
+        raise SystemExit(str(e))
+
+    #The freed pages only go back to the file system with a VACUUM (slow on a big file, needs the app closed)
+    if args.vacuum:
+        db.conn.execute("VACUUM")
+        print("Database vacuumed")
+
+
+#Meant for a scheduled task so the analytics never wait on a big catch-up (needs numpy)
+def cmd_mirror(args):
+    from columnar import ColumnarMirror, mirror_path
+    try:
+        mirror = ColumnarMirror(open_db(args), mirror_path(args.db))
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    read = mirror.refresh()
+    print(f"Mirror refreshed: {read:,} transactions read, {mirror.meta['counts']['transactions']:,} mirrored")
+
+
+def cmd_categories(args):
+    from analytics import category_breakdown
+    from database import PHYSICAL_BRANCHES
+
+    db = open_db(args)
+    mirror = None
+    if args.mirror:
+        from columnar import ColumnarMirror, mirror_path
+        try:
+            mirror = ColumnarMirror(db, mirror_path(args.db))
+        except RuntimeError as e:
+            raise SystemExit(str(e))
+        mirror.refresh()
+
+    branches = PHYSICAL_BRANCHES if args.branch == "All" else [args.branch]
+    rows = category_breakdown(db, branches, args.date_from, args.date_to, args.type, mirror=mirror)
+
+    if args.json:
+        print(json.dumps([{"category": category, "total_usd": total} for category, total in rows], indent=2))
+        return
+
+    print(f"{'Category':<30} {'Total (USD)':>16}")
+    for category, total in rows:
+        print(f"{category:<30} {total:>16,.2f}")
+
+
+#Exits with 1 while problems remain, so a scheduled run can alert on it
+def cmd_integrity(args):
+    from database import INTEGRITY_CHECKS
+
+    db = open_db(args)
+    if args.fix:
+        print(f"Recalculated {db.fix_leg_drift():,} drifted legs", file=sys.stderr)
+    report = db.check_integrity(limit=args.limit)
+
+    if args.json:
+        print(json.dumps({kind: {"count": entry["count"],
+                                 "rows": [dict(zip(["id", "parent_id", "date", "store", "detail"], row)) for row in entry["rows"]]}
+                          for kind, entry in report.items()}, indent=2))
+    else:
+        for kind, entry in report.items():
+            print(f"{INTEGRITY_CHECKS[kind]:<36} {entry['count']:>10,}")
+            for row_id, parent_id, t_date, store, detail in entry["rows"]:
+                print(f"    #{row_id:<10} parent {parent_id or '-':<10} {t_date:<12} {store or '?':<18} {detail}")
+
+    if any(entry["count"] for entry in report.values()):
+        raise SystemExit(1)
+
+
+#Incremental readers: one JSON line per change after --after, the id to pass next time goes to stderr
+def cmd_journal(args):
+    rows = open_db(args).read_journal(args.after, args.limit)
+    for row_id, batch_id, table, op, old, new in rows:
+        print(json.dumps({"id": row_id, "batch": batch_id, "table": table, "op": op, "old": old, "new": new}))
+    print(f"Next: --after {rows[-1][0] if rows else args.after}", file=sys.stderr)
+
+
+def cmd_sync(args):
+    import sync
+    sys.argv = ["sync.py", "--db", args.db, *args.options]
+    sync.main()
+
+
+def cmd_benchmark(args):
+    import benchmark
+    sys.argv = ["benchmark.py", *args.options]
+    benchmark.main()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Store ledger batch jobs and reports (no GUI)")
+    parser.add_argument("--db", default="store.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backup = commands.add_parser("backup", help="Consistent copy of the database")
+    backup.add_argument("--dir", default="backups")
+    backup.add_argument("--keep", type=int, default=0, help="Only keep the newest N backups (0 keeps everything)")
+    backup.set_defaults(func=cmd_backup)
+
+    balances = commands.add_parser("balances", help="Balance of every store / currency / method")
+    balances.add_argument("--json", action="store_true")
+    balances.set_defaults(func=cmd_balances)
+
+    export = commands.add_parser("export", help="Ledger rows of a store as CSV (same filters as the ledger screen)")
+    export.add_argument("--store", required=True)
+    export.add_argument("--type", default="All")
+    export.add_argument("--category", default="All")
+    export.add_argument("--currency", default="All")
+    export.add_argument("--method", default="All")
+    export.add_argument("--from", dest="date_from", default="")
+    export.add_argument("--to", dest="date_to", default="")
+    export.add_argument("--out", default="", help="CSV file (stdout otherwise)")
+    export.set_defaults(func=cmd_export)
+
+    imp = commands.add_parser("import", help="Load ledger rows from a CSV file")
+    imp.add_argument("file")
+    imp.add_argument("--store", default="", help="Store of the rows without a Store column")
+    imp.add_argument("--post", action="store_true", help="Post every row with its derived legs (TVA, Main, ...)")
+    imp.set_defaults(func=cmd_import)
+
+    rollup = commands.add_parser("rollup", help="Daily rollup maintenance")
+    rollup.add_argument("action", choices=["rebuild"])
+    rollup.set_defaults(func=cmd_rollup)
+
+    archive = commands.add_parser("archive", help="Move a closed year to its own database file")
+    archive.add_argument("year", type=int)
+    archive.add_argument("--dir", default="archives", help="Relative to the database folder")
+    archive.add_argument("--vacuum", action="store_true", help="Shrink store.db afterwards")
+    archive.set_defaults(func=cmd_archive)
+
+    mirror = commands.add_parser("mirror", help="Columnar mirror of the ledger for the analytics scans (needs numpy)")
+    mirror.add_argument("action", choices=["refresh"])
+    mirror.set_defaults(func=cmd_mirror)
+
+    categories = commands.add_parser("categories", help="USD total per category over a date range")
+    categories.add_argument("--from", dest="date_from", required=True)
+    categories.add_argument("--to", dest="date_to", required=True)
+    categories.add_argument("--branch", default="All")
+    categories.add_argument("--type", default="Expense", choices=["Income", "Expense"])
+    categories.add_argument("--mirror", action="store_true", help="Scan the columnar mirror instead of SQL")
+    categories.add_argument("--json", action="store_true")
+    categories.set_defaults(func=cmd_categories)
+
+    integrity = commands.add_parser("integrity", help="Check every derived-leg chain (orphans, missing legs, amount drift)")
+    integrity.add_argument("--limit", type=int, default=20, help="Rows listed per check")
+    integrity.add_argument("--fix", action="store_true", help="Recalculate drifted legs from their parent first")
+    integrity.add_argument("--json", action="store_true")
+    integrity.set_defaults(func=cmd_integrity)
+
+    journal = commands.add_parser("journal", help="Changes recorded after a journal id (inserts, updates, deletes)")
+    journal.add_argument("--after", type=int, default=0, help="Last journal id already handled")
+    journal.add_argument("--limit", type=int, default=1000)
+    journal.set_defaults(func=cmd_journal)
+
+    sync_cmd = commands.add_parser("sync", help="Run sync.py on this database (export, merge, push, status)")
+    sync_cmd.add_argument("options", nargs=argparse.REMAINDER)
+    sync_cmd.set_defaults(func=cmd_sync)
+
+    bench = commands.add_parser("benchmark", help="Run benchmark.py (options are passed through)")
+    bench.add_argument("options", nargs=argparse.REMAINDER)
+    bench.set_defaults(func=cmd_benchmark)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
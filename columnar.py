@@ -0,0 +1,277 @@
+import json
+import os
+
+from database import to_day, from_day
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#Optional columnar copy of transactions, daily_sales and daily_metrics for the analytics scans
+#Every column is a memory-mapped .npy file (strings are dictionary encoded, dates are day numbers like in SQLite),
+#so a scan reads the arrays in place instead of building a Python object per row
+#Only new ids are appended on refresh, any update or delete (see REWRITE_TRIGGERS) rebuilds it
+#Needs numpy, without it available() is False and the analytics stay on SQL
+
+NO_DAY = -2 ** 31
+FETCH_ROWS = 50_000
+MIN_CAPACITY = 1024
+
+#(column, dtype) per table, the string columns are stored as codes into meta["dicts"][column]
+TABLES = {
+    "transactions": [("id", "int64"), ("store_id", "int32"), ("parent_id", "int64"), ("day", "int32"), ("type", "int32"),
+                     ("category", "int32"), ("amount", "float64"), ("currency", "int32"), ("method", "int32"), ("leg_role", "int32")],
+    "daily_sales": [("store_id", "int32"), ("day", "int32"), ("amount", "float64")],
+    "daily_metrics": [("store_id", "int32"), ("day", "int32"), ("receipts", "int64"), ("footfall", "int64")],
+}
+STRING_COLUMNS = ["type", "category", "currency", "method", "leg_role"]
+
+#Dates come out of SQLite as day numbers already, only NULL needs a stand in
+TRANSACTIONS_QUERY = f"""
+    SELECT id, IFNULL(store_id, -1), IFNULL(parent_id, -1), IFNULL(date, {NO_DAY}), IFNULL(type, ''), IFNULL(category, ''), IFNULL(amount, 0),
+           IFNULL(currency, ''), IFNULL(payment_method, ''), IFNULL(leg_role, '')
+    FROM transactions WHERE id > ? ORDER BY id
+"""
+DAILY_SALES_QUERY = f"SELECT store_id, IFNULL(date, {NO_DAY}), IFNULL(amount, 0) FROM daily_sales"
+DAILY_METRICS_QUERY = f"SELECT store_id, IFNULL(date, {NO_DAY}), IFNULL(receipts, 0), IFNULL(footfall, 0) FROM daily_metrics"
+
+
+def available():
+    return np is not None
+
+
+#"2024-03-01" -> days since 1970-01-01, same numbers as the date columns (NO_DAY when the text is not a date)
+def day_number(text):
+    try:
+        day = to_day(text)
+    except (TypeError, ValueError):
+        day = None
+    return NO_DAY if day is None else day
+
+
+def day_text(day):
+    return from_day(int(day))
+
+
+#Mirror directory next to the database: store.db -> store_columns/
+def mirror_path(db_name):
+    return f"{os.path.splitext(db_name)[0]}_columns"
+
+
+class ColumnarMirror:
+    def __init__(self, db, path):
+        if np is None:
+            raise RuntimeError("The columnar mirror needs numpy (pip install numpy)")
+        self.db = db
+        self.path = path
+        self.meta = self.load_meta()
+        self.columns = {}
+
+    def load_meta(self):
+        try:
+            with open(os.path.join(self.path, "meta.json"), encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    #meta.json is written last and atomically: rows past its counts are ignored after a crash
+    def save_meta(self):
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as file:
+            json.dump(self.meta, file)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    def column_file(self, table, column):
+        return os.path.join(self.path, f"{table}.{column}.npy")
+
+    #Brings the mirror up to date: O(new rows), or a full rebuild after an update/delete or on another database file
+    #Returns the number of transactions rows read
+    def refresh(self):
+        #Versions are read before the rows: a change landing in between is only seen on the next refresh
+        epoch, rewrite, sales_version, metrics_version = self.db.get_data_versions(["transactions_rewrite", "daily_sales", "daily_metrics"])
+        self.columns = {}
+
+        if self.meta is None or self.meta["epoch"] != epoch or self.meta["rewrite"] != rewrite:
+            os.makedirs(self.path, exist_ok=True)
+            self.meta = {"epoch": epoch, "rewrite": rewrite, "high_water": 0, "versions": {},
+                         "counts": {table: 0 for table in TABLES}, "dicts": {column: [] for column in STRING_COLUMNS}}
+            #Saved right away so a crash during the rebuild can't pair the old counts with the new files
+            self.save_meta()
+
+        read = self.append_transactions()
+
+        if self.meta["versions"].get("daily_sales") != sales_version:
+            self.replace_table("daily_sales", DAILY_SALES_QUERY)
+            self.meta["versions"]["daily_sales"] = sales_version
+        if self.meta["versions"].get("daily_metrics") != metrics_version:
+            self.replace_table("daily_metrics", DAILY_METRICS_QUERY)
+            self.meta["versions"]["daily_metrics"] = metrics_version
+
+        self.meta["rewrite"] = rewrite
+        self.save_meta()
+        self.columns = {}
+        return read
+
+    def append_transactions(self):
+        codes = {column: {value: code for code, value in enumerate(self.meta["dicts"][column])} for column in STRING_COLUMNS}
+        read = 0
+
+        self.db.c.execute(TRANSACTIONS_QUERY, (self.meta["high_water"],))
+        while True:
+            rows = self.db.c.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+
+            #Python only touches the new rows once, to turn the strings into codes
+            chunk = list(zip(*rows))
+            values = {"id": chunk[0], "store_id": chunk[1], "parent_id": chunk[2], "day": chunk[3], "amount": chunk[6]}
+            for column, index in [("type", 4), ("category", 5), ("currency", 7), ("method", 8), ("leg_role", 9)]:
+                lookup = codes[column]
+                strings = self.meta["dicts"][column]
+                encoded = []
+                for text in chunk[index]:
+                    code = lookup.get(text)
+                    if code is None:
+                        code = lookup[text] = len(strings)
+                        strings.append(text)
+                    encoded.append(code)
+                values[column] = encoded
+
+            self.append("transactions", values, len(rows))
+            self.meta["high_water"] = rows[-1][0]
+            read += len(rows)
+        return read
+
+    #Small tables (one row per branch-day): rewritten whole when their version moves
+    def replace_table(self, table, query):
+        self.db.c.execute(query)
+        rows = self.db.c.fetchall()
+        chunk = list(zip(*rows)) if rows else [[] for _ in TABLES[table]]
+        values = {column: chunk[index] for index, (column, _) in enumerate(TABLES[table])}
+
+        self.meta["counts"][table] = 0
+        self.append(table, values, len(rows))
+
+    #Writes the rows after the current count, files grow by doubling so appends stay amortized O(rows)
+    def append(self, table, values, n):
+        start = self.meta["counts"][table]
+        for column, dtype in TABLES[table]:
+            file_path = self.column_file(table, column)
+            array = np.load(file_path, mmap_mode="r+") if start and os.path.exists(file_path) else None
+
+            if array is None or len(array) < start + n:
+                capacity = max(MIN_CAPACITY, start + n, 2 * (len(array) if array is not None else 0))
+                grown = np.lib.format.open_memmap(file_path + ".tmp", mode="w+", dtype=dtype, shape=(capacity,))
+                if array is not None:
+                    grown[:start] = array[:start]
+                grown.flush()
+                del grown, array
+                os.replace(file_path + ".tmp", file_path)
+                array = np.load(file_path, mmap_mode="r+")
+
+            array[start:start + n] = np.asarray(values[column], dtype=dtype)
+            array.flush()
+            del array
+
+        self.meta["counts"][table] = start + n
+
+    #Read-only views over the mapped files (no copy), limited to the rows the meta knows about
+    def table(self, table):
+        if table not in self.columns:
+            count = self.meta["counts"][table] if self.meta else 0
+            arrays = {}
+            for column, dtype in TABLES[table]:
+                file_path = self.column_file(table, column)
+                arrays[column] = np.load(file_path, mmap_mode="r")[:count] if count and os.path.exists(file_path) else np.zeros(0, dtype=dtype)
+            self.columns[table] = arrays
+        return self.columns[table]
+
+    #Code of a string in a dictionary encoded column (-1 matches nothing)
+    def code(self, column, value):
+        strings = self.meta["dicts"][column] if self.meta else []
+        return strings.index(value) if value in strings else -1
+
+    def store_ids(self, names):
+        self.db.c.execute("SELECT id FROM stores WHERE name IN (SELECT value FROM json_each(?))", (json.dumps(names),))
+        return np.array([row[0] for row in self.db.c.fetchall()], dtype="int32")
+
+    #LBP -> USD rate of every day number in `days`, same as-of rule as RATE_ON (a rate of 0 counts as unknown)
+    def rates_on(self, days):
+        self.db.c.execute("SELECT date, rate FROM exchange_rates ORDER BY date")
+        history = self.db.c.fetchall()
+        if not history:
+            return np.full(len(days), np.nan)
+
+        #The opening rate (0000-01-01) is not a real date, it covers everything before the first change
+        starts = np.array([day_number(text) if text[:4] != "0000" else NO_DAY for text, _ in history], dtype="int64")
+        rates = np.array([rate or np.nan for _, rate in history], dtype="float64")
+        index = np.searchsorted(starts, days, side="right") - 1
+        return np.where(index >= 0, rates[np.maximum(index, 0)], np.nan)
+
+    #Vectorized version of DatabaseManager.get_category_totals: [(category, total in USD)], biggest first
+    def category_totals(self, branches, start_date, end_date, t_type="Expense"):
+        tx = self.table("transactions")
+        mask = ((tx["day"] >= day_number(start_date)) & (tx["day"] <= day_number(end_date))
+                & (tx["type"] == self.code("type", t_type)) & np.isin(tx["store_id"], self.store_ids(branches)))
+
+        amounts = tx["amount"][mask]
+        usd = tx["currency"][mask] == self.code("currency", "USD ($)")
+        converted = np.where(usd, amounts, amounts / self.rates_on(tx["day"][mask]))
+
+        categories = tx["category"][mask]
+        totals = np.bincount(categories, weights=np.nan_to_num(converted), minlength=len(self.meta["dicts"]["category"]))
+        present = np.bincount(categories, minlength=len(totals)) > 0
+
+        names = self.meta["dicts"]["category"]
+        result = [(names[code], float(totals[code])) for code in np.nonzero(present)[0]]
+        result.sort(key=lambda row: row[1], reverse=True)
+        return result
+
+    #Vectorized version of DatabaseManager.get_branch_rollup, from the daily_sales and daily_metrics arrays:
+    #[(branch, period start, sales, receipts, footfall, sales in USD)] sorted by branch and period
+    def branch_rollup(self, branches, start_date, end_date, granularity="day"):
+        first, last = day_number(start_date), day_number(end_date)
+        self.db.c.execute("SELECT id, name FROM stores WHERE name IN (SELECT value FROM json_each(?))", (json.dumps(branches),))
+        names = dict(self.db.c.fetchall())
+        ids = np.array(list(names), dtype="int32")
+
+        sales = self.table("daily_sales")
+        s_mask = (sales["day"] >= first) & (sales["day"] <= last) & np.isin(sales["store_id"], ids)
+        s_days = sales["day"][s_mask]
+        amounts = sales["amount"][s_mask]
+        usd = np.nan_to_num(amounts / self.rates_on(s_days))
+
+        metrics = self.table("daily_metrics")
+        m_mask = (metrics["day"] >= first) & (metrics["day"] <= last) & np.isin(metrics["store_id"], ids)
+
+        #One group per (store, period) found in either table, like the rollup rows of the range
+        stores = np.concatenate([sales["store_id"][s_mask], metrics["store_id"][m_mask]]).astype("int64")
+        periods = period_starts(np.concatenate([s_days, metrics["day"][m_mask]]), granularity)
+        if not len(stores):
+            return []
+        keys, group = np.unique(np.stack([stores, periods], axis=1), axis=0, return_inverse=True)
+        group = group.reshape(-1)
+        s_group, m_group = group[:len(s_days)], group[len(s_days):]
+
+        totals = [np.bincount(s_group, weights=amounts, minlength=len(keys)),
+                  np.bincount(m_group, weights=metrics["receipts"][m_mask], minlength=len(keys)),
+                  np.bincount(m_group, weights=metrics["footfall"][m_mask], minlength=len(keys)),
+                  np.bincount(s_group, weights=usd, minlength=len(keys))]
+
+        result = [(names[int(store)], day_text(period), float(totals[0][i]), int(totals[1][i]), int(totals[2][i]), float(totals[3][i]))
+                  for i, (store, period) in enumerate(keys)]
+        result.sort(key=lambda row: (row[0], row[1]))
+        return result
+
+
+#First day of the period every day number falls in, the same buckets as GRANULARITY_PERIODS in SQL
+def period_starts(days, granularity):
+    days = np.asarray(days, dtype="int64")
+    if granularity == "week":
+        #Weeks start on Monday, day 0 (1970-01-01) was a Thursday
+        return days - (days + 3) % 7
+    if granularity in ("month", "year"):
+        unit = "M" if granularity == "month" else "Y"
+        return days.astype("datetime64[D]").astype(f"datetime64[{unit}]").astype("datetime64[D]").astype("int64")
+    return days
@@ -0,0 +1,1748 @@
+import sqlite3
+import re
+import json
+import os
+import platform
+import random
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+
+from querystats import QueryStats, InstrumentedCursor, SLOW_QUERY_MS
+
+#Several workstations can open the same store.db: writers wait for each other instead of failing
+#WAL lets the readers carry on while someone writes, but it needs every process on the same machine
+#(shared memory), so a store.db on a network share has to run with STORE_JOURNAL_MODE=delete
+JOURNAL_MODE = os.environ.get("STORE_JOURNAL_MODE", "wal")
+BUSY_TIMEOUT_MS = 5000
+WRITE_RETRIES = 5
+
+
+#Raised when a record was changed or deleted by someone else since it was read
+class StaleRecordError(Exception):
+    pass
+
+
+#Raised when a write targets a year that was moved to an archive
+class ClosedPeriodError(Exception):
+    pass
+
+
+#Closed years live in archives/store_<year>.db, the hot database keeps one carry forward row
+#per store / currency / method and year so balances and the rollup stay whole
+ARCHIVE_DIR = "archives"
+CARRY_FORWARD = "carry_forward"
+
+#SQLite allows 10 attached databases by default, older archives are detached past this
+MAX_ATTACHED_ARCHIVES = 8
+
+#Columns copied to the archives (row_version is not needed once a year is closed)
+ARCHIVE_COLUMNS = "id, store_id, parent_id, date, type, category, amount, currency, payment_method, description, leg_role, leg_rate"
+
+
+#Branches that hold a real cash register (used by analytics and reconciliation)
+PHYSICAL_BRANCHES = [
+    "LeMall Dbayye",
+    "City Center",
+    "City Mall",
+    "Tripoli",
+    "Koura Branch"
+]
+
+#Internal accounts that only receive the derived legs
+SYSTEM_ACCOUNTS = ["Main Vault", "TVA Account", "Bank Commission", "Cost of goods", "Freight"]
+
+#Every auto generated leg records its role and the rate (in %) it was derived with
+#Roles listed here map to the settings key that holds their current rate
+LEG_RATE_KEYS = {
+    "main": "main_rate",
+    "tva": "tva_rate",
+    "comm": "comm_rate",
+    "freight": "freight_rate",
+}
+
+#Expense side legs that carry their rate in the category text (ex: "TVA (7%)")
+LEG_LABELS = {
+    "main": "Main",
+    "tva": "TVA",
+    "comm": "Card Commission",
+}
+
+#Shared SET clause: amount = parent amount * rate, and relabel the expense legs with their rate
+RECALC_LEGS_SET = """
+    SET amount = ROUND((SELECT p.amount FROM transactions p WHERE p.id = transactions.parent_id) * leg_rate / 100, 2),
+        row_version = row_version + 1,
+        category = CASE
+            WHEN type = 'Expense' AND leg_role = 'main' THEN 'Main (' || printf('%g', leg_rate) || '%)'
+            WHEN type = 'Expense' AND leg_role = 'tva' THEN 'TVA (' || printf('%g', leg_rate) || '%)'
+            WHEN type = 'Expense' AND leg_role = 'comm' THEN 'Card Commission (' || printf('%g', leg_rate) || '%)'
+            ELSE category
+        END
+"""
+
+
+#Posting rules: the legs a parent transaction fans out into
+#rates is {role: rate in %}, every leg is (store, type, category, amount, leg_role, leg_rate)
+def derive_legs(store, t_type, category, amount, p_method, rates, apply_main=True):
+    legs = []
+
+    if t_type == "Expense" and category == "Cost of goods":
+        freight_rate = rates["freight"]
+        amt_freight = round(amount * (freight_rate / 100), 2)
+        legs.append(("Cost of goods", "Income", f"from {store}", amount, "cogs", 100.0))
+        legs.append((store, "Expense", "Freight", amt_freight, "freight", freight_rate))
+        legs.append(("Freight", "Income", f"from {store}", amt_freight, "freight", freight_rate))
+
+    if t_type == "Expense" and category == "Main":
+        legs.append(("Main Vault", "Income", f"from {store}", amount, "main_transfer", 100.0))
+
+    if t_type == "Income" and category == "Sales":
+        if apply_main:
+            main_rate = rates["main"]
+            amount_main = round(amount * (main_rate / 100), 2)
+            legs.append((store, "Expense", f"Main ({main_rate:g}%)", amount_main, "main", main_rate))
+            legs.append(("Main Vault", "Income", f"from {store}", amount_main, "main", main_rate))
+
+        tva_rate = rates["tva"]
+        amount_tva = round(amount * (tva_rate / 100), 2)
+        legs.append((store, "Expense", f"TVA ({tva_rate:g}%)", amount_tva, "tva", tva_rate))
+        legs.append(("TVA Account", "Income", f"from {store}", amount_tva, "tva", tva_rate))
+
+        if p_method == "Card":
+            comm_rate = rates["comm"]
+            amount_comm = round(amount * (comm_rate / 100), 2)
+            legs.append((store, "Expense", f"Card Commission ({comm_rate:g}%)", amount_comm, "comm", comm_rate))
+            legs.append(("Bank Commission", "Income", f"from {store}", amount_comm, "comm", comm_rate))
+
+    return legs
+
+
+#Ledger dates are stored as day numbers (days since 1970-01-01): 3 bytes instead of 10 in the rows and every index
+#"yyyy-mm-dd" text only exists outside the database, the methods below convert at the boundary
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+#SQL: day number -> "yyyy-mm-dd" ({} is the column), 2440587.5 is the julian day of 1970-01-01
+DAY_TEXT = "date({} + 2440587.5)"
+
+
+#"2024-03-01" -> 19783, an empty date stays None (a malformed one raises ValueError)
+def to_day(text):
+    return date.fromisoformat(text).toordinal() - EPOCH_ORDINAL if text else None
+
+
+def from_day(day):
+    return date.fromordinal(day + EPOCH_ORDINAL).isoformat() if day is not None else ""
+
+
+#LBP per USD in effect on a given date (the latest rate set on or before it), {} is the date as text
+#The rate history keeps text dates, so a day number column goes through DAY_TEXT first
+#Amounts are grouped by date first so the lookup runs once per day, not once per row
+RATE_ON = "(SELECT NULLIF(x.rate, 0) FROM exchange_rates x WHERE x.date <= {} ORDER BY x.date DESC LIMIT 1)"
+
+#Opening row of the rate history: covers every date before the first recorded change
+OPENING_RATE_DATE = "0000-01-01"
+
+#Analytics buckets: SQL expression giving the first day of the period a rollup day falls in (as text)
+GRANULARITY_PERIODS = {
+    "day": "date(r.date + 2440587.5)",
+    "week": "date(r.date + 2440587.5, '-6 days', 'weekday 1')",
+    "month": "strftime('%Y-%m-01', r.date + 2440587.5)",
+    "year": "strftime('%Y-01-01', r.date + 2440587.5)",
+}
+
+#Charts never get more points than this, a finer granularity is bumped to the next one
+MAX_CHART_POINTS = 60
+
+#Ledger columns that can be sorted on (heading -> SQL), ties are broken by id so pages never overlap
+#Each one has a (store_id, column) index, the id comes free as the last key of every index
+LEDGER_SORTS = {
+    "date": "t.date",
+    "amount": "t.amount",
+    "category": "t.category",
+    "currency": "t.currency",
+    "method": "t.payment_method",
+}
+LEDGER_PAGE_SIZE = 300
+
+#Account that receives the income side of each leg role (the expense side stays on the parent's store)
+LEG_ACCOUNTS = {
+    "main": "Main Vault",
+    "tva": "TVA Account",
+    "comm": "Bank Commission",
+    "freight": "Freight",
+    "cogs": "Cost of goods",
+    "main_transfer": "Main Vault",
+}
+
+#What the integrity check reports, in the order it is shown
+INTEGRITY_CHECKS = {
+    "orphan": "Leg whose parent is gone",
+    "nested": "Leg hanging off another leg",
+    "unknown_role": "Leg with no recorded role",
+    "drift": "Amount differs from parent x rate",
+    "date": "Leg dated apart from its parent",
+    "account": "Leg on the wrong account",
+    "label": "Category does not match the rule",
+    "missing": "Parent with missing or extra legs",
+}
+
+#Pass 1, one row per leg: the first problem found on it (NULL when the leg is fine)
+#A cent off is rounding (postings round in Python, the recalc in SQLite), more than that is drift
+INTEGRITY_LEG_PASS = """
+    WITH accounts AS (SELECT key AS role, value AS account FROM json_each(?)),
+         labels AS (SELECT key AS role, value AS label FROM json_each(?))
+    SELECT issue, id, parent_id, date, store, amount, expected, category FROM (
+        SELECT t.id, t.parent_id, date(t.date + 2440587.5) AS date, s.name AS store, t.amount, t.category,
+               ROUND(p.amount * t.leg_rate / 100, 2) AS expected,
+               CASE
+                   WHEN p.id IS NULL THEN 'orphan'
+                   WHEN p.parent_id IS NOT NULL THEN 'nested'
+                   WHEN IFNULL(t.leg_role, 'unknown') = 'unknown' THEN 'unknown_role'
+                   WHEN t.leg_rate IS NOT NULL AND ABS(t.amount - ROUND(p.amount * t.leg_rate / 100, 2)) > 0.015 THEN 'drift'
+                   WHEN t.date IS NOT p.date THEN 'date'
+                   WHEN CASE WHEN t.type = 'Income' AND a.account IS NOT NULL THEN s.name IS NOT a.account
+                             ELSE t.store_id IS NOT p.store_id END THEN 'account'
+                   WHEN CASE WHEN t.type = 'Income' AND a.account IS NOT NULL THEN t.category IS NOT 'from ' || ps.name
+                             WHEN l.label IS NOT NULL THEN t.category IS NOT l.label || ' (' || printf('%g', t.leg_rate) || '%)'
+                             WHEN t.type = 'Expense' AND t.leg_role = 'freight' THEN t.category IS NOT 'Freight'
+                             ELSE 0 END THEN 'label'
+               END AS issue
+        FROM transactions t
+        LEFT JOIN transactions p ON p.id = t.parent_id
+        LEFT JOIN stores s ON s.id = t.store_id
+        LEFT JOIN stores ps ON ps.id = p.store_id
+        LEFT JOIN accounts a ON a.role = t.leg_role
+        LEFT JOIN labels l ON l.role = t.leg_role AND t.type = 'Expense'
+        WHERE t.parent_id IS NOT NULL
+    )
+    WHERE issue IS NOT NULL
+"""
+
+#Pass 2, one row per parent: its legs counted per role and side, compared with what derive_legs makes
+#The Main pair is optional on a sale (apply_main), but both sides or none
+INTEGRITY_PARENT_PASS = """
+    SELECT id, date, store, sales, card, cogs, main, swap, main_out, main_in, tva_out, tva_in, comm_out, comm_in,
+           freight_out, freight_in, cogs_in, transfer_in, swap_in
+    FROM (
+        SELECT p.id, date(p.date + 2440587.5) AS date, s.name AS store,
+               (p.type = 'Income' AND p.category = 'Sales') AS sales,
+               (p.type = 'Income' AND p.category = 'Sales' AND p.payment_method = 'Card') AS card,
+               (p.type = 'Expense' AND p.category = 'Cost of goods') AS cogs,
+               (p.type = 'Expense' AND p.category = 'Main') AS main,
+               (p.type = 'Expense' AND p.category IN ('Exchange Out', 'Bank Transfer Out')) AS swap,
+               IFNULL(l.main_out, 0) AS main_out, IFNULL(l.main_in, 0) AS main_in,
+               IFNULL(l.tva_out, 0) AS tva_out, IFNULL(l.tva_in, 0) AS tva_in,
+               IFNULL(l.comm_out, 0) AS comm_out, IFNULL(l.comm_in, 0) AS comm_in,
+               IFNULL(l.freight_out, 0) AS freight_out, IFNULL(l.freight_in, 0) AS freight_in,
+               IFNULL(l.cogs_in, 0) AS cogs_in, IFNULL(l.transfer_in, 0) AS transfer_in, IFNULL(l.swap_in, 0) AS swap_in
+        FROM transactions p
+        LEFT JOIN (
+            SELECT parent_id,
+                   SUM(leg_role = 'main' AND type = 'Expense') AS main_out, SUM(leg_role = 'main' AND type = 'Income') AS main_in,
+                   SUM(leg_role = 'tva' AND type = 'Expense') AS tva_out, SUM(leg_role = 'tva' AND type = 'Income') AS tva_in,
+                   SUM(leg_role = 'comm' AND type = 'Expense') AS comm_out, SUM(leg_role = 'comm' AND type = 'Income') AS comm_in,
+                   SUM(leg_role = 'freight' AND type = 'Expense') AS freight_out, SUM(leg_role = 'freight' AND type = 'Income') AS freight_in,
+                   SUM(leg_role = 'cogs') AS cogs_in, SUM(leg_role = 'main_transfer') AS transfer_in,
+                   SUM(leg_role IN ('exchange', 'transfer')) AS swap_in
+            FROM transactions WHERE parent_id IS NOT NULL
+            GROUP BY parent_id
+        ) l ON l.parent_id = p.id
+        LEFT JOIN stores s ON s.id = p.store_id
+        WHERE p.parent_id IS NULL
+    )
+    WHERE tva_out != sales OR tva_in != sales OR comm_out != card OR comm_in != card
+       OR main_out != main_in OR main_out > sales
+       OR freight_out != cogs OR freight_in != cogs OR cogs_in != cogs
+       OR transfer_in != main OR swap_in != swap
+"""
+
+
+#Number of periods a date range spans at the given granularity
+def period_count(start_date, end_date, granularity):
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    if end < start:
+        return 0
+    if granularity == "day":
+        return (end - start).days + 1
+    if granularity == "week":
+        return (end.toordinal() - end.weekday() - (start.toordinal() - start.weekday())) // 7 + 1
+    if granularity == "month":
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return end.year - start.year + 1
+
+
+#Finest granularity (at least `wanted`) that keeps the chart under max_points
+def pick_granularity(start_date, end_date, wanted="auto", max_points=MAX_CHART_POINTS):
+    order = list(GRANULARITY_PERIODS)
+    first = 0 if wanted == "auto" else order.index(wanted)
+    for granularity in order[first:]:
+        if period_count(start_date, end_date, granularity) <= max_points:
+            return granularity
+    return order[-1]
+
+
+#Triggers keeping daily_rollup in sync with every write (UI, bulk posts, imports...)
+#Ledger rows add/subtract their amount, daily_sales/daily_metrics rows just overwrite their figures
+#Sales, receipts and footfall live on the store-day row with currency = '' and method = ''
+ROLLUP_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_tx_insert AFTER INSERT ON transactions BEGIN
+        INSERT INTO daily_rollup (store_id, date, currency, method, income, expense)
+        VALUES (NEW.store_id, NEW.date, IFNULL(NEW.currency, ''), IFNULL(NEW.payment_method, ''),
+                CASE WHEN NEW.type = 'Income' THEN NEW.amount ELSE 0 END,
+                CASE WHEN NEW.type = 'Income' THEN 0 ELSE NEW.amount END)
+        ON CONFLICT (store_id, date, currency, method) DO UPDATE
+        SET income = income + excluded.income, expense = expense + excluded.expense;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_tx_delete AFTER DELETE ON transactions BEGIN
+        UPDATE daily_rollup
+        SET income = income - CASE WHEN OLD.type = 'Income' THEN OLD.amount ELSE 0 END,
+            expense = expense - CASE WHEN OLD.type = 'Income' THEN 0 ELSE OLD.amount END
+        WHERE store_id = OLD.store_id AND date = OLD.date
+        AND currency = IFNULL(OLD.currency, '') AND method = IFNULL(OLD.payment_method, '');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_tx_update AFTER UPDATE OF store_id, date, type, amount, currency, payment_method ON transactions BEGIN
+        UPDATE daily_rollup
+        SET income = income - CASE WHEN OLD.type = 'Income' THEN OLD.amount ELSE 0 END,
+            expense = expense - CASE WHEN OLD.type = 'Income' THEN 0 ELSE OLD.amount END
+        WHERE store_id = OLD.store_id AND date = OLD.date
+        AND currency = IFNULL(OLD.currency, '') AND method = IFNULL(OLD.payment_method, '');
+
+        INSERT INTO daily_rollup (store_id, date, currency, method, income, expense)
+        VALUES (NEW.store_id, NEW.date, IFNULL(NEW.currency, ''), IFNULL(NEW.payment_method, ''),
+                CASE WHEN NEW.type = 'Income' THEN NEW.amount ELSE 0 END,
+                CASE WHEN NEW.type = 'Income' THEN 0 ELSE NEW.amount END)
+        ON CONFLICT (store_id, date, currency, method) DO UPDATE
+        SET income = income + excluded.income, expense = expense + excluded.expense;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_sales_insert AFTER INSERT ON daily_sales BEGIN
+        INSERT INTO daily_rollup (store_id, date, currency, method, sales)
+        VALUES (NEW.store_id, NEW.date, '', '', NEW.amount)
+        ON CONFLICT (store_id, date, currency, method) DO UPDATE SET sales = excluded.sales;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_sales_update AFTER UPDATE ON daily_sales BEGIN
+        UPDATE daily_rollup SET sales = 0
+        WHERE store_id = OLD.store_id AND date = OLD.date AND currency = '' AND method = '';
+
+        INSERT INTO daily_rollup (store_id, date, currency, method, sales)
+        VALUES (NEW.store_id, NEW.date, '', '', NEW.amount)
+        ON CONFLICT (store_id, date, currency, method) DO UPDATE SET sales = excluded.sales;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_sales_delete AFTER DELETE ON daily_sales BEGIN
+        UPDATE daily_rollup SET sales = 0
+        WHERE store_id = OLD.store_id AND date = OLD.date AND currency = '' AND method = '';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_metrics_insert AFTER INSERT ON daily_metrics BEGIN
+        INSERT INTO daily_rollup (store_id, date, currency, method, receipts, footfall)
+        VALUES (NEW.store_id, NEW.date, '', '', NEW.receipts, NEW.footfall)
+        ON CONFLICT (store_id, date, currency, method) DO UPDATE
+        SET receipts = excluded.receipts, footfall = excluded.footfall;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_metrics_update AFTER UPDATE ON daily_metrics BEGIN
+        UPDATE daily_rollup SET receipts = 0, footfall = 0
+        WHERE store_id = OLD.store_id AND date = OLD.date AND currency = '' AND method = '';
+
+        INSERT INTO daily_rollup (store_id, date, currency, method, receipts, footfall)
+        VALUES (NEW.store_id, NEW.date, '', '', NEW.receipts, NEW.footfall)
+        ON CONFLICT (store_id, date, currency, method) DO UPDATE
+        SET receipts = excluded.receipts, footfall = excluded.footfall;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_metrics_delete AFTER DELETE ON daily_metrics BEGIN
+        UPDATE daily_rollup SET receipts = 0, footfall = 0
+        WHERE store_id = OLD.store_id AND date = OLD.date AND currency = '' AND method = '';
+    END;
+"""
+
+#Anything but an append to transactions bumps this counter, readers that only follow new ids
+#(the columnar mirror) start over when it moves
+REWRITE_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trg_rewrite_tx_update AFTER UPDATE ON transactions BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('transactions_rewrite', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_rewrite_tx_delete AFTER DELETE ON transactions BEGIN
+        INSERT INTO data_versions (name, version) VALUES ('transactions_rewrite', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1;
+    END;
+"""
+
+
+#Tables recorded in the change journal: (key columns, every column)
+#Row images are json arrays in this column order (new columns only ever go at the end, older images are shorter)
+JOURNAL_TABLES = {
+    "transactions": (["id"], ["id", "store_id", "parent_id", "date", "type", "category", "amount", "currency", "payment_method",
+                              "description", "leg_role", "leg_rate", "row_version"]),
+    "daily_sales": (["store_id", "date"], ["store_id", "date", "amount"]),
+    "daily_metrics": (["store_id", "date"], ["store_id", "date", "receipts", "footfall"]),
+}
+
+#Undo only looks at this many batches back
+UNDO_DEPTH = 50
+JOURNAL_PAGE = 1000
+
+
+def journal_image(table, prefix=""):
+    return "json_array(" + ", ".join(prefix + column for column in JOURNAL_TABLES[table][1]) + ")"
+
+
+#json array of a journal image -> {column: value}
+def image_row(table, image):
+    if image is None:
+        return None
+    values = json.loads(image)
+    return dict(zip(JOURNAL_TABLES[table][1], values + [None] * (len(JOURNAL_TABLES[table][1]) - len(values))))
+
+
+def same_image(a, b):
+    if a is None or b is None:
+        return a is b
+    return {k: v for k, v in a.items() if k != "row_version"} == {k: v for k, v in b.items() if k != "row_version"}
+
+
+#TEMP triggers: they only exist on the DatabaseManager connections and only record while write() has a batch open
+#in temp.journal_context, so bulk loaders, migrations and the archiving are left out of the journal
+def journal_triggers():
+    script = "CREATE TEMP TABLE IF NOT EXISTS journal_context (batch_id INTEGER);\n"
+    for table in JOURNAL_TABLES:
+        for event, op, old, new in [("INSERT", "I", "NULL", journal_image(table, "NEW.")),
+                                    ("UPDATE", "U", journal_image(table, "OLD."), journal_image(table, "NEW.")),
+                                    ("DELETE", "D", journal_image(table, "OLD."), "NULL")]:
+            script += f"""
+                CREATE TEMP TRIGGER IF NOT EXISTS trg_journal_{table}_{event.lower()} AFTER {event} ON main.{table}
+                WHEN EXISTS (SELECT 1 FROM temp.journal_context) BEGIN
+                    INSERT INTO journal (batch_id, tbl, op, old, new)
+                    SELECT batch_id, '{table}', '{op}', {old}, {new} FROM temp.journal_context;
+                END;
+            """
+    return script
+
+
+#Copies `table` into a new one with date INTEGER (text dates converted), then puts its indexes and triggers back
+#Runs inside the caller's transaction, a text date that doesn't parse becomes NULL
+def rebuild_with_days(conn, table):
+    create_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    extras = [row[0] for row in conn.execute("SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql IS NOT NULL",
+                                             (table,))]
+    columns = [row[0] for row in conn.execute(f"SELECT name FROM pragma_table_info('{table}')")]
+    values = ["CASE WHEN typeof(date) = 'text' THEN CAST(julianday(date) - 2440587.5 AS INTEGER) ELSE date END" if column == "date" else column
+              for column in columns]
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone() if "AUTOINCREMENT" in create_sql.upper() else None
+
+    new_sql = re.sub(r"\bdate\s+TEXT\b", "date INTEGER", create_sql, count=1, flags=re.IGNORECASE)
+    new_sql = re.sub(rf"\b{table}\b", f"{table}_days", new_sql, count=1)
+    conn.execute(new_sql)
+    conn.execute(f"INSERT INTO {table}_days ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_days RENAME TO {table}")
+
+    #AUTOINCREMENT keeps counting from where it was (ids of deleted rows are never handed out again)
+    if sequence:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table))
+    for sql in extras:
+        conn.execute(sql)
+
+
+#This class is for everything database related
+class DatabaseManager:
+    #This will create the db file (and sqlite3 setups)
+    #check_same_thread=False is for callers that hand the manager between threads themselves (one thread at a time)
+    def __init__(self, db_name="store.db", slow_ms=SLOW_QUERY_MS, journal_mode=JOURNAL_MODE, busy_timeout_ms=BUSY_TIMEOUT_MS, check_same_thread=True):
+        self.conn = sqlite3.connect(db_name, timeout=busy_timeout_ms / 1000, check_same_thread=check_same_thread)
+        self.db_dir = os.path.dirname(os.path.abspath(db_name))
+        self.attached = []
+        if journal_mode:
+            self.conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        #SQLite only enforces the REFERENCES clauses (daily_metrics -> stores) when asked to, per connection
+        self.conn.execute("PRAGMA foreign_keys = ON")
+
+        #Every statement goes through this cursor so it gets timed (see querystats.py)
+        self.stats = QueryStats(slow_ms)
+        self.c = InstrumentedCursor(self.conn, self.stats)
+
+        self.create_tables()
+
+        self.run_migrations()
+
+        #Recording of the change journal on this connection (see journal_triggers)
+        self.workstation = platform.node()
+        self.conn.executescript(journal_triggers())
+
+    #Migration for 1.2 update (Add description columns without destrying the already in use db)
+    def run_migrations(self):
+        try:
+            self.c.execute("ALTER TABLE transactions ADD COLUMN description TEXT")
+            self.conn.commit()
+            print("Database upgraded: Added description column.")
+        except sqlite3.OperationalError:
+            pass
+
+        #Migration for the recalculation engine (role + rate of every derived leg)
+        #The columns and their backfill commit together, a failed backfill is an error and is tried again on the next start
+        self.c.execute("SELECT count(*) FROM pragma_table_info('transactions') WHERE name = 'leg_role'")
+        if self.c.fetchone()[0] == 0:
+            with self.write(journal=False):
+                self.c.execute("ALTER TABLE transactions ADD COLUMN leg_role TEXT")
+                self.c.execute("ALTER TABLE transactions ADD COLUMN leg_rate REAL")
+                legs = self.backfill_leg_roles()
+            print("Database upgraded: Added leg_role and leg_rate columns.")
+            print(f"Database upgraded: Recorded role and rate on {legs} derived legs.")
+
+        #Migration for multi workstation edits (optimistic check: an edit only applies to the version it was read at)
+        try:
+            self.c.execute("ALTER TABLE transactions ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0")
+            self.conn.commit()
+            print("Database upgraded: Added row_version column.")
+        except sqlite3.OperationalError:
+            pass
+
+        #Migration for the analytics cache (a counter per table, bumped by every write path)
+        #The epoch row is random per database file so a cache can't be reused against another file
+        self.c.execute("CREATE TABLE IF NOT EXISTS data_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+        self.c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('epoch', ?)", (random.getrandbits(48),))
+        self.conn.commit()
+
+        #Migration for the columnar mirror (updates and deletes are counted by triggers, whoever runs them)
+        self.c.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_rewrite_tx_update'")
+        if self.c.fetchone()[0] == 0:
+            self.conn.executescript(REWRITE_TRIGGERS)
+            print("Database upgraded: Added rewrite triggers.")
+
+        #Migration for the ledger sorting (date is already covered by idx_store_date)
+        self.c.execute("SELECT count(*) FROM sqlite_master WHERE type = 'index' AND name = 'idx_store_amount'")
+        if self.c.fetchone()[0] == 0:
+            self.c.execute("CREATE INDEX IF NOT EXISTS idx_store_amount ON transactions(store_id, amount)")
+            self.c.execute("CREATE INDEX IF NOT EXISTS idx_store_category ON transactions(store_id, category)")
+            self.c.execute("CREATE INDEX IF NOT EXISTS idx_store_currency ON transactions(store_id, currency)")
+            self.c.execute("CREATE INDEX IF NOT EXISTS idx_store_method ON transactions(store_id, payment_method)")
+            self.conn.commit()
+            print("Database upgraded: Added sort indexes.")
+
+        #Migration for the year archives (one row per closed year)
+        self.c.execute("""CREATE TABLE IF NOT EXISTS archives (
+                       year INTEGER PRIMARY KEY,
+                       path TEXT NOT NULL,
+                       rows INTEGER NOT NULL,
+                       archived_at TEXT NOT NULL)""")
+        self.conn.commit()
+
+        #Migration for the rate history (the rate in settings becomes the opening rate)
+        self.c.execute("CREATE TABLE IF NOT EXISTS exchange_rates (date TEXT PRIMARY KEY, rate REAL NOT NULL)")
+        self.c.execute("SELECT count(*) FROM exchange_rates")
+        if self.c.fetchone()[0] == 0:
+            self.c.execute("INSERT INTO exchange_rates (date, rate) SELECT ?, value FROM settings WHERE key = 'exchange_rate'", (OPENING_RATE_DATE,))
+            self.conn.commit()
+            print("Database upgraded: Added exchange_rates history.")
+
+        #Migration for the metrics on store_id (they were keyed on the branch name, unlike sales and transactions)
+        #Runs before the rollup and day number migrations, both read daily_metrics.store_id
+        self.c.execute("SELECT count(*) FROM pragma_table_info('daily_metrics') WHERE name = 'branch'")
+        if self.c.fetchone()[0]:
+            self.migrate_metrics_store_id()
+
+        #Migration for the daily rollup (store/day/currency/method totals kept up to date by triggers)
+        #The rollup_built setting is committed with the fill, a build that failed is done again on the next start
+        self.c.execute("SELECT count(*) FROM settings WHERE key = 'rollup_built'")
+        if self.c.fetchone()[0] == 0:
+            self.create_rollup()
+            with self.write(journal=False):
+                self.rebuild_rollup()
+                self.c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('rollup_built', 1)")
+            print("Database upgraded: Built daily_rollup.")
+
+        #Migration for the day number dates (text dates are rewritten, the archives too)
+        self.c.execute("SELECT type FROM pragma_table_info('transactions') WHERE name = 'date'")
+        if self.c.fetchone()[0].upper() != "INTEGER":
+            self.migrate_day_numbers()
+
+        #Migration for the covering index: ledger totals and category totals over a date range never read the table
+        self.c.execute("SELECT count(*) FROM sqlite_master WHERE type = 'index' AND name = 'idx_store_day_cover'")
+        if self.c.fetchone()[0] == 0:
+            self.c.execute("""CREATE INDEX IF NOT EXISTS idx_store_day_cover
+                           ON transactions(store_id, date, type, currency, payment_method, amount, category)""")
+            self.conn.commit()
+            print("Database upgraded: Added covering index.")
+
+        #Migration for the change journal: one batch per write(), every row it touched with its before/after image
+        #journal is append only (undo and redo add batches of their own), only the batch state moves
+        self.c.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'journal'")
+        if self.c.fetchone()[0] == 0:
+            self.c.execute("""CREATE TABLE IF NOT EXISTS journal_batches (
+                           id INTEGER PRIMARY KEY,
+                           label TEXT,
+                           kind TEXT NOT NULL DEFAULT 'write',
+                           target INTEGER,
+                           state TEXT NOT NULL DEFAULT 'done',
+                           workstation TEXT,
+                           created_at TEXT NOT NULL)""")
+            self.c.execute("""CREATE TABLE IF NOT EXISTS journal (
+                           id INTEGER PRIMARY KEY,
+                           batch_id INTEGER NOT NULL,
+                           tbl TEXT NOT NULL,
+                           op TEXT NOT NULL,
+                           old TEXT,
+                           new TEXT)""")
+            self.c.execute("CREATE INDEX IF NOT EXISTS idx_journal_batch ON journal(batch_id)")
+            self.conn.commit()
+            print("Database upgraded: Added change journal.")
+
+        #Migration for the site sync (sync.py): how far each site was merged, and its transaction ids in this database
+        self.c.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'sync_sites'")
+        if self.c.fetchone()[0] == 0:
+            self.c.execute("""CREATE TABLE IF NOT EXISTS sync_sites (
+                           site_id INTEGER PRIMARY KEY,
+                           name TEXT,
+                           last_seq INTEGER NOT NULL DEFAULT 0,
+                           synced_at TEXT)""")
+            self.c.execute("""CREATE TABLE IF NOT EXISTS sync_ids (
+                           site_id INTEGER,
+                           source_id INTEGER,
+                           local_id INTEGER,
+                           PRIMARY KEY (site_id, source_id)) WITHOUT ROWID""")
+            self.conn.commit()
+            print("Database upgraded: Added sync tables.")
+
+    #Text dates -> day numbers in every table that has one. The column type has to change too (TEXT affinity
+    #would store the numbers as text again), so each table is rebuilt and gets its indexes and triggers back
+    def migrate_day_numbers(self):
+        started = time.perf_counter()
+        self.conn.execute("PRAGMA legacy_alter_table = ON")
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table in ["transactions", "daily_sales", "daily_metrics", "daily_rollup"]:
+                    rebuild_with_days(self.conn, table)
+                self.bump_version("transactions", "daily_sales", "daily_metrics")
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        finally:
+            self.conn.execute("PRAGMA legacy_alter_table = OFF")
+
+        #Archive files are never written otherwise, this is their only change
+        for year, path in self.get_archived_years():
+            archive = sqlite3.connect(self.archive_path(path))
+            try:
+                archive.execute("BEGIN IMMEDIATE")
+                rebuild_with_days(archive, "transactions")
+                archive.commit()
+            finally:
+                archive.close()
+
+        print(f"Database upgraded: Dates stored as day numbers ({(time.perf_counter() - started):.1f}s).")
+
+    #Rebuilds daily_metrics on store_id with a foreign key to stores. Rows whose branch is not a store
+    #(they never reached the rollup either) are kept aside in daily_metrics_unmatched instead of being lost
+    def migrate_metrics_store_id(self):
+        with self.write(journal=False):
+            self.c.execute("SELECT count(*) FROM daily_metrics WHERE branch NOT IN (SELECT name FROM stores)")
+            unmatched = self.c.fetchone()[0]
+            if unmatched:
+                self.c.execute("CREATE TABLE IF NOT EXISTS daily_metrics_unmatched AS SELECT * FROM daily_metrics WHERE false")
+                self.c.execute("INSERT INTO daily_metrics_unmatched SELECT * FROM daily_metrics WHERE branch NOT IN (SELECT name FROM stores)")
+
+            self.c.execute("""CREATE TABLE daily_metrics_ids (
+                           store_id INTEGER NOT NULL REFERENCES stores(id),
+                           date INTEGER,
+                           receipts INTEGER,
+                           footfall INTEGER,
+                           PRIMARY KEY (store_id, date))""")
+            #Same store as the old rollup triggers picked for a duplicated name (the lowest id)
+            self.c.execute("""
+                INSERT INTO daily_metrics_ids (store_id, date, receipts, footfall)
+                SELECT (SELECT MIN(id) FROM stores WHERE name = dm.branch), dm.date, dm.receipts, dm.footfall
+                FROM daily_metrics dm WHERE dm.branch IN (SELECT name FROM stores)
+            """)
+            #Its rollup triggers go with the old table
+            self.c.execute("DROP TABLE daily_metrics")
+            self.c.execute("ALTER TABLE daily_metrics_ids RENAME TO daily_metrics")
+            self.bump_version("daily_metrics")
+
+        #The triggers on store_id (executescript commits first, so this runs after the rebuild is in)
+        #Before the rollup exists they are added by create_rollup instead
+        self.c.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'daily_rollup'")
+        if self.c.fetchone()[0]:
+            self.conn.executescript(ROLLUP_TRIGGERS)
+        print("Database upgraded: Metrics keyed on store_id.")
+        if unmatched:
+            print(f"  {unmatched} rows of unknown branches kept in daily_metrics_unmatched")
+
+    #Short write transaction: the write lock is taken up front (BEGIN IMMEDIATE) so two writers never deadlock
+    #on a lock upgrade, busy waits are handled by the timeout and a few retries, and errors roll everything back
+    #Nested calls join the transaction already open
+    #Everything it writes is one journal batch (one undo step), named by the outermost label
+    @contextmanager
+    def write(self, label=None, journal=True):
+        if self.conn.in_transaction:
+            yield self.c
+            return
+
+        self.retry_locked(lambda: self.c.execute("BEGIN IMMEDIATE"))
+        try:
+            batch_id = self.open_batch(label) if journal else None
+            yield self.c
+            if batch_id:
+                self.close_batch(batch_id)
+            self.retry_locked(self.conn.commit)
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def open_batch(self, label, kind="write", target=None):
+        self.c.execute("INSERT INTO journal_batches (label, kind, target, workstation, created_at) VALUES (?,?,?,?,?)",
+                       (label, kind, target, self.workstation, datetime.now().isoformat(timespec="seconds")))
+        batch_id = self.c.lastrowid
+        self.c.execute("INSERT INTO temp.journal_context (batch_id) VALUES (?)", (batch_id,))
+        return batch_id
+
+    #Batches that wrote nothing (settings, rollup rebuilds...) are dropped, a new change ends the redo chain
+    def close_batch(self, batch_id, ends_redo=True):
+        self.c.execute("DELETE FROM temp.journal_context")
+        self.c.execute("SELECT EXISTS (SELECT 1 FROM journal WHERE batch_id = ?)", (batch_id,))
+        if not self.c.fetchone()[0]:
+            self.c.execute("DELETE FROM journal_batches WHERE id = ?", (batch_id,))
+        elif ends_redo:
+            self.c.execute("UPDATE journal_batches SET state = 'dropped' WHERE state = 'undone' AND workstation = ?", (self.workstation,))
+
+    #Last batch of this workstation that can be undone / redone: (id, label) or None
+    def undo_candidate(self):
+        self.c.execute("""
+            SELECT id, label FROM journal_batches
+            WHERE kind = 'write' AND state = 'done' AND workstation = ?
+            AND id >= IFNULL((SELECT MIN(id) FROM (SELECT id FROM journal_batches WHERE kind = 'write' AND workstation = ?
+                                                   ORDER BY id DESC LIMIT ?)), 0)
+            ORDER BY id DESC LIMIT 1
+        """, (self.workstation, self.workstation, UNDO_DEPTH))
+        return self.c.fetchone()
+
+    #Undone batches go back in the order they were written (the oldest undone one first)
+    def redo_candidate(self):
+        self.c.execute("""
+            SELECT id, label FROM journal_batches
+            WHERE kind = 'write' AND state = 'undone' AND workstation = ?
+            ORDER BY id LIMIT 1
+        """, (self.workstation,))
+        return self.c.fetchone()
+
+    #(label of the next undo, label of the next redo), None when there is nothing to undo/redo
+    def get_undo_labels(self):
+        undo, redo = self.undo_candidate(), self.redo_candidate()
+        return (undo[1] or "Last change") if undo else None, (redo[1] or "Last change") if redo else None
+
+    #Reverts the last batch of this workstation (a posting with its legs, an edit, a delete...) in one transaction
+    #Returns its label, None when there is nothing to undo. Refused (StaleRecordError) if one of its rows changed since
+    def undo(self):
+        return self.replay_batch(undo=True)
+
+    def redo(self):
+        return self.replay_batch(undo=False)
+
+    def replay_batch(self, undo):
+        with self.write(journal=False):
+            candidate = self.undo_candidate() if undo else self.redo_candidate()
+            if candidate is None:
+                return None
+            batch_id, label = candidate
+
+            self.c.execute(f"SELECT tbl, old, new FROM journal WHERE batch_id = ? ORDER BY id {'DESC' if undo else ''}", (batch_id,))
+            changes = [(table, image_row(table, old), image_row(table, new)) for table, old, new in self.c.fetchall()]
+            self.check_open(*{from_day(row["date"]) for _, old, new in changes for row in (old, new) if row and row["date"] is not None})
+
+            replay_id = self.open_batch(f"{'Undo' if undo else 'Redo'}: {label or 'Last change'}", "undo" if undo else "redo", batch_id)
+            for table, old, new in changes:
+                if undo:
+                    self.apply_image(table, new, old)
+                else:
+                    self.apply_image(table, old, new)
+            self.close_batch(replay_id, ends_redo=False)
+
+            self.c.execute("UPDATE journal_batches SET state = ? WHERE id = ?", ("undone" if undo else "done", batch_id))
+            self.bump_version(*{table for table, _, _ in changes})
+        return label or "Last change"
+
+    #Moves one row from the `expected` image to the `wanted` one (None = no row)
+    #row_version is not compared, an undo or redo counts as one more edit of the row
+    def apply_image(self, table, expected, wanted):
+        keys, columns = JOURNAL_TABLES[table]
+        key_values = [(expected or wanted)[key] for key in keys]
+        where = " AND ".join(f"{key} = ?" for key in keys)
+
+        self.c.execute(f"SELECT {journal_image(table)} FROM {table} WHERE {where}", key_values)
+        found = self.c.fetchone()
+        current = image_row(table, found[0]) if found else None
+        if not same_image(current, expected):
+            raise StaleRecordError(f"{table} row {', '.join(map(str, key_values))} was changed since, nothing was undone or redone")
+
+        if wanted is None:
+            self.c.execute(f"DELETE FROM {table} WHERE {where}", key_values)
+            return
+
+        if "row_version" in wanted:
+            wanted = dict(wanted, row_version=(current or wanted)["row_version"] + 1)
+        if current is None:
+            self.c.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                           [wanted[column] for column in columns])
+        else:
+            changed = [column for column in columns if column not in keys]
+            self.c.execute(f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in changed)} WHERE {where}",
+                           [wanted[column] for column in changed] + key_values)
+
+    #Sites merged into (or exported from) this database: [(site_id, name, last change, synced at)], latest first
+    def get_sync_sites(self):
+        self.c.execute("SELECT site_id, name, last_seq, synced_at FROM sync_sites ORDER BY synced_at DESC")
+        return self.c.fetchall()
+
+    #Incremental readers (exports, sync...) keep the last journal id they handled and ask for what came after it
+    #Ids only grow in commit order, writers are serialized by BEGIN IMMEDIATE
+    #[(id, batch_id, table, op, old row, new row)], rows are {column: value} and None on the side that has no row
+    def read_journal(self, after_id=0, limit=JOURNAL_PAGE):
+        self.c.execute("SELECT id, batch_id, tbl, op, old, new FROM journal WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+        return [(row_id, batch_id, table, op, image_row(table, old), image_row(table, new))
+                for row_id, batch_id, table, op, old, new in self.c.fetchall()]
+
+    @staticmethod
+    def retry_locked(step):
+        for attempt in range(WRITE_RETRIES):
+            try:
+                return step()
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e) or attempt == WRITE_RETRIES - 1:
+                    raise
+                print(f"Database busy, retrying ({attempt + 1}/{WRITE_RETRIES - 1})")
+                time.sleep(0.05 * 2 ** attempt + random.random() * 0.05)
+
+    #Marks tables as changed, the caller commits (so the bump is part of the same transaction)
+    def bump_version(self, *tables):
+        self.c.executemany("""
+            INSERT INTO data_versions (name, version) VALUES (?, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1
+        """, [(table,) for table in tables])
+
+    #(epoch, version of each table) -> changes as soon as any of the tables is written
+    def get_data_versions(self, tables):
+        self.c.execute("SELECT name, version FROM data_versions WHERE name IN (SELECT value FROM json_each(?))",
+                       (json.dumps(["epoch", *tables]),))
+        versions = dict(self.c.fetchall())
+        return tuple(versions.get(name, 0) for name in ["epoch", *tables])
+
+    def create_rollup(self):
+        self.c.execute("""CREATE TABLE IF NOT EXISTS daily_rollup (
+                       store_id INTEGER,
+                       date INTEGER,
+                       currency TEXT,
+                       method TEXT,
+                       income REAL DEFAULT 0,
+                       expense REAL DEFAULT 0,
+                       sales REAL DEFAULT 0,
+                       receipts INTEGER DEFAULT 0,
+                       footfall INTEGER DEFAULT 0,
+                       PRIMARY KEY (store_id, date, currency, method))""")
+
+        self.conn.executescript(ROLLUP_TRIGGERS)
+
+    #Backfill: recompute the whole rollup from the raw tables (O(transactions), only needed once or after repairs)
+    def rebuild_rollup(self):
+        with self.write(journal=False):
+            self.fill_rollup()
+
+    def fill_rollup(self):
+        self.c.execute("DELETE FROM daily_rollup")
+
+        self.c.execute("""
+            INSERT INTO daily_rollup (store_id, date, currency, method, income, expense)
+            SELECT store_id, date, IFNULL(currency, ''), IFNULL(payment_method, ''),
+                   SUM(CASE WHEN type = 'Income' THEN amount ELSE 0 END),
+                   SUM(CASE WHEN type = 'Income' THEN 0 ELSE amount END)
+            FROM transactions
+            GROUP BY store_id, date, IFNULL(currency, ''), IFNULL(payment_method, '')
+        """)
+
+        self.c.execute("""
+            INSERT INTO daily_rollup (store_id, date, currency, method, sales)
+            SELECT store_id, date, '', '', amount FROM daily_sales WHERE true
+            ON CONFLICT (store_id, date, currency, method) DO UPDATE SET sales = excluded.sales
+        """)
+
+        self.c.execute("""
+            INSERT INTO daily_rollup (store_id, date, currency, method, receipts, footfall)
+            SELECT store_id, date, '', '', receipts, footfall FROM daily_metrics WHERE true
+            ON CONFLICT (store_id, date, currency, method) DO UPDATE
+            SET receipts = excluded.receipts, footfall = excluded.footfall
+        """)
+
+        self.bump_version("transactions", "daily_sales", "daily_metrics")
+
+    #Old postings only have the naming conventions, so we read the role and rate back from them once (the caller commits)
+    def backfill_leg_roles(self):
+        self.c.execute("""
+            SELECT t.id, t.type, t.category, s.name, p.type, p.category
+            FROM transactions t
+            JOIN stores s ON t.store_id = s.id
+            JOIN transactions p ON t.parent_id = p.id
+            WHERE t.leg_role IS NULL
+        """)
+        rows = self.c.fetchall()
+
+        if not rows:
+            return 0
+
+        accounts = {"Main Vault": "main", "TVA Account": "tva", "Bank Commission": "comm", "Freight": "freight"}
+        updates = []
+
+        for leg_id, leg_type, leg_cat, leg_store, parent_type, parent_cat in rows:
+            role = None
+            rate = None
+
+            if parent_type == "Income" and parent_cat == "Sales":
+                if leg_type == "Expense":
+                    for key, label in LEG_LABELS.items():
+                        if leg_cat.startswith(label):
+                            role = key
+                            found = re.search(r"\(([\d.]+)%\)", leg_cat)
+                            rate = float(found.group(1)) if found else None
+                            break
+                else:
+                    role = accounts.get(leg_store)
+
+            elif parent_type == "Expense" and parent_cat == "Cost of goods":
+                if leg_store == "Cost of goods":
+                    role, rate = "cogs", 100.0
+                else:
+                    role = "freight"
+
+            elif parent_type == "Expense" and parent_cat == "Main":
+                role, rate = "main_transfer", 100.0
+
+            elif leg_cat.startswith("Exchange"):
+                role = "exchange"
+
+            elif leg_cat.startswith("Bank Transfer"):
+                role = "transfer"
+
+            if role is None:
+                role = "unknown"
+
+            updates.append((role, rate, leg_id))
+
+        self.c.executemany("UPDATE transactions SET leg_role = ?, leg_rate = ? WHERE id = ?", updates)
+
+        #Mirror incomes take the rate of their expense sibling, and anything left uses today's settings
+        self.c.execute("""
+            UPDATE transactions
+            SET leg_rate = (SELECT s.leg_rate FROM transactions s
+                            WHERE s.parent_id = transactions.parent_id AND s.leg_role = transactions.leg_role
+                            AND s.type = 'Expense' AND s.leg_rate IS NOT NULL)
+            WHERE leg_rate IS NULL AND type = 'Income' AND leg_role IN ('main', 'tva', 'comm', 'freight')
+        """)
+
+        for role, key in LEG_RATE_KEYS.items():
+            self.c.execute("UPDATE transactions SET leg_rate = ? WHERE leg_rate IS NULL AND leg_role = ?", (self.get_rate(key), role))
+
+        return len(updates)
+
+    #This will create the required tables (stores and transactions if not created) and check if stores is empty to add the default stores
+    def create_tables(self):
+        self.c.execute("""
+            CREATE TABLE IF NOT EXISTS stores (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       name TEXT
+                       )
+        """)
+
+        self.c.execute("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       store_id INTEGER,
+                       parent_id INTEGER,
+                       date INTEGER,
+                       type TEXT,
+                       category TEXT,
+                       amount REAL,
+                       currency TEXT,
+                       payment_method TEXT
+                       )
+        """)
+
+        self.c.execute("""CREATE TABLE IF NOT EXISTS settings (
+                       key TEXT PRIMARY KEY,
+                       value REAL
+                       )
+        """)
+
+        self.c.execute("""CREATE TABLE IF NOT EXISTS daily_sales (
+                       date INTEGER,
+                       store_id INTEGER,
+                       amount REAL,
+                       PRIMARY KEY (store_id, date))""")
+        
+        self.c.execute("""CREATE TABLE IF NOT EXISTS daily_metrics (
+                       store_id INTEGER NOT NULL REFERENCES stores(id),
+                       date INTEGER,
+                       receipts INTEGER,
+                       footfall INTEGER,
+                       PRIMARY KEY (store_id, date))""")
+
+        self.c.execute("CREATE INDEX IF NOT EXISTS idx_store_date ON transactions(store_id, date)")
+        
+        self.c.execute("CREATE INDEX IF NOT EXISTS idx_parent ON transactions(parent_id)")
+
+        self.seed_data()
+        self.seed_settings()
+
+    def seed_settings(self):
+        default = {
+            "main_rate" : 15.0,
+            "tva_rate" : 7.0,
+            "comm_rate": 3.0,
+            "freight_rate": 33.0,
+            "exchange_rate": 89500.0,
+        }
+
+        for key, val in default.items():
+            self.c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?,?)", (key,val))
+        self.conn.commit()
+
+    def get_rate(self, key):
+        self.c.execute("SELECT value FROM settings WHERE key = ?", (key,))
+        res = self.c.fetchone()
+        return res[0] if res else 0.0
+
+    def update_rate(self, key, value):
+        with self.write():
+            self.c.execute("UPDATE settings SET value = ? WHERE key = ?", (value,key))
+            self.bump_version("settings")
+
+            #A new exchange rate applies from today on, past days keep the rate they had
+            if key == "exchange_rate" and self.get_rate_on(date.today().isoformat()) != value:
+                self.c.execute("""
+                    INSERT INTO exchange_rates (date, rate) VALUES (?, ?)
+                    ON CONFLICT (date) DO UPDATE SET rate = excluded.rate
+                """, (date.today().isoformat(), value))
+                self.bump_version("exchange_rates")
+
+    #Exchange rate in effect on t_date (yyyy-mm-dd)
+    def get_rate_on(self, t_date):
+        self.c.execute(f"SELECT {RATE_ON.format('?')}", (t_date,))
+        rate = self.c.fetchone()[0]
+        return rate if rate else self.get_rate("exchange_rate")
+
+    #{date: rate} for every day of the range, from the changes inside it and the rate in effect on start_date
+    def get_rates_range(self, start_date, end_date):
+        rate = self.get_rate_on(start_date)
+        self.c.execute("SELECT date, rate FROM exchange_rates WHERE date > ? AND date <= ? ORDER BY date", (start_date, end_date))
+        changes = dict(self.c.fetchall())
+
+        rates = {}
+        day = date.fromisoformat(start_date)
+        end = date.fromisoformat(end_date)
+        while day <= end:
+            key = day.isoformat()
+            rate = changes.get(key, rate)
+            rates[key] = rate
+            day = date.fromordinal(day.toordinal() + 1)
+        return rates
+
+    #This will check if the stores table is empty, if it is, it will add the default stores (he bas ta nzid l branches)
+    def seed_data(self):
+        default_branches = ["LeMall Dbayye", "City Center", "City Mall", "Koura Branch",
+                                "Main Vault", "TVA Account", "Bank Commission", "Cost of goods", "Freight"]
+        
+        for branch in default_branches:
+            self.c.execute("SELECT count(*) FROM stores WHERE name = ?", (branch,))
+            if self.c.fetchone()[0] == 0:
+                print(f"Adding missing branch: {branch}")
+                self.c.execute("INSERT INTO stores (name) VALUES (?)", (branch,))
+        self.conn.commit()
+
+
+    def get_store_names(self):
+        self.c.execute("SELECT name FROM stores")
+
+        names = []
+
+        for row in self.c.fetchall():
+            names.append(row[0])
+        return names
+    
+    def get_store_id(self, store_name):
+        self.c.execute("SELECT id FROM stores WHERE name = ?", (store_name,))
+        #Safety check
+        result = self.c.fetchone()
+        if not result:
+            print(f"Error Store '{store_name}' not found")
+            return
+        return result[0]
+    
+    def save_daily_sale(self, store_name, t_date, t_amount):
+    
+        store_id = self.get_store_id(store_name)
+        #In case of an error where there is no ID provided
+        if not store_id:
+            return
+
+        #Upsert to overwrite a sale, if its in the same day, same store (an update keeps the old amount in the journal)
+        with self.write(f"Target of {store_name} {t_date}"):
+            self.c.execute("""
+                INSERT INTO daily_sales (date, store_id, amount) VALUES (?,?,?)
+                ON CONFLICT (store_id, date) DO UPDATE SET amount = excluded.amount
+            """, (to_day(t_date), store_id, t_amount))
+            self.bump_version("daily_sales")
+
+    def get_daily_sale(self, store_name, t_date):
+        store_id = self.get_store_id(store_name)
+
+        self.c.execute("SELECT amount FROM daily_sales WHERE store_id = ? AND date = ?", (store_id, to_day(t_date)))
+        amount = self.c.fetchone()
+        if amount == None:
+            return 0
+        else :
+            return amount[0]
+        
+
+
+        
+    def add_transactions(self, store_name, t_date, t_type, category, amount, currency, p_method, parent_id=None, description=None, leg_role=None, leg_rate=None):
+        self.c.execute("SELECT id FROM stores WHERE name = ?", (store_name,))
+        result = self.c.fetchone()
+
+        if result:
+            store_id = result[0]
+            self.check_open(t_date)
+
+            with self.write(f"{t_type} {category} {store_name}"):
+                self.c.execute("INSERT INTO transactions (store_id, parent_id, date, type, category, amount, currency, payment_method, description, leg_role, leg_rate) VALUES (?,?,?,?,?,?,?,?,?,?,?)", (store_id, parent_id, to_day(t_date), t_type, category, amount, currency, p_method, description, leg_role, leg_rate))
+                row_id = self.c.lastrowid
+                self.bump_version("transactions")
+            return row_id
+        else:
+            print("Error, Store not found")
+
+    def get_posting_rates(self):
+        return {role: self.get_rate(key) for role, key in LEG_RATE_KEYS.items()}
+
+    #Parent + all its derived legs, written with a single commit
+    def post_transaction(self, store_name, t_date, t_type, category, amount, currency, p_method, description=None, apply_main=True, rates=None):
+        if rates is None:
+            rates = self.get_posting_rates()
+
+        store_id = self.get_store_id(store_name)
+        if not store_id:
+            return
+        self.check_open(t_date)
+        day = to_day(t_date)
+
+        #Everything is looked up before the write lock is taken
+        legs = derive_legs(store_name, t_type, category, amount, p_method, rates, apply_main)
+        store_ids = {name: self.get_store_id(name) for name in {leg[0] for leg in legs}}
+
+        with self.write(f"{t_type} {category} {store_name}"):
+            self.c.execute("INSERT INTO transactions (store_id, date, type, category, amount, currency, payment_method, description) VALUES (?,?,?,?,?,?,?,?)",
+                           (store_id, day, t_type, category, amount, currency, p_method, description))
+            parent_id = self.c.lastrowid
+
+            self.c.executemany("INSERT INTO transactions (store_id, parent_id, date, type, category, amount, currency, payment_method, leg_role, leg_rate) VALUES (?,?,?,?,?,?,?,?,?,?)",
+                               [(store_ids[leg_store], parent_id, day, leg_type, leg_cat, leg_amt, currency, p_method, role, rate)
+                                for leg_store, leg_type, leg_cat, leg_amt, role, rate in legs])
+
+            self.bump_version("transactions")
+        return parent_id
+
+    #Targets and metrics of many branch-days in one query: {(branch, date): (target, receipts, footfall)}
+    def get_daily_targets_range(self, branches, start_date, end_date):
+        self.c.execute("""
+            WITH picked AS (SELECT id FROM stores WHERE name IN (SELECT value FROM json_each(?))),
+            keys AS (
+                SELECT store_id, date FROM daily_sales WHERE store_id IN picked AND date BETWEEN ? AND ?
+                UNION
+                SELECT store_id, date FROM daily_metrics WHERE store_id IN picked AND date BETWEEN ? AND ?
+            )
+            SELECT s.name, date(k.date + 2440587.5), IFNULL(ds.amount, 0), dm.receipts, dm.footfall
+            FROM keys k
+            JOIN stores s ON s.id = k.store_id
+            LEFT JOIN daily_sales ds ON ds.store_id = k.store_id AND ds.date = k.date
+            LEFT JOIN daily_metrics dm ON dm.store_id = k.store_id AND dm.date = k.date
+        """, (json.dumps(branches), to_day(start_date), to_day(end_date), to_day(start_date), to_day(end_date)))
+
+        return {(branch, date): (amount, receipts, footfall) for branch, date, amount, receipts, footfall in self.c.fetchall()}
+
+    #Posts many reconciled branch-days at once: targets, metrics, sales and all their legs in one transaction
+    #First id of a block of explicit transaction ids, read like AUTOINCREMENT does (the highest id ever handed out,
+    #so ids of deleted rows are never handed out again). Call it inside the write transaction, SQLite moves
+    #sqlite_sequence by itself when the inserted ids go past it
+    def next_transaction_id(self):
+        self.c.execute("""
+            SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'transactions'), 0), IFNULL(MAX(id), 0)) + 1
+            FROM transactions
+        """)
+        return self.c.fetchone()[0]
+
+    #days: [{"branch", "date", "target", "receipts", "footfall", "amounts": [(currency, method, amount), ...]}]
+    #receipts / footfall None keeps what is already saved for that branch-day (re-posting the sales doesn't wipe them)
+    def post_daily_batch(self, days, apply_main=True, rates=None):
+        if rates is None:
+            rates = self.get_posting_rates()
+
+        self.c.execute("SELECT name, id FROM stores")
+        store_ids = dict(self.c.fetchall())
+        self.check_open(*[day["date"] for day in days])
+
+        with self.write(f"Daily batch ({len(days)} branch-days)"):
+            #Ids are handed out here so the legs can reference their parent in the same executemany
+            next_id = self.next_transaction_id()
+
+            rows = []
+            targets = []
+            metrics = []
+
+            for day in days:
+                branch, t_date = day["branch"], to_day(day["date"])
+                targets.append((t_date, store_ids[branch], day["target"]))
+                if day["receipts"] is not None or day["footfall"] is not None:
+                    metrics.append({"store_id": store_ids[branch], "date": t_date, "receipts": day["receipts"], "footfall": day["footfall"]})
+
+                for currency, method, amount in day["amounts"]:
+                    parent_id = next_id
+                    next_id += 1
+                    rows.append((parent_id, store_ids[branch], None, t_date, "Income", "Sales", amount, currency, method, None, None))
+
+                    for leg_store, leg_type, leg_cat, leg_amt, role, rate in derive_legs(branch, "Income", "Sales", amount, method, rates, apply_main):
+                        rows.append((next_id, store_ids[leg_store], parent_id, t_date, leg_type, leg_cat, leg_amt, currency, method, role, rate))
+                        next_id += 1
+
+            self.c.executemany("""
+                INSERT INTO transactions (id, store_id, parent_id, date, type, category, amount, currency, payment_method, leg_role, leg_rate)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?)
+            """, rows)
+            self.c.executemany("""
+                INSERT INTO daily_sales (date, store_id, amount) VALUES (?,?,?)
+                ON CONFLICT (store_id, date) DO UPDATE SET amount = excluded.amount
+            """, targets)
+            self.c.executemany("""
+                INSERT INTO daily_metrics (store_id, date, receipts, footfall) VALUES (:store_id, :date, IFNULL(:receipts, 0), IFNULL(:footfall, 0))
+                ON CONFLICT (store_id, date) DO UPDATE SET receipts = IFNULL(:receipts, receipts), footfall = IFNULL(:footfall, footfall)
+            """, metrics)
+
+            self.bump_version("transactions", "daily_sales", "daily_metrics")
+
+        return len(rows)
+
+    def get_transactions(self, store_name):
+        self.c.execute("""
+            SELECT t.id, date(t.date + 2440587.5), t.type, t.category, t.amount, t.currency, t.payment_method, IFNULL(t.description, '') FROM transactions t
+            JOIN stores s ON t.store_id = s.id
+            WHERE s.name = ?
+            ORDER BY t.date DESC
+        """, (store_name,))
+
+        return self.c.fetchall()
+    
+    #Same filters as the ledger view (type, category, currency, method, date range) as a WHERE clause on "t"
+    #The store is a constant subquery (not a join) so the (store_id, sort column) indexes also give the ORDER BY
+    def ledger_filter(self, store_name, f_type="All", f_cat="All", f_curr="All", f_paym="All", start_date="", end_date="", match_from=False):
+        where = "t.store_id = (SELECT MIN(id) FROM stores WHERE name = ?)"
+        params = [store_name]
+
+        if f_type != "All":
+            where += " AND t.type = ?"
+            params.append(f_type)
+
+        if start_date:
+            where += " AND t.date >= ?"
+            params.append(to_day(start_date))
+
+        if end_date:
+            where += " AND t.date <= ?"
+            params.append(to_day(end_date))
+
+        if f_curr != "All":
+            where += " AND t.currency = ?"
+            params.append(f_curr)
+
+        if f_paym != "All":
+            where += " AND t.payment_method = ?"
+            params.append(f_paym)
+
+        if f_cat != "All" and f_cat.strip() != "":
+            if f_cat == "Exchange In/Out":
+                where += " AND t.category IN ('Exchange In', 'Exchange Out')"
+            elif f_cat == "Bank Transfer In/Out":
+                where += " AND t.category IN ('Bank Transfer In', 'Bank Transfer Out')"
+            elif match_from:
+                where += " AND (instr(lower(t.category), lower(?)) > 0 OR t.category = ?)"
+                params += [f_cat, f"from {f_cat}"]
+            else:
+                where += " AND instr(lower(t.category), lower(?)) > 0"
+                params.append(f_cat)
+
+        return where, params
+
+    #One page of the ledger view sorted on a LEDGER_SORTS column (limit=None returns every row, for the exports)
+    def get_ledger_rows(self, store_name, f_type="All", f_cat="All", f_curr="All", f_paym="All", start_date="", end_date="", match_from=False,
+                        sort="date", descending=True, limit=None, offset=0):
+        where, params = self.ledger_filter(store_name, f_type, f_cat, f_curr, f_paym, start_date, end_date, match_from)
+        direction = "DESC" if descending else "ASC"
+
+        query = f"""
+            SELECT t.id, {DAY_TEXT.format('t.date')}, t.type, t.category, t.amount, t.currency, t.payment_method, IFNULL(t.description, '')
+            FROM {self.ledger_source(start_date, end_date)}
+            WHERE {where}
+            ORDER BY {LEDGER_SORTS[sort]} {direction}, t.id {direction}
+        """
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+
+        self.c.execute(query, params)
+        return self.c.fetchall()
+
+    #Totals of the ledger view: {(currency, method): (balance, balance in USD)}
+    #Without a category filter they come from the rollup, so they cost O(days) whatever the size of the ledger
+    #(except for ranges reaching into the archives, the rollup only knows the carry forward of closed years)
+    def get_ledger_totals(self, store_name, f_type="All", f_cat="All", f_curr="All", f_paym="All", start_date="", end_date="", match_from=False):
+        source = self.ledger_source(start_date, end_date)
+
+        if (f_cat == "All" or f_cat.strip() == "") and source == "transactions t":
+            where = "s.name = ? AND r.currency != ''"
+            params = [store_name]
+
+            for column, value in [("r.currency", f_curr), ("r.method", f_paym)]:
+                if value != "All":
+                    where += f" AND {column} = ?"
+                    params.append(value)
+            if start_date:
+                where += " AND r.date >= ?"
+                params.append(to_day(start_date))
+            if end_date:
+                where += " AND r.date <= ?"
+                params.append(to_day(end_date))
+
+            balance = {"Income": "r.income", "Expense": "-r.expense"}.get(f_type, "r.income - r.expense")
+
+            per_day = f"""
+                SELECT r.currency as currency, r.method as method, r.date as date, SUM({balance}) as total FROM daily_rollup r
+                JOIN stores s ON r.store_id = s.id
+                WHERE {where}
+                GROUP BY r.currency, r.method, r.date
+            """
+        else:
+            where, params = self.ledger_filter(store_name, f_type, f_cat, f_curr, f_paym, start_date, end_date, match_from)
+
+            per_day = f"""
+                SELECT t.currency as currency, t.payment_method as method, t.date as date,
+                       SUM(CASE WHEN t.type = 'Income' THEN t.amount ELSE -t.amount END) as total FROM {source}
+                WHERE {where}
+                GROUP BY t.date, t.currency, t.payment_method
+            """
+
+        #LBP days are converted at the rate of their own date
+        self.c.execute(f"""
+            SELECT currency, method, SUM(total),
+                   SUM(CASE WHEN currency = 'USD ($)' THEN total ELSE total / {RATE_ON.format(DAY_TEXT.format('d.date'))} END)
+            FROM ({per_day}) d
+            GROUP BY currency, method
+        """, params)
+
+        return {(currency, method): (total, total_usd) for currency, method, total, total_usd in self.c.fetchall()}
+
+    def get_transaction(self, trans_id):
+        self.c.execute(f"""
+            SELECT id, store_id, parent_id, {DAY_TEXT.format('date')}, type, category, amount, currency, payment_method,
+                   description, leg_role, leg_rate, row_version
+            FROM transactions WHERE id = ?
+        """, (trans_id,))
+        return self.c.fetchone()
+
+    def get_parent_id(self, trans_id):
+        self.c.execute("SELECT parent_id FROM transactions WHERE id = ?", (trans_id,))
+        result = self.c.fetchone()
+        return result[0] if result else None
+
+    #expected_version is the row_version read when the edit started, the update is refused if it moved since
+    #The legs follow the new date and amount in the same transaction
+    def update_transaction_full(self, record_id, new_date, new_cat, new_amt, new_desc, expected_version=None):
+        with self.write(f"Edit #{record_id}"):
+            self.c.execute("SELECT date FROM transactions WHERE id = ?", (record_id,))
+            old = self.c.fetchone()
+            self.check_open(new_date, from_day(old[0]) if old else "")
+            new_day = to_day(new_date)
+
+            self.c.execute("""
+                           UPDATE transactions
+                           SET date = ?, category = ?, amount = ?, description = ?, row_version = row_version + 1
+                           WHERE id = ? AND (? IS NULL OR row_version = ?)
+                           """, (new_day, new_cat, new_amt, new_desc, record_id, expected_version, expected_version))
+            if self.c.rowcount == 0:
+                raise StaleRecordError(f"Transaction {record_id} was changed or deleted by another workstation")
+
+            self.c.execute("UPDATE transactions SET date = ?, row_version = row_version + 1 WHERE parent_id = ?",(new_day, record_id))
+            self.recalc_derived_legs([record_id])
+
+            self.bump_version("transactions")
+
+    #Recompute every rated leg of the given parents from the parent amount in one UPDATE
+    def recalc_derived_legs(self, parent_ids):
+        with self.write("Recalculate legs"):
+            self.c.execute(f"""
+                UPDATE transactions {RECALC_LEGS_SET}
+                WHERE parent_id IN (SELECT value FROM json_each(?))
+                AND leg_rate IS NOT NULL
+            """, (json.dumps(list(parent_ids)),))
+
+            updated = self.c.rowcount
+            self.bump_version("transactions")
+        return updated
+
+    #Bulk re-derive: set new rates on every leg of the chosen roles in the date range, then recompute them
+    def rederive_legs(self, start_date, end_date, rates):
+        rates = {role: rate for role, rate in rates.items() if role in LEG_RATE_KEYS}
+        if not rates:
+            return 0
+
+        roles = json.dumps(list(rates))
+        case_sql = " ".join("WHEN ? THEN ?" for _ in rates)
+        case_params = [value for pair in rates.items() for value in pair]
+
+        with self.write(f"Re-derive legs {start_date} to {end_date}"):
+            self.c.execute(f"""
+                UPDATE transactions
+                SET leg_rate = CASE leg_role {case_sql} ELSE leg_rate END
+                WHERE leg_role IN (SELECT value FROM json_each(?))
+                AND date BETWEEN ? AND ?
+            """, (*case_params, roles, to_day(start_date), to_day(end_date)))
+
+            self.c.execute(f"""
+                UPDATE transactions {RECALC_LEGS_SET}
+                WHERE leg_role IN (SELECT value FROM json_each(?))
+                AND date BETWEEN ? AND ?
+                AND parent_id IS NOT NULL
+            """, (roles, to_day(start_date), to_day(end_date)))
+
+            updated = self.c.rowcount
+            self.bump_version("transactions")
+        return updated
+
+    def delete_transaction(self, trans_id):
+        with self.write(f"Delete #{trans_id}"):
+            self.c.execute("DELETE FROM transactions WHERE id = ?", (trans_id,))
+            self.bump_version("transactions")
+
+    #Same optimistic check as update_transaction_full, and a record someone else already deleted is reported
+    def delete_smart_chain(self, record_id, expected_version=None):
+        with self.write(f"Delete #{record_id}"):
+            self.c.execute("SELECT date FROM transactions WHERE id = ?", (record_id,))
+            old = self.c.fetchone()
+            self.check_open(from_day(old[0]) if old else "")
+
+            self.c.execute("DELETE FROM transactions WHERE id = ? AND (? IS NULL OR row_version = ?)",(record_id, expected_version, expected_version))
+            if self.c.rowcount == 0:
+                raise StaleRecordError(f"Transaction {record_id} was changed or deleted by another workstation")
+
+            self.c.execute("DELETE FROM transactions WHERE parent_id = ?", (record_id,))
+
+            self.bump_version("transactions")
+
+
+    #Read from the rollup: O(store-days) instead of O(transactions)
+    def get_balance_summary(self):
+        query = """
+            SELECT s.name, r.currency, r.method, SUM(r.income - r.expense) as balance
+            FROM daily_rollup r
+            JOIN stores s ON r.store_id = s.id
+            WHERE r.currency != ''
+            GROUP BY s.name, r.currency, r.method
+        """
+        self.c.execute(query)
+        return self.c.fetchall()
+
+    #Figures of the given branches (summed over branches) from the rollup: [(period start, sales, receipts, footfall, sales in USD)]
+    #granularity is a GRANULARITY_PERIODS key, the bucketing is done by SQL so a year is 12 rows instead of 365
+    #Sales are converted to USD at the rate of their own day
+    def get_daily_rollup(self, branches, start_date, end_date, granularity="day"):
+        period = GRANULARITY_PERIODS[granularity]
+        self.c.execute(f"""
+            SELECT {period} as period, SUM(r.sales), SUM(r.receipts), SUM(r.footfall), SUM(r.sales / {RATE_ON.format(DAY_TEXT.format('r.date'))})
+            FROM daily_rollup r
+            JOIN stores s ON r.store_id = s.id
+            WHERE s.name IN (SELECT value FROM json_each(?))
+            AND r.date BETWEEN ? AND ?
+            AND r.currency = '' AND r.method = ''
+            GROUP BY period
+            ORDER BY period
+        """, (json.dumps(branches), to_day(start_date), to_day(end_date)))
+        return self.c.fetchall()
+
+    #Same figures split per branch in one grouped pass: [(branch, period start, sales, receipts, footfall, sales in USD)]
+    def get_branch_rollup(self, branches, start_date, end_date, granularity="day"):
+        period = GRANULARITY_PERIODS[granularity]
+        self.c.execute(f"""
+            SELECT s.name, {period} as period, SUM(r.sales), SUM(r.receipts), SUM(r.footfall), SUM(r.sales / {RATE_ON.format(DAY_TEXT.format('r.date'))})
+            FROM daily_rollup r
+            JOIN stores s ON r.store_id = s.id
+            WHERE s.name IN (SELECT value FROM json_each(?))
+            AND r.date BETWEEN ? AND ?
+            AND r.currency = '' AND r.method = ''
+            GROUP BY s.name, period
+            ORDER BY s.name, period
+        """, (json.dumps(branches), to_day(start_date), to_day(end_date)))
+        return self.c.fetchall()
+
+    #USD total of every category of one type over the branches, LBP at the rate of its own day: [(category, total in USD)]
+    #(SQL side of analytics.category_breakdown, the columnar mirror answers the same from its arrays)
+    def get_category_totals(self, branches, start_date, end_date, t_type="Expense"):
+        self.c.execute(f"""
+            SELECT category, SUM(CASE WHEN currency = 'USD ($)' THEN total ELSE total / {RATE_ON.format(DAY_TEXT.format('d.date'))} END) as total_usd
+            FROM (
+                SELECT t.category as category, t.currency as currency, t.date as date, SUM(t.amount) as total FROM transactions t
+                WHERE t.store_id IN (SELECT id FROM stores WHERE name IN (SELECT value FROM json_each(?)))
+                AND t.date BETWEEN ? AND ? AND t.type = ?
+                GROUP BY t.category, t.currency, t.date
+            ) d
+            GROUP BY category
+            ORDER BY total_usd DESC
+        """, (json.dumps(branches), to_day(start_date), to_day(end_date), t_type))
+        return self.c.fetchall()
+
+    #Returns None when the branch is not a store (nothing is saved)
+    def save_daily_metrics(self, branch, date, receipts, footfall):
+        store_id = self.get_store_id(branch)
+        if not store_id:
+            return
+
+        with self.write(f"Metrics of {branch} {date}"):
+            self.c.execute("""
+                INSERT INTO daily_metrics (store_id, date, receipts, footfall) VALUES (?,?,?,?)
+                ON CONFLICT (store_id, date) DO UPDATE SET receipts = excluded.receipts, footfall = excluded.footfall
+            """, (store_id, to_day(date), receipts, footfall))
+            self.bump_version("daily_metrics")
+        return store_id
+
+    def get_daily_metrics(self, branch, date):
+        self.c.execute('''
+            SELECT receipts, footfall FROM daily_metrics 
+            WHERE store_id = (SELECT id FROM stores WHERE name = ?) AND date = ?
+        ''', (branch, to_day(date)))
+
+        result = self.c.fetchone()
+
+        if result:
+            return result[0], result[1]
+        return "", ""
+
+    # ==========================================
+    # Year archives
+    # ==========================================
+    def get_archived_years(self):
+        self.c.execute("SELECT year, path FROM archives ORDER BY year")
+        return self.c.fetchall()
+
+    #Last archived day ("" when nothing is archived), nothing on or before it can be written anymore
+    def closed_through(self):
+        self.c.execute("SELECT MAX(year) FROM archives")
+        year = self.c.fetchone()[0]
+        return f"{year}-12-31" if year else ""
+
+    def check_open(self, *dates):
+        closed = self.closed_through()
+        for t_date in dates:
+            if closed and t_date and t_date <= closed:
+                raise ClosedPeriodError(f"{t_date[:4]} is archived and can't be changed anymore")
+
+    def archive_path(self, path):
+        return path if os.path.isabs(path) else os.path.join(self.db_dir, path)
+
+    #ATTACH on demand, the most recently used archives stay attached
+    def attach_archive(self, year, path):
+        alias = f"arch_{year}"
+        if alias in self.attached:
+            self.attached.remove(alias)
+        else:
+            if len(self.attached) >= MAX_ATTACHED_ARCHIVES:
+                self.c.execute(f"DETACH DATABASE {self.attached.pop(0)}")
+            self.c.execute(f"ATTACH DATABASE ? AS {alias}", (self.archive_path(path),))
+        self.attached.append(alias)
+        return alias
+
+    #FROM clause of the ledger queries ("t"): the hot table, plus the archives the date range reaches into
+    #An open start date stays on the hot table, the carry forward rows stand in for the closed years
+    def ledger_source(self, start_date="", end_date=""):
+        closed = self.closed_through()
+        if not closed or not start_date or start_date > closed:
+            return "transactions t"
+
+        try:
+            first, last = int(start_date[:4]), int(end_date[:4]) if end_date else None
+        except ValueError:
+            return "transactions t"
+
+        years = [(year, path) for year, path in self.get_archived_years() if year >= first and (last is None or year <= last)]
+        if not years:
+            return "transactions t"
+
+        #The carry forward of an attached year is replaced by its real rows (archived years follow each other)
+        first_day, last_day = to_day(f"{years[0][0]}-01-01"), to_day(f"{years[-1][0]}-12-31")
+        parts = [f"""SELECT {ARCHIVE_COLUMNS} FROM main.transactions
+                     WHERE NOT (IFNULL(leg_role, '') = '{CARRY_FORWARD}' AND date BETWEEN {first_day} AND {last_day})"""]
+        for year, path in years:
+            parts.append(f"SELECT {ARCHIVE_COLUMNS} FROM {self.attach_archive(year, path)}.transactions")
+
+        return "(" + " UNION ALL ".join(parts) + ") t"
+
+    #Moves every row of a closed year to its own file, oldest year first
+    #Phase 1 copies the rows and checks them, phase 2 replaces them by carry forward rows in one transaction,
+    #so an interruption never loses a row (a leftover archive file is simply rebuilt on the next run)
+    def archive_year(self, year, archive_dir=ARCHIVE_DIR):
+        year = int(year)
+        start, end = to_day(f"{year}-01-01"), to_day(f"{year}-12-31")
+
+        if year >= date.today().year:
+            raise ValueError(f"{year} is not closed yet")
+        if any(archived == year for archived, _ in self.get_archived_years()):
+            raise ValueError(f"{year} is already archived")
+
+        self.c.execute(f"SELECT MIN(date) FROM transactions WHERE IFNULL(leg_role, '') != '{CARRY_FORWARD}'")
+        earliest = self.c.fetchone()[0]
+        if earliest is None:
+            raise ValueError("Nothing left to archive")
+        earliest = int(from_day(earliest)[:4])
+        if earliest != year:
+            raise ValueError(f"Years are archived oldest first, the oldest year in the ledger is {earliest}")
+
+        path = os.path.join(archive_dir, f"store_{year}.db")
+        full_path = self.archive_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+
+        archive = sqlite3.connect(full_path)
+        archive.execute("""CREATE TABLE transactions (
+                        id INTEGER PRIMARY KEY,
+                        store_id INTEGER,
+                        parent_id INTEGER,
+                        date INTEGER,
+                        type TEXT,
+                        category TEXT,
+                        amount REAL,
+                        currency TEXT,
+                        payment_method TEXT,
+                        description TEXT,
+                        leg_role TEXT,
+                        leg_rate REAL)""")
+        archive.execute("CREATE INDEX idx_store_date ON transactions(store_id, date)")
+        archive.execute("CREATE INDEX idx_parent ON transactions(parent_id)")
+        archive.commit()
+        archive.close()
+
+        # Phase 1: copy
+        self.c.execute("ATTACH DATABASE ? AS archive_new", (full_path,))
+        try:
+            with self.write(journal=False):
+                self.c.execute(f"""
+                    INSERT INTO archive_new.transactions ({ARCHIVE_COLUMNS})
+                    SELECT {ARCHIVE_COLUMNS} FROM main.transactions WHERE date BETWEEN ? AND ?
+                """, (start, end))
+            self.c.execute("SELECT count(*) FROM archive_new.transactions")
+            copied = self.c.fetchone()[0]
+        finally:
+            self.c.execute("DETACH DATABASE archive_new")
+
+        # Phase 2: swap the rows for their carry forward (kept out of the journal, an undo must not bring them back)
+        with self.write(journal=False):
+            self.c.execute("SELECT count(*) FROM transactions WHERE date BETWEEN ? AND ?", (start, end))
+            if self.c.fetchone()[0] != copied:
+                raise RuntimeError(f"Rows were added to {year} while archiving, nothing was removed (run it again)")
+
+            self.c.execute("""
+                SELECT store_id, currency, payment_method, ROUND(SUM(CASE WHEN type = 'Income' THEN amount ELSE -amount END), 2)
+                FROM transactions WHERE date BETWEEN ? AND ?
+                GROUP BY store_id, currency, payment_method
+            """, (start, end))
+            carry = [(store_id, end, "Income" if net >= 0 else "Expense", f"Carry Forward {year}", abs(net), currency, method,
+                      f"Closing balance of {year} (see {path})", CARRY_FORWARD)
+                     for store_id, currency, method, net in self.c.fetchall() if net]
+
+            self.c.execute("DELETE FROM transactions WHERE date BETWEEN ? AND ?", (start, end))
+            self.c.executemany("""
+                INSERT INTO transactions (store_id, date, type, category, amount, currency, payment_method, description, leg_role)
+                VALUES (?,?,?,?,?,?,?,?,?)
+            """, carry)
+            self.c.execute("INSERT INTO archives (year, path, rows, archived_at) VALUES (?,?,?,?)",
+                           (year, path, copied, datetime.now().isoformat(timespec="seconds")))
+            self.bump_version("transactions")
+
+        print(f"Archived {copied:,} rows of {year} to {path} ({len(carry)} carry forward rows)")
+        return copied
+
+    #Every derived-leg chain of the live database checked in two scans (archived years never change, they are left out)
+    #Returns {check: {"count": n, "rows": [(id, parent_id, date, store, detail), ...]}}, at most `limit` rows per check
+    def check_integrity(self, limit=50):
+        started = time.perf_counter()
+        report = {kind: {"count": 0, "rows": []} for kind in INTEGRITY_CHECKS}
+
+        def add(kind, row):
+            report[kind]["count"] += 1
+            if len(report[kind]["rows"]) < limit:
+                report[kind]["rows"].append(row)
+
+        self.c.execute(INTEGRITY_LEG_PASS, (json.dumps(LEG_ACCOUNTS), json.dumps(LEG_LABELS)))
+        for issue, leg_id, parent_id, t_date, store, amount, expected, category in self.c.fetchall():
+            if issue == "drift":
+                detail = f"{amount:,.2f} recorded, {expected:,.2f} expected"
+            elif issue in ("account", "label"):
+                detail = f"{category} on {store}"
+            else:
+                detail = category
+            add(issue, (leg_id, parent_id, t_date, store, detail))
+
+        self.c.execute(INTEGRITY_PARENT_PASS)
+        for (parent_id, t_date, store, sales, card, cogs, main, swap, main_out, main_in, tva_out, tva_in, comm_out, comm_in,
+             freight_out, freight_in, cogs_in, transfer_in, swap_in) in self.c.fetchall():
+            #(role, found expense/income legs, wanted)
+            found = [("main", (main_out, main_in), (main_in, main_in) if main_in <= sales else (0, 0)),
+                     ("tva", (tva_out, tva_in), (sales, sales)),
+                     ("comm", (comm_out, comm_in), (card, card)),
+                     ("freight", (freight_out, freight_in), (cogs, cogs)),
+                     ("cogs", (0, cogs_in), (0, cogs)),
+                     ("main_transfer", (0, transfer_in), (0, main)),
+                     ("exchange", (0, swap_in), (0, swap))]
+            detail = ", ".join(f"{role} {have[0]}/{have[1]} (want {want[0]}/{want[1]})" for role, have, want in found if have != want)
+            add("missing", (parent_id, None, t_date, store, detail))
+
+        total = sum(entry["count"] for entry in report.values())
+        print(f"Integrity check: {total:,} issue(s) in {(time.perf_counter() - started) * 1000:,.0f} ms")
+        return report
+
+    #Puts every drifted leg back to parent amount x recorded rate (the fix for the "drift" check)
+    def fix_leg_drift(self):
+        with self.write("Fix leg drift"):
+            self.c.execute(f"""
+                UPDATE transactions {RECALC_LEGS_SET}
+                WHERE parent_id IS NOT NULL AND leg_rate IS NOT NULL
+                AND ABS(amount - ROUND((SELECT p.amount FROM transactions p WHERE p.id = transactions.parent_id) * leg_rate / 100, 2)) > 0.015
+            """)
+            updated = self.c.rowcount
+            self.bump_version("transactions")
+        return updated
+
+    #Consistent copy of the live database (a plain file copy would miss what is still in the WAL)
+    def backup_to(self, path):
+        dest = sqlite3.connect(path)
+        try:
+            self.conn.backup(dest)
+        finally:
+            dest.close()
+
+    #Live numbers for the diagnostics window
+    def get_query_stats(self):
+        self.c._finish()
+        return self.stats.snapshot(), list(self.stats.slow_queries)
+
+    def reset_query_stats(self):
+        self.stats.reset()
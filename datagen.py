@@ -0,0 +1,221 @@
+import argparse
+import math
+import random
+import time
+from datetime import date
+
+from database import DatabaseManager, PHYSICAL_BRANCHES, EPOCH_ORDINAL, derive_legs
+
+#Deterministic synthetic ledger for benchmarks and load tests
+#Usage: python datagen.py --db year.db --start 2024-01-01 --days 365 --transactions 1m --seed 42
+
+EXPENSE_CATEGORIES = ["Salaries", "Rent", "Yearly Fees", "Electricity Chiller", "Phone", "Various", "Cleaner", "Extra Cash"]
+
+#How often each kind of posting shows up next to the daily envelope sales
+POSTING_WEIGHTS = [
+    ("expense", 30),
+    ("cost_of_goods", 10),
+    ("main", 8),
+    ("exchange", 8),
+    ("transfer", 4),
+]
+
+#Average number of rows a branch-day produces with the defaults below (used to size the run)
+ROWS_PER_SALE_LINE = 6
+CHUNK_SIZE = 50_000
+
+
+def usd_amount(rng):
+    return round(rng.uniform(20, 1500), 2)
+
+
+def lbp_amount(rng):
+    return round(rng.uniform(500_000, 60_000_000), -3)
+
+
+class LedgerGenerator:
+    def __init__(self, db, seed=42, start=date(2024, 1, 1), days=365, exchange_rate=None, rates=None):
+        self.db = db
+        self.rng = random.Random(seed)
+        self.start = start
+        self.days = days
+        self.rates = rates or db.get_posting_rates()
+        self.exchange_rate = exchange_rate or db.get_rate("exchange_rate")
+
+        self.db.c.execute("SELECT name, id FROM stores")
+        self.store_ids = dict(self.db.c.fetchall())
+        self.branches = [b for b in PHYSICAL_BRANCHES if b in self.store_ids]
+
+        #Ids are assigned here so the derived legs can point at their parent inside one executemany
+        #(the first one is read once run() holds the write lock, see next_transaction_id)
+        self.next_id = None
+
+        self.pending = []
+        self.written = 0
+
+    def add(self, store, t_date, t_type, category, amount, currency, method, parent_id=None, description=None, leg_role=None, leg_rate=None):
+        row_id = self.next_id
+        self.next_id += 1
+        self.pending.append((row_id, self.store_ids[store], parent_id, t_date, t_type, category, amount, currency, method, description, leg_role, leg_rate))
+
+        if len(self.pending) >= CHUNK_SIZE:
+            self.flush()
+        return row_id
+
+    #Same rules as add_records / submit_sale (derive_legs), only batched
+    def post(self, store, t_date, t_type, category, amount, currency, method, apply_main=True):
+        parent_id = self.add(store, t_date, t_type, category, amount, currency, method)
+
+        for leg_store, leg_type, leg_cat, leg_amt, role, rate in derive_legs(store, t_type, category, amount, method, self.rates, apply_main):
+            self.add(leg_store, t_date, leg_type, leg_cat, leg_amt, currency, method, parent_id=parent_id, leg_role=role, leg_rate=rate)
+        return parent_id
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.db.c.executemany("""
+            INSERT INTO transactions (id, store_id, parent_id, date, type, category, amount, currency, payment_method, description, leg_role, leg_rate)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+        """, self.pending)
+        self.written += len(self.pending)
+        self.pending = []
+
+    def post_exchange(self, store, t_date):
+        rng = self.rng
+        if rng.random() < 0.5:
+            amount = usd_amount(rng)
+            converted, cur_out, cur_in = round(amount * self.exchange_rate, 0), "USD ($)", "Lira (LBP)"
+        else:
+            amount = lbp_amount(rng)
+            converted, cur_out, cur_in = round(amount / self.exchange_rate, 2), "Lira (LBP)", "USD ($)"
+
+        parent_id = self.add(store, t_date, "Expense", "Exchange Out", amount, cur_out, "Cash")
+        self.add(store, t_date, "Income", "Exchange In", converted, cur_in, "Cash", parent_id=parent_id, leg_role="exchange")
+
+    def post_transfer(self, store, t_date):
+        rng = self.rng
+        currency = rng.choice(["USD ($)", "Lira (LBP)"])
+        amount = usd_amount(rng) if currency == "USD ($)" else lbp_amount(rng)
+        paym_out, paym_in = ("Cash", "Card") if rng.random() < 0.5 else ("Card", "Cash")
+
+        parent_id = self.add(store, t_date, "Expense", "Bank Transfer Out", amount, currency, paym_out)
+        self.add(store, t_date, "Income", "Bank Transfer In", amount, currency, paym_in, parent_id=parent_id, leg_role="transfer")
+
+    #One branch-day: the envelope sales of the reconciliation, its target and metrics, then some other postings
+    def generate_day(self, branch, t_date, sale_lines, other_postings):
+        rng = self.rng
+        counted_lbp = 0
+
+        for _ in range(sale_lines):
+            currency = rng.choice(["USD ($)", "Lira (LBP)"])
+            method = rng.choice(["Cash", "Card"])
+            amount = usd_amount(rng) if currency == "USD ($)" else lbp_amount(rng)
+            self.post(branch, t_date, "Income", "Sales", amount, currency, method, apply_main=rng.random() < 0.9)
+            counted_lbp += amount * self.exchange_rate if currency == "USD ($)" else amount
+
+        kinds = [kind for kind, _ in POSTING_WEIGHTS]
+        weights = [weight for _, weight in POSTING_WEIGHTS]
+
+        for kind in rng.choices(kinds, weights, k=other_postings):
+            currency = rng.choice(["USD ($)", "Lira (LBP)"])
+            method = rng.choice(["Cash", "Card"])
+            amount = usd_amount(rng) if currency == "USD ($)" else lbp_amount(rng)
+
+            if kind == "expense":
+                self.post(branch, t_date, "Expense", rng.choice(EXPENSE_CATEGORIES), amount, currency, method)
+            elif kind == "cost_of_goods":
+                self.post(branch, t_date, "Expense", "Cost of goods", amount, currency, method)
+            elif kind == "main":
+                self.post(branch, t_date, "Expense", "Main", amount, currency, method)
+            elif kind == "exchange":
+                self.post_exchange(branch, t_date)
+            else:
+                self.post_transfer(branch, t_date)
+
+        #Targets are close to what was counted, with the odd discrepancy
+        target = round(counted_lbp * rng.uniform(0.98, 1.02), -3)
+        receipts = max(1, sale_lines * rng.randint(3, 12))
+        footfall = receipts + rng.randint(0, receipts * 4)
+        return (t_date, self.store_ids[branch], target), (self.store_ids[branch], t_date, receipts, footfall)
+
+    #Generates until `transactions` rows are written (or for every day when it is None)
+    def run(self, transactions=None, sale_lines=4, other_postings=2):
+        if transactions:
+            branch_days = self.days * max(1, len(self.branches))
+            rows_per_day = sale_lines * ROWS_PER_SALE_LINE + other_postings * 3
+            scale = max(1, math.ceil(transactions / (branch_days * rows_per_day)))
+            sale_lines *= scale
+            other_postings *= scale
+
+        daily_sales = []
+        daily_metrics = []
+
+        self.db.c.execute("PRAGMA synchronous")
+        synchronous = self.db.c.fetchone()[0]
+        self.db.c.execute("PRAGMA synchronous = OFF")
+        #A failed insert rolls the whole run back, and synchronous always goes back to what it was
+        try:
+            #IMMEDIATE: no other workstation can post between reading the next id and the inserts
+            self.db.c.execute("BEGIN IMMEDIATE")
+            try:
+                self.next_id = self.db.next_transaction_id()
+                for offset in range(self.days):
+                    #Rows go straight to SQLite, so the date is already the stored day number
+                    t_date = self.start.toordinal() - EPOCH_ORDINAL + offset
+
+                    for branch in self.branches:
+                        sale_row, metric_row = self.generate_day(branch, t_date, sale_lines, other_postings)
+                        daily_sales.append(sale_row)
+                        daily_metrics.append(metric_row)
+
+                    if transactions and self.written + len(self.pending) >= transactions:
+                        break
+
+                self.flush()
+                self.db.c.executemany("INSERT OR REPLACE INTO daily_sales (date, store_id, amount) VALUES (?,?,?)", daily_sales)
+                self.db.c.executemany("INSERT OR REPLACE INTO daily_metrics (store_id, date, receipts, footfall) VALUES (?,?,?,?)", daily_metrics)
+
+                self.db.bump_version("transactions", "daily_sales", "daily_metrics")
+                self.db.conn.commit()
+            except BaseException:
+                self.db.conn.rollback()
+                self.pending = []
+                self.written = 0
+                raise
+        finally:
+            self.db.c.execute(f"PRAGMA synchronous = {int(synchronous)}")
+        return self.written
+
+
+def parse_count(text):
+    text = text.strip().lower()
+    multipliers = {"k": 1_000, "m": 1_000_000}
+    if text[-1] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a realistic multi-branch ledger into a store.db file")
+    parser.add_argument("--db", default="synthetic.db")
+    parser.add_argument("--start", default="2024-01-01", help="First day (yyyy-mm-dd)")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--transactions", default="", help="Approximate number of rows to write, ex: 1m")
+    parser.add_argument("--sale-lines", type=int, default=4, help="Envelope sales per branch-day")
+    parser.add_argument("--other", type=int, default=2, help="Expenses, exchanges and transfers per branch-day")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    db = DatabaseManager(args.db)
+    generator = LedgerGenerator(db, seed=args.seed, start=date.fromisoformat(args.start), days=args.days)
+
+    started = time.perf_counter()
+    written = generator.run(parse_count(args.transactions) if args.transactions else None, args.sale_lines, args.other)
+    elapsed = time.perf_counter() - started
+
+    print(f"Wrote {written:,} transactions to {args.db} in {elapsed:.1f}s ({written / max(elapsed, 1e-9):,.0f} rows/s)")
+    db.conn.close()
+
+
+if __name__ == "__main__":
+    main()
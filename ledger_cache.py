@@ -0,0 +1,84 @@
+from collections import Counter, OrderedDict
+
+from database import LEDGER_PAGE_SIZE
+
+#Tables the ledger rows and totals are read from (totals convert LBP at the rate of their day)
+LEDGER_TABLES = ["transactions", "exchange_rates"]
+
+
+#Prepared ledger views keyed by (store, filters): their totals and the pages already fetched in each sort order
+#Switching back to a branch or paging back then skips SQL. Any write bumps the data versions (here or on
+#another workstation sharing the file), and the next lookup drops every view
+class LedgerCache:
+    def __init__(self, db, max_views=32, max_pages=8):
+        self.db = db
+        self.max_views = max_views
+        self.max_pages = max_pages
+        self.views = OrderedDict()
+        self.versions = None
+        self.uses = Counter()
+        self.hits = 0
+        self.misses = 0
+
+    #One small query per lookup, the versions are read before the data so a write in between only over-invalidates
+    def check(self):
+        versions = self.db.get_data_versions(LEDGER_TABLES)
+        if versions != self.versions:
+            self.views.clear()
+            self.versions = versions
+
+    def view(self, query):
+        view = self.views.get(query)
+        if view is None:
+            view = self.views[query] = {"totals": None, "pages": OrderedDict()}
+            while len(self.views) > self.max_views:
+                self.views.popitem(last=False)
+        self.views.move_to_end(query)
+        return view
+
+    #query is the ledger_query tuple of the main window (store, type, category, currency, method, from, to, match_from)
+    #Rows of one page plus the extra row that tells if there is a next one
+    def page(self, query, sort, descending, number):
+        self.check()
+        pages = self.view(query)["pages"]
+        key = (sort, descending, number)
+
+        rows = pages.get(key)
+        if rows is None:
+            self.misses += 1
+            rows = pages[key] = self.db.get_ledger_rows(*query, sort=sort, descending=descending,
+                                                        limit=LEDGER_PAGE_SIZE + 1, offset=number * LEDGER_PAGE_SIZE)
+            while len(pages) > self.max_pages:
+                pages.popitem(last=False)
+        else:
+            self.hits += 1
+        pages.move_to_end(key)
+        return rows
+
+    def totals(self, query):
+        self.check()
+        view = self.view(query)
+        if view["totals"] is None:
+            self.misses += 1
+            view["totals"] = self.db.get_ledger_totals(*query)
+        else:
+            self.hits += 1
+        return view["totals"]
+
+    def used(self, store):
+        self.uses[store] += 1
+
+    #Branches picked most often this session, best first
+    def most_used(self, n):
+        return [store for store, _ in self.uses.most_common(n)]
+
+    #Fills the totals and first page of a view ahead of time, False when they were already there
+    def prefetch(self, query, sort, descending):
+        self.check()
+        view = self.views.get(query)
+        if view is not None and view["totals"] is not None and (sort, descending, 0) in view["pages"]:
+            return False
+
+        self.totals(query)
+        self.page(query, sort, descending, 0)
+        return True
@@ -1,259 +1,130 @@
-import sqlite3
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 import customtkinter as ctk
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
 from tkcalendar import DateEntry
 import os
-import shutil
+import sys
 import pandas as pd
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from database import DatabaseManager, StaleRecordError, ClosedPeriodError, PHYSICAL_BRANCHES, SYSTEM_ACCOUNTS, LEDGER_PAGE_SIZE, INTEGRITY_CHECKS
+from analytics import AnalyticsCache, branch_report, compare_branches, sidecar_path
+from ledger_cache import LedgerCache
+import columnar
+from sync import site_id
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
 
-
-#This class is for everything database related
-class DatabaseManager:
-    #This will create the db file (and sqlite3 setups)
-    def __init__(self, db_name="store.db"):
-        self.conn = sqlite3.connect(db_name)
-
-        self.c = self.conn.cursor()
-
-        self.create_tables()
-
-        self.run_migrations()
-
-    #Migration for 1.2 update (Add description columns without destrying the already in use db)
-    def run_migrations(self):
-        try:
-            self.c.execute("ALTER TABLE transactions ADD COLUMN description TEXT")
-            self.conn.commit()
-            print("Database upgraded: Added description column.")
-        except sqlite3.OperationalError:
-            pass
-
-    #This will create the required tables (stores and transactions if not created) and check if stores is empty to add the default stores
-    def create_tables(self):
-        self.c.execute("""
-            CREATE TABLE IF NOT EXISTS stores (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                       name TEXT
-                       )
-        """)
-
-        self.c.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                       store_id INTEGER,
-                       parent_id INTEGER,
-                       date TEXT,
-                       type TEXT,
-                       category TEXT,
-                       amount REAL,
-                       currency TEXT,
-                       payment_method TEXT
-                       )
-        """)
-
-        self.c.execute("""CREATE TABLE IF NOT EXISTS settings (
-                       key TEXT PRIMARY KEY,
-                       value REAL
-                       )
-        """)
-
-        self.c.execute("""CREATE TABLE IF NOT EXISTS daily_sales (
-                       date TEXT,
-                       store_id INTEGER,
-                       amount REAL,
-                       PRIMARY KEY (store_id, date))""")
-        
-        self.c.execute("""CREATE TABLE IF NOT EXISTS daily_metrics (
-                       branch TEXT,
-                       date TEXT,
-                       receipts INTEGER,
-                       footfall INTEGER,
-                       PRIMARY KEY (branch, date))""")
-
-        self.c.execute("CREATE INDEX IF NOT EXISTS idx_store_date ON transactions(store_id, date)")
-        
-        self.c.execute("CREATE INDEX IF NOT EXISTS idx_parent ON transactions(parent_id)")
-
-        self.seed_data()
-        self.seed_settings()
-
-    def seed_settings(self):
-        default = {
-            "main_rate" : 15.0,
-            "tva_rate" : 7.0,
-            "comm_rate": 3.0,
-            "freight_rate": 33.0,
-            "exchange_rate": 89500.0,
-        }
-
-        for key, val in default.items():
-            self.c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?,?)", (key,val))
-        self.conn.commit()
-
-    def get_rate(self, key):
-        self.c.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        res = self.c.fetchone()
-        return res[0] if res else 0.0
-
-    def update_rate(self, key, value):
-        self.c.execute("UPDATE settings SET value = ? WHERE key = ?", (value,key))
-        self.conn.commit()
-
-    #This will check if the stores table is empty, if it is, it will add the default stores (he bas ta nzid l branches)
-    def seed_data(self):
-        default_branches = ["LeMall Dbayye", "City Center", "City Mall", "Koura Branch",
-                                "Main Vault", "TVA Account", "Bank Commission", "Cost of goods", "Freight"]
-        
-        for branch in default_branches:
-            self.c.execute("SELECT count(*) FROM stores WHERE name = ?", (branch,))
-            if self.c.fetchone()[0] == 0:
-                print(f"Adding missing branch: {branch}")
-                self.c.execute("INSERT INTO stores (name) VALUES (?)", (branch,))
-        self.conn.commit()
-
-
-    def get_store_names(self):
-        self.c.execute("SELECT name FROM stores")
-
-        names = []
-
-        for row in self.c.fetchall():
-            names.append(row[0])
-        return names
-    
-    def get_store_id(self, store_name):
-        self.c.execute("SELECT id FROM stores WHERE name = ?", (store_name,))
-        #Safety check
-        result = self.c.fetchone()
-        if not result:
-            print(f"Error Store '{store_name}' not found")
-            return
-        return result[0]
-    
-    def save_daily_sale(self, store_name, t_date, t_amount):
-    
-        store_id = self.get_store_id(store_name)
-        #In case of an error where there is no ID provided
-        if not store_id:
-            return
-
-        #I used INSERT OR REPLACE to overwrite a sale, if its in the same day, same store
-        self.c.execute("INSERT OR REPLACE INTO daily_sales (date, store_id, amount) VALUES (?,?,?)", (t_date, store_id, t_amount))
-
-        self.conn.commit()
-
-    def get_daily_sale(self, store_name, t_date):
-        store_id = self.get_store_id(store_name)
-
-        self.c.execute("SELECT amount FROM daily_sales WHERE store_id = ? AND date = ?", (store_id, t_date))
-        amount = self.c.fetchone()
-        if amount == None:
-            return 0
-        else :
-            return amount[0]
-        
-
-
-        
-    def add_transactions(self, store_name, t_date, t_type, category, amount, currency, p_method, parent_id=None, description=None):
-        self.c.execute("SELECT id FROM stores WHERE name = ?", (store_name,))
-        result = self.c.fetchone()
-
-        if result:
-            store_id = result[0]
-
-            self.c.execute("INSERT INTO transactions (store_id, parent_id, date, type, category, amount, currency, payment_method, description) VALUES (?,?,?,?,?,?,?,?,?)", (store_id, parent_id,t_date, t_type, category, amount, currency, p_method, description))
-            self.conn.commit()
-            return self.c.lastrowid
+#Analytics charts: value labels only when they stay readable, bar width and date format per granularity
+ANNOTATE_MAX_POINTS = 31
+BAR_WIDTH_DAYS = {"day": 0.6, "week": 4.5, "month": 20, "year": 250}
+DATE_FORMATS = {"day": "%Y-%m-%d", "week": "%Y-%m-%d", "month": "%b %Y", "year": "%Y"}
+
+#Ledger headings that sort (re-query) on click -> LEDGER_SORTS key
+HEADING_SORTS = {"Date": "date", "Amount": "amount", "Category": "category", "Currency": "currency", "Payment Method": "method"}
+
+#Undo / redo buttons show the start of what they would take back
+UNDO_LABEL_CHARS = 28
+
+#Branches whose ledger (same filters) is loaded while the window is idle, 0 turns the prefetch off
+PREFETCH_BRANCHES = 3
+PREFETCH_DELAY_MS = 500
+
+def parse_amount(text):
+    try:
+        text = text.replace(",", "").strip()
+        return float(text) if text else 0.0
+    except ValueError:
+        return 0.0
+
+
+#Parsed values behind the reconciliation window
+#A keystroke only swaps the contribution of the cell that changed, the widgets are never re-read
+class ReconModel:
+    def __init__(self, rate):
+        self.rate = rate
+        self.cells = {}
+        self.usd_total = 0.0
+        self.lbp_total = 0.0
+        self.target = 0.0
+
+    #Returns True when the parsed value actually changed (so a render is needed)
+    def set_cell(self, env, tag, text):
+        new_val = parse_amount(text)
+        old_val = self.cells.get((env, tag), 0.0)
+
+        if new_val == old_val:
+            return False
+
+        self.cells[(env, tag)] = new_val
+        if tag.startswith("usd"):
+            self.usd_total += new_val - old_val
         else:
-            print("Error, Store not found")
+            self.lbp_total += new_val - old_val
+        return True
 
-    def get_transactions(self, store_name):
-        self.c.execute("""
-            SELECT t.id, t.date, t.type, t.category, t.amount, t.currency, t.payment_method, IFNULL(t.description, '') FROM transactions t
-            JOIN stores s ON t.store_id = s.id
-            WHERE s.name = ?
-            ORDER BY t.date DESC
-        """, (store_name,))
+    def set_target(self, text):
+        new_val = parse_amount(text)
+        if new_val == self.target:
+            return False
+        self.target = new_val
+        return True
 
-        return self.c.fetchall()
-    
-    def update_transaction_full(self, record_id, new_date, new_cat, new_amt, new_desc):
-        self.c.execute("""
-                       UPDATE transactions
-                       SET date = ?, category = ?, amount = ?, description = ?
-                       WHERE id = ?
-                       """, (new_date, new_cat, new_amt, new_desc, record_id))
-        
-        self.c.execute("UPDATE transactions SET date = ? WHERE parent_id = ?",(new_date, record_id))
+    def counted(self):
+        return self.lbp_total + self.usd_total * self.rate
 
-        self.conn.commit()
+    def difference(self):
+        return self.target - self.counted()
 
-    def update_smart_pair(self, parent_id, dest_store_name, category_keyword, new_amount):
-        self.c.execute("""
-            UPDATE transactions 
-            SET amount = ? 
-            WHERE parent_id = ? 
-            AND store_id = (SELECT id FROM stores WHERE name = ?)
-        """, (new_amount, parent_id, dest_store_name))
 
-        like_query = f"{category_keyword}%"
-        self.c.execute("""
-                        UPDATE transactions
-                       SET amount = ?
-                       WHERE parent_id = ?
-                       AND category LIKE ?""", (new_amount, parent_id, like_query))
-
-        self.conn.commit()
-
-    def delete_transaction(self, trans_id):
-        self.c.execute("DELETE FROM transactions WHERE id = ?", (trans_id,))
-        self.conn.commit()
+#Dialogs are built once and hidden when closed (withdraw instead of destroy)
+#build(top) creates the widgets and returns refresh(**kwargs), which is all a reopen costs
+class DialogManager:
+    def __init__(self, root):
+        self.root = root
+        self.dialogs = {}
+        #Window that held the grab when a dialog was shown (a modal opened from another modal), it gets it back on hide
+        self.grab_owners = {}
+
+    def show(self, name, title, geometry, build, modal=True, **kwargs):
+        entry = self.dialogs.get(name)
+
+        if entry is None or not entry[0].winfo_exists():
+            top = ctk.CTkToplevel(self.root)
+            top.title(title)
+            top.geometry(geometry)
+            top.protocol("WM_DELETE_WINDOW", lambda: self.hide(name))
+            entry = self.dialogs[name] = (top, build(top), modal)
+        else:
+            entry[0].deiconify()
+            entry[0].lift()
+
+        top, refresh, modal = entry
+        if modal:
+            owner = self.root.grab_current()
+            if owner is not None and owner is not top:
+                self.grab_owners[name] = owner
+            top.grab_set()
+        top.focus()
 
-    def delete_smart_chain(self, record_id):
-        self.c.execute("DELETE FROM transactions WHERE parent_id = ?", (record_id,))
+        refresh(**kwargs)
+        return top
 
-        self.c.execute("DELETE FROM transactions WHERE id = ?",(record_id,))
+    def hide(self, name):
+        entry = self.dialogs.get(name)
+        if entry is not None and entry[0].winfo_exists():
+            entry[0].grab_release()
+            entry[0].withdraw()
 
-        self.conn.commit()
+        owner = self.grab_owners.pop(name, None)
+        if owner is not None and owner.winfo_exists() and owner.winfo_viewable():
+            owner.grab_set()
 
 
-    def get_balance_summary(self):
-        query = """
-            SELECT s.name, t.currency, t.payment_method, 
-                   SUM(CASE WHEN t.type = 'Income' THEN t.amount ELSE -t.amount END) as balance
-            FROM transactions t
-            JOIN stores s ON t.store_id = s.id
-            GROUP BY s.name, t.currency, t.payment_method
-        """
-        self.c.execute(query)
-        return self.c.fetchall()
-    
-    def save_daily_metrics(self, branch, date, receipts, footfall):
-        self.c.execute("""
-                        INSERT OR REPLACE INTO daily_metrics (branch, date, receipts, footfall) VALUES (?,?,?,?) """, (branch, date, receipts, footfall))
-        self.conn.commit()
-
-    def get_daily_metrics(self, branch, date):
-        self.c.execute('''
-            SELECT receipts, footfall FROM daily_metrics 
-            WHERE branch = ? AND date = ?
-        ''', (branch, date))
-
-        result = self.c.fetchone()
-
-        if result:
-            return result[0], result[1]
-        return "", ""
-        
 #This class will be used for the user interface (GUI)
 class StoreApp:
     #This will create the root of the window, link the db class and setup the page
@@ -277,6 +148,21 @@ class StoreApp:
         self.db = DatabaseManager()
         self.auto_backup()
 
+        #Analytics results are reused until new data arrives (kept in store_cache.db between runs)
+        self.analytics_cache = AnalyticsCache(self.db, path=sidecar_path("store.db"))
+
+        #The columnar mirror is opt-in: used once "cli.py mirror refresh" made it, and numpy is installed
+        self.mirror = None
+        if columnar.available() and os.path.isdir(columnar.mirror_path("store.db")):
+            self.mirror = columnar.ColumnarMirror(self.db, columnar.mirror_path("store.db"))
+
+        #Ledger pages and totals per (branch, filters), so switching back to a branch doesn't re-query
+        self.ledger_cache = LedgerCache(self.db)
+        self.prefetch_job = None
+
+        #Balances, recon, analytics, settings, exchange, edit and diagnostics are built on first open only
+        self.dialogs = DialogManager(self.root)
+
         #Color dictionnary
         self.colors = {
             "bg": "#242424",           
@@ -291,15 +177,9 @@ class StoreApp:
 
         self.setup_styles()
 
-        self.system_accounts = ["Main Vault", "TVA Account", "Bank Commission", "Cost of goods", "Freight"]
+        self.system_accounts = list(SYSTEM_ACCOUNTS)
 
-        self.physical_branches = [
-            "LeMall Dbayye", 
-            "City Center", 
-            "City Mall", 
-            "Tripoli", 
-            "Koura Branch"
-        ]
+        self.physical_branches = list(PHYSICAL_BRANCHES)
 
         self.category_list = [
             "Salaries",
@@ -338,7 +218,11 @@ class StoreApp:
             "Yearly Fees"
         ]
 
-        self.current_data = []
+        #Ledger view: filters of the last Apply, sort column/direction and page shown
+        self.ledger_query = None
+        self.ledger_sort = "date"
+        self.ledger_desc = True
+        self.ledger_page = 0
 
         self.setup_header()
         self.setup_inputs()
@@ -355,7 +239,7 @@ class StoreApp:
 
             if not os.path.exists(backup_file) and os.path.exists("store.db"):
                 try:
-                    shutil.copy("store.db",backup_file)
+                    self.db.backup_to(backup_file)
                     print(f"Auto Backup created for {today}")
                 except Exception as e:
                     print(f"Auto-backup failed: {e}")
@@ -390,6 +274,12 @@ class StoreApp:
                                     command=self.open_analytics_window)
         btn_analytics.pack(side=tk.RIGHT, padx=5)
 
+        diag_btn = ctk.CTkButton(header_frame, text="🩺 Diagnostics", width=120, height=35, fg_color="transparent",
+                                 border_width=2, border_color="#3e3e3e", hover_color="#3e3e3e",
+                                 font=("Segoe UI", 11, "bold"), cursor="hand2",
+                                 command=self.open_diagnostics_window)
+        diag_btn.pack(side=tk.RIGHT, padx=5)
+
         all_stores = self.db.get_store_names()
 
         #Now under it we want to branch dropdown menu
@@ -398,7 +288,14 @@ class StoreApp:
 
         self.store_combo.pack(side=tk.RIGHT, padx=20)
 
+    #Brought up to date before a scan (O(new rows), a full rebuild after an edit or delete), None without a mirror
+    def refreshed_mirror(self):
+        if self.mirror is not None:
+            self.mirror.refresh()
+        return self.mirror
+
     def on_branch_change(self, choice):
+        self.ledger_cache.used(choice)
         self.toggle_category_state()
         self.update_filter_dropdown()
 
@@ -544,7 +441,11 @@ class StoreApp:
         
 
         for col in visible_cols:
-            self.tree.heading(col, text=col)
+            if col in HEADING_SORTS:
+                self.tree.heading(col, text=col, command=lambda key=HEADING_SORTS[col]: self.sort_ledger(key))
+            else:
+                self.tree.heading(col, text=col)
+        self.update_sort_headings()
 
         scrollbar = ctk.CTkScrollbar(tree_frame, orientation="vertical", command=self.tree.yview)
         self.tree.configure(yscroll=scrollbar.set)
@@ -563,6 +464,30 @@ class StoreApp:
         export_btn = ctk.CTkButton(bottom_frame, text="Export to Excel", fg_color=self.colors["accent"], hover_color="#154360", font=("Segoe UI", 12, "bold"), height=35, cursor="hand2", command=self.export_to_excel)
         export_btn.pack(side="left")
 
+        #Undo / redo of the last postings, edits and deletes of this workstation (see the journal in database.py)
+        self.undo_btn = ctk.CTkButton(bottom_frame, text="↶ Undo", width=80, height=35, fg_color="transparent", border_width=1, cursor="hand2",
+                                      command=self.undo_last)
+        self.undo_btn.pack(side="left", padx=(20, 5))
+
+        self.redo_btn = ctk.CTkButton(bottom_frame, text="↷ Redo", width=80, height=35, fg_color="transparent", border_width=1, cursor="hand2",
+                                      command=self.redo_last)
+        self.redo_btn.pack(side="left", padx=5)
+
+        self.root.bind("<Control-z>", lambda event: self.undo_last())
+        self.root.bind("<Control-y>", lambda event: self.redo_last())
+
+        #Pages of LEDGER_PAGE_SIZE rows, only the page on screen is fetched
+        self.prev_page_btn = ctk.CTkButton(bottom_frame, text="◀ Prev", width=70, height=35, fg_color="transparent", border_width=1, cursor="hand2",
+                                           command=lambda: self.change_ledger_page(-1))
+        self.prev_page_btn.pack(side="left", padx=(20, 5))
+
+        self.page_label = ctk.CTkLabel(bottom_frame, text="Page 1", font=("Segoe UI", 12), text_color="#bdc3c7")
+        self.page_label.pack(side="left", padx=5)
+
+        self.next_page_btn = ctk.CTkButton(bottom_frame, text="Next ▶", width=70, height=35, fg_color="transparent", border_width=1, cursor="hand2",
+                                           command=lambda: self.change_ledger_page(1))
+        self.next_page_btn.pack(side="left", padx=5)
+
         #He placeholder ma bt bayyin b bayyin mahala l hateto b show records and __init__ he bas just to be safe
         self.status_label = ctk.CTkLabel(bottom_frame, text="Loading...", font=("Consolas", 12, "bold"), text_color="#bdc3c7")
         self.status_label.pack(side="right")
@@ -596,10 +521,7 @@ class StoreApp:
         row_data = self.tree.item(selected_item)['values']
         clicked_id = row_data[0]
 
-        self.db.c.execute("SELECT parent_id FROM transactions WHERE id = ?", (clicked_id,))
-        result = self.db.c.fetchone()
-
-        if result and result[0]:
+        if self.db.get_parent_id(clicked_id):
             messagebox.showwarning(
                 "Locked Record",
                 "This is an auto-generated system record.\n\nTo change it, please go to the original branch and edit the source transaction"
@@ -608,21 +530,20 @@ class StoreApp:
 
         final_id = clicked_id
 
-        self.db.c.execute("SELECT * FROM transactions WHERE id = ?", (final_id,))
-        record = self.db.c.fetchone()
+        record = self.db.get_transaction(final_id)
+        if record is None:
+            messagebox.showwarning("Warning", "This record was deleted on another workstation")
+            self.view_records()
+            return
 
-        old_date = record[3]
-        old_cat = record[5]
-        old_amt = record[6]
-        old_type = record[4]
-        old_paym = record[8]
-        old_desc = record[9] if record[9] else ""
+        #Saved changes only apply if nobody else edited the record in the meantime
+        #(the version read with the record, a second read could already see someone else's edit)
+        self.dialogs.show("edit", "Edit Record", "350x500", self.build_edit_window,
+                          record_id=final_id, record=record, row_version=record[12])
 
-        edit_win = ctk.CTkToplevel(self.root)
-        edit_win.title("Edit Record")
-        edit_win.geometry("350x500")
-        edit_win.grab_set()
-        edit_win.focus()
+    def build_edit_window(self, edit_win):
+        #Record being edited, set by every refresh
+        state = {}
 
         ctk.CTkLabel(edit_win, text="Edit Transaction", font=("Roboto Medium", 18), text_color=self.colors["accent"]).pack(pady=(20, 10))
 
@@ -632,41 +553,56 @@ class StoreApp:
 
         ctk.CTkLabel(card, text="Date:", font=("Segoe UI", 12)).pack(pady=(15, 0))
         date_entry = DateEntry(card, width=15, background="#1f538d", foreground="white", borderwidth=0, date_pattern='yyyy-mm-dd')
-        date_entry.set_date(old_date)
         date_entry.pack(pady=(5, 10))
 
-        valid_categories = []
-        store = self.store_combo.get()
-        if old_type == "Income":
-                valid_categories = ["Sales", "Investment"]
-        else:
-            if store == "Main Vault":
-                valid_categories = self.main_category_list
-            elif store == "Eshop":
-                valid_categories = self.Eshop_category_list
-            else:
-                valid_categories = self.category_list
-
         ctk.CTkLabel(card, text="Category:", font=("Segoe UI", 12)).pack(pady=0)
 
-        cat_var = ctk.StringVar(value=old_cat)
-        cat_entry = ctk.CTkComboBox(card, values=valid_categories, variable=cat_var, state="readonly", width=200)
-        if old_cat == "Main":
-            cat_entry.configure(state="disabled")
-        else :
-            cat_entry.configure(state="readonly")
+        cat_var = ctk.StringVar()
+        cat_entry = ctk.CTkComboBox(card, values=[], variable=cat_var, state="readonly", width=200)
         cat_entry.pack(pady=(5, 10))
 
         ctk.CTkLabel(card, text="Description:", font=("Segoe UI", 12)).pack(pady=0)
         desc_entry = ctk.CTkEntry(card, width=200)
-        desc_entry.insert(0, old_desc)
         desc_entry.pack(pady=(5, 10))
 
         ctk.CTkLabel(card, text="Amount:", font=("Segoe UI", 12)).pack(pady=0)
         amt_entry = ctk.CTkEntry(card, width=200)
-        amt_entry.insert(0, str(old_amt))
         amt_entry.pack(pady=(5, 15))
 
+        def refresh(record_id, record, row_version):
+            state.update(record_id=record_id, row_version=row_version)
+
+            old_date = record[3]
+            old_cat = record[5]
+            old_amt = record[6]
+            old_type = record[4]
+            old_desc = record[9] if record[9] else ""
+
+            date_entry.set_date(old_date)
+
+            valid_categories = []
+            store = self.store_combo.get()
+            if old_type == "Income":
+                    valid_categories = ["Sales", "Investment"]
+            else:
+                if store == "Main Vault":
+                    valid_categories = self.main_category_list
+                elif store == "Eshop":
+                    valid_categories = self.Eshop_category_list
+                else:
+                    valid_categories = self.category_list
+
+            cat_entry.configure(values=valid_categories, state="readonly")
+            cat_var.set(old_cat)
+            if old_cat == "Main":
+                cat_entry.configure(state="disabled")
+
+            desc_entry.delete(0, tk.END)
+            desc_entry.insert(0, old_desc)
+
+            amt_entry.delete(0, tk.END)
+            amt_entry.insert(0, str(old_amt))
+
         def save_changes():
             try:
                 new_date = date_entry.get()
@@ -674,43 +610,29 @@ class StoreApp:
                 new_amt = float(amt_entry.get())
                 new_desc = desc_entry.get()
 
-                self.db.update_transaction_full(final_id, new_date, new_cat, new_amt, new_desc)
-
-                if old_type == "Income" and new_amt != old_amt:
-
-                    main_rate = self.db.get_rate("main_rate")
-                    tva_rate = self.db.get_rate("tva_rate")
-                    comm_rate = self.db.get_rate("comm_rate")
-
-                    val_main = round(new_amt * (main_rate / 100), 2)
-                    val_tva = round(new_amt * (tva_rate / 100), 2)
-
-                    self.db.update_smart_pair(final_id, "Main Vault", "Main", val_main)
-                    self.db.update_smart_pair(final_id, "TVA Account", "TVA", val_tva)
-
-                    if old_paym == "Card":
-                        val_comm = round(new_amt * (comm_rate / 100), 2)
-                        self.db.update_smart_pair(final_id, "Bank Commission", "Card Commission",val_comm)
-                    
-                elif old_type == "Expense" and old_cat == "Main" and new_amt != old_amt:
-                    self.db.update_smart_pair(final_id, "Main Vault", "from", new_amt)
+                #Every derived leg (TVA, Main, Commission, Freight, mirrors) follows its recorded rate, in the same transaction
+                self.db.update_transaction_full(state["record_id"], new_date, new_cat, new_amt, new_desc, expected_version=state["row_version"])
 
                 messagebox.showinfo("Success", "Record Updated!")
-                edit_win.destroy()
+                self.dialogs.hide("edit")
                 self.view_records()
             except ValueError:
                 messagebox.showerror("Error", "Amount must be a number")
+            except StaleRecordError:
+                messagebox.showwarning("Record Changed", "This record was changed or deleted on another workstation.\n\nThe ledger will be reloaded, please edit it again.", parent=edit_win)
+                self.dialogs.hide("edit")
+                self.view_records()
+            except ClosedPeriodError as e:
+                messagebox.showerror("Closed Year", str(e), parent=edit_win)
 
         ctk.CTkButton(edit_win, text="SAVE CHANGES", command=save_changes, fg_color=self.colors["success"], hover_color="#27ae60", font=("Segoe UI", 12, "bold"), height=40).pack(pady=20, padx=20, fill="x")
 
+        return refresh
+
     def open_settings_window(self):
-        # --- Window ---
-        top = ctk.CTkToplevel(self.root)
-        top.title("Configure Rates")
-        top.geometry("320x400")
-        top.grab_set()
-        top.focus()
+        self.dialogs.show("settings", "Configure Rates", "320x620", self.build_settings_window)
 
+    def build_settings_window(self, top):
         # --- Header ---
 
         ctk.CTkLabel(top, text="Update Tax Rates", font=("Roboto Medium", 18), 
@@ -725,9 +647,6 @@ class StoreApp:
             
             entry = ctk.CTkEntry(form_frame, width=100, justify="center")
             entry.grid(row=row, column=1, padx=15, pady=12)
-            
-            current_val = self.db.get_rate(key) 
-            entry.insert(0, str(current_val))
             return entry
 
         e_main = make_row(0, "Main Vault (%):", "main_rate")
@@ -736,6 +655,12 @@ class StoreApp:
         e_frgt = make_row(3, "Freight (%):", "freight_rate")
         e_exr = make_row(4, "Exchange Rate:", "exchange_rate")
 
+        #Rates are re-read on every open (another workstation may have changed them)
+        def refresh():
+            for entry, key in [(e_main, "main_rate"), (e_tva, "tva_rate"), (e_comm, "comm_rate"), (e_frgt, "freight_rate"), (e_exr, "exchange_rate")]:
+                entry.delete(0, tk.END)
+                entry.insert(0, str(self.db.get_rate(key)))
+
         def save():
             try:
                 self.db.update_rate("main_rate", float(e_main.get()))
@@ -745,23 +670,60 @@ class StoreApp:
                 self.db.update_rate("exchange_rate", float(e_exr.get()))
                 
                 messagebox.showinfo("Success", "Rates updated!", parent=top) 
-                top.destroy()
+                self.dialogs.hide("settings")
             except ValueError:
                 messagebox.showerror("Error", "Please enter valid numbers", parent=top)
 
         # --- Save Button ---
         save_btn = ctk.CTkButton(top, text="SAVE CHANGES", command=save, 
                              fg_color=self.colors["success"], hover_color="#27ae60", font=("Segoe UI", 12, "bold"), height=40)
-        save_btn.pack(pady=20, padx=20, fill="x")
+        save_btn.pack(pady=(20, 10), padx=20, fill="x")
+
+        # --- Re-derive past postings ---
+        range_frame = ctk.CTkFrame(top, fg_color=self.colors["card"], corner_radius=10)
+        range_frame.pack(padx=20, pady=10, fill="x")
+
+        ctk.CTkLabel(range_frame, text="Apply rates to past postings", font=("Segoe UI", 12, "bold")).grid(row=0, column=0, columnspan=2, padx=15, pady=(10, 5), sticky="w")
+
+        ctk.CTkLabel(range_frame, text="From:", font=("Segoe UI", 12)).grid(row=1, column=0, padx=15, pady=5, sticky="w")
+        range_from = DateEntry(range_frame, width=12, background="#1f538d", foreground="white", borderwidth=0, date_pattern='yyyy-mm-dd')
+        range_from.grid(row=1, column=1, padx=15, pady=5)
+
+        ctk.CTkLabel(range_frame, text="To:", font=("Segoe UI", 12)).grid(row=2, column=0, padx=15, pady=5, sticky="w")
+        range_to = DateEntry(range_frame, width=12, background="#1f538d", foreground="white", borderwidth=0, date_pattern='yyyy-mm-dd')
+        range_to.grid(row=2, column=1, padx=15, pady=(5, 10))
+
+        def rederive():
+            try:
+                rates = {
+                    "main": float(e_main.get()),
+                    "tva": float(e_tva.get()),
+                    "comm": float(e_comm.get()),
+                    "freight": float(e_frgt.get()),
+                }
+            except ValueError:
+                messagebox.showerror("Error", "Please enter valid numbers", parent=top)
+                return
+
+            start_date = range_from.get()
+            end_date = range_to.get()
+
+            if not messagebox.askyesno("Re-derive Legs", f"Recalculate every Main, TVA, Commission and Freight leg posted between {start_date} and {end_date} with these rates?", parent=top):
+                return
+
+            updated = self.db.rederive_legs(start_date, end_date, rates)
+            messagebox.showinfo("Success", f"{updated} derived legs recalculated!", parent=top)
+            self.view_records()
+
+        ctk.CTkButton(top, text="RE-DERIVE RANGE", command=rederive,
+                      fg_color=self.colors["accent"], hover_color="#154360", font=("Segoe UI", 12, "bold"), height=40).pack(pady=(10, 20), padx=20, fill="x")
+
+        return refresh
 
     def open_exchange_window(self):
-        # -- Popup Window ---
-        top = ctk.CTkToplevel(self.root)
-        top.title("Exchange currency")
-        top.geometry("400x550")
-        top.grab_set()
-        top.focus()
+        self.dialogs.show("exchange", "Exchange currency", "400x550", self.build_exchange_window)
 
+    def build_exchange_window(self, top):
         # --- Tabview ---
         tabview = ctk.CTkTabview(top, width=350, height=480, corner_radius=10, fg_color=self.colors["bg"],
                                  segmented_button_selected_color=self.colors["accent"],
@@ -786,7 +748,6 @@ class StoreApp:
 
         ctk.CTkLabel(tab_ce, text="Exchange Rate:", font=("Segoe UI", 12)).pack(anchor="w", pady=(0, 5), padx=20)
         rate_entry_ce = ctk.CTkEntry(tab_ce, width=300)
-        rate_entry_ce.insert(0, str(self.db.get_rate("exchange_rate")))
         rate_entry_ce.pack(fill="x", padx=20, pady=(0, 15))
 
         #Result Preview
@@ -885,35 +846,50 @@ class StoreApp:
                     cat_out = "Bank Transfer Out"
                     cat_in = "Bank Transfer In"
 
-                parent_id = self.db.add_transactions(
-                    store, today, "Expense", cat_out, amount, cur_out, paym_out, parent_id=None
-                )
+                #Both sides in one write, so one undo takes the whole exchange back
+                with self.db.write(f"{cat_out} {store}"):
+                    parent_id = self.db.add_transactions(
+                        store, today, "Expense", cat_out, amount, cur_out, paym_out, parent_id=None
+                    )
 
-                self.db.add_transactions(
-                    store, today, "Income", cat_in, converted_amt, cur_in, paym_in, parent_id=parent_id
-                )
+                    self.db.add_transactions(
+                        store, today, "Income", cat_in, converted_amt, cur_in, paym_in, parent_id=parent_id,
+                        leg_role="exchange" if action_type == "currency" else "transfer"
+                    )
 
                 messagebox.showinfo("Success", "Transaction Recorded successfully!", parent=top)
-                top.destroy()
+                self.dialogs.hide("exchange")
                 self.view_records()
             
             except ValueError:
                 messagebox.showerror("Error", "Please enter a valid number.", parent=top)
 
 
+        #Every open starts from empty amounts and the current rate, like a new window would
+        def refresh():
+            for entry in (amt_entry_ce, amt_entry_bt):
+                entry.delete(0, tk.END)
+            rate_entry_ce.delete(0, tk.END)
+            rate_entry_ce.insert(0, str(self.db.get_rate("exchange_rate")))
+            tabview.set("Currency Exchange")
+            update_preview()
+
         amt_entry_ce.bind("<KeyRelease>", update_preview)
         rate_entry_ce.bind("<KeyRelease>", update_preview)
         dir_combo_ce.configure(command=update_preview)
 
+        return refresh
+
     def open_balances_window(self):
-        top = ctk.CTkToplevel(self.root)
-        top.title("All Branch Balances")
-        top.geometry("750x600")
-        top.grab_set()
-        top.focus()
+        self.dialogs.show("balances", "All Branch Balances", "750x600", self.build_balances_window)
 
+    def build_balances_window(self, top):
         ctk.CTkLabel(top, text="Current Balance Sheet", font=("Roboto Medium", 20), 
-                 text_color=self.colors["accent"]).pack(pady=(20, 15))
+                 text_color=self.colors["accent"]).pack(pady=(20, 5))
+
+        #On the head office database: which branch databases were merged in and when (sync.py)
+        sync_label = ctk.CTkLabel(top, text="", font=("Segoe UI", 11), text_color="#bdc3c7")
+        sync_label.pack(pady=(0, 10))
         
         table_frame = ctk.CTkFrame(top, fg_color="transparent")
         table_frame.pack(fill="both", expand=True, padx=20, pady=(0, 20))
@@ -937,65 +913,227 @@ class StoreApp:
 
         tree.pack(fill="both", expand=True, side="left")
 
-        # DATA PROCESSING LOGIC
-        raw_data = self.db.get_balance_summary()
+        tree.tag_configure("total_row", background=self.colors["accent"], foreground="white", font=("Segoe UI", 11, "bold"))
 
-        branch_data = {}
-        all_stores = self.db.get_store_names()
+        #Only the rows are rebuilt on reopen
+        def refresh():
+            tree.delete(*tree.get_children())
+
+            own_site = site_id(self.db)
+            sites = [f"{name} ({synced_at[:16].replace('T', ' ')})" for site, name, _, synced_at in self.db.get_sync_sites() if site != own_site]
+            sync_label.configure(text=f"Includes: {', '.join(sites)}" if sites else "")
 
+            # DATA PROCESSING LOGIC
+            raw_data = self.db.get_balance_summary()
 
-        for store in all_stores:
-            branch_data[store] = {"USD ($)": {"Cash": 0, "Card": 0}, "Lira (LBP)": {"Cash": 0, "Card": 0}}
+            branch_data = {}
+            all_stores = self.db.get_store_names()
 
 
-        for row in raw_data:
-            store, curr, method, amount = row
-            if store in branch_data:
-                branch_data[store][curr][method] = amount
+            for store in all_stores:
+                branch_data[store] = {"USD ($)": {"Cash": 0, "Card": 0}, "Lira (LBP)": {"Cash": 0, "Card": 0}}
 
-        grand_totals = [0, 0, 0, 0]
 
-        for store in all_stores:
-            d = branch_data[store]
+            for row in raw_data:
+                store, curr, method, amount = row
+                if store in branch_data:
+                    branch_data[store][curr][method] = amount
+
+            grand_totals = [0, 0, 0, 0]
+
+            for store in all_stores:
+                d = branch_data[store]
             
-            usd_cash = d["USD ($)"]["Cash"]
-            usd_card = d["USD ($)"]["Card"]
-            lbp_cash = d["Lira (LBP)"]["Cash"]
-            lbp_card = d["Lira (LBP)"]["Card"]
+                usd_cash = d["USD ($)"]["Cash"]
+                usd_card = d["USD ($)"]["Card"]
+                lbp_cash = d["Lira (LBP)"]["Cash"]
+                lbp_card = d["Lira (LBP)"]["Card"]
 
 
-            grand_totals[0] += usd_cash
-            grand_totals[1] += usd_card
-            grand_totals[2] += lbp_cash
-            grand_totals[3] += lbp_card
+                grand_totals[0] += usd_cash
+                grand_totals[1] += usd_card
+                grand_totals[2] += lbp_cash
+                grand_totals[3] += lbp_card
 
 
-            values = (
-                store,
-                f"${usd_cash:,.2f}",
-                f"${usd_card:,.2f}",
-                f"{lbp_cash:,.0f} L.L",
-                f"{lbp_card:,.0f} L.L"
-            )
-            tree.insert("", "end", values=values)
-
-        tree.insert("", "end", values=("TOTALS:", 
-                                       f"${grand_totals[0]:,.2f}", 
-                                       f"${grand_totals[1]:,.2f}", 
-                                       f"{grand_totals[2]:,.0f} L.L", 
-                                       f"{grand_totals[3]:,.0f} L.L"), 
-                                       tags=("total_row",))
-        
+                values = (
+                    store,
+                    f"${usd_cash:,.2f}",
+                    f"${usd_card:,.2f}",
+                    f"{lbp_cash:,.0f} L.L",
+                    f"{lbp_card:,.0f} L.L"
+                )
+                tree.insert("", "end", values=values)
+
+            tree.insert("", "end", values=("TOTALS:", 
+                                           f"${grand_totals[0]:,.2f}", 
+                                           f"${grand_totals[1]:,.2f}", 
+                                           f"{grand_totals[2]:,.0f} L.L", 
+                                           f"{grand_totals[3]:,.0f} L.L"), 
+                                           tags=("total_row",))
+
+        return refresh
+
+    def open_diagnostics_window(self):
+        self.dialogs.show("diagnostics", "Query Diagnostics", "1000x650", self.build_diagnostics_window, modal=False)
+
+    def build_diagnostics_window(self, top):
+        ctk.CTkLabel(top, text="Query Timings", font=("Roboto Medium", 20),
+                 text_color=self.colors["accent"]).pack(pady=(20, 10))
+
+        table_frame = ctk.CTkFrame(top, fg_color="transparent")
+        table_frame.pack(fill="both", expand=True, padx=20)
+
+        cols = ("Query", "Calls", "Total ms", "Avg ms", "p95 ms", "Max ms")
+        tree = ttk.Treeview(table_frame, columns=cols, show="headings", selectmode="browse")
+
+        tree.heading("Query", text="Query")
+        tree.column("Query", width=520, anchor="w")
+
+        for col in cols[1:]:
+            tree.heading(col, text=col)
+            tree.column(col, width=90, anchor="e")
+
+        scrollbar = ctk.CTkScrollbar(table_frame, orientation="vertical", command=tree.yview)
+        scrollbar.pack(side="right", fill="y")
+        tree.configure(yscroll=scrollbar.set)
+        tree.pack(fill="both", expand=True, side="left")
+
+        ctk.CTkLabel(top, text=f"Slow queries (>= {self.db.stats.slow_ms:g} ms)", font=("Segoe UI", 12, "bold"), text_color="#bdc3c7").pack(anchor="w", padx=20, pady=(10, 0))
+
+        slow_box = ctk.CTkTextbox(top, height=150, font=("Consolas", 11))
+        slow_box.pack(fill="x", padx=20, pady=(5, 10))
+
+        btn_frame = ctk.CTkFrame(top, fg_color="transparent")
+        btn_frame.pack(fill="x", padx=20, pady=(0, 15))
+
+        #Pending live refresh, so reopening never starts a second loop
+        job = {"id": None}
+
+        def refresh():
+            if job["id"] is not None:
+                top.after_cancel(job["id"])
+                job["id"] = None
+
+            #Hidden: the loop stops, the next open starts it again
+            if not top.winfo_exists() or top.state() == "withdrawn":
+                return
+
+            stats, slow = self.db.get_query_stats()
+
+            selected = tree.selection()
+            selected_query = tree.item(selected[0])["values"][0] if selected else None
+
+            for row in tree.get_children():
+                tree.delete(row)
+
+            for entry in stats:
+                item = tree.insert("", "end", values=(entry["query"], entry["calls"], f"{entry['total_ms']:,.1f}",
+                                                      f"{entry['avg_ms']:.2f}", f"{entry['p95_ms']:.2f}", f"{entry['max_ms']:.2f}"))
+                if entry["query"] == selected_query:
+                    tree.selection_set(item)
+
+            slow_box.delete("1.0", "end")
+            for entry in reversed(slow):
+                slow_box.insert("end", f"[{entry['time']}] {entry['ms']:,.0f} ms  {entry['query']}\n")
+                for line in entry["plan"]:
+                    slow_box.insert("end", f"      {line}\n")
+
+            #Live view: refresh every second while the window is open
+            job["id"] = top.after(1000, refresh)
+
+        def reset():
+            self.db.reset_query_stats()
+
+        def rebuild_rollup():
+            if messagebox.askyesno("Rebuild Rollup", "Recompute the daily rollup from every transaction?\n\nThis is only needed after a repair or a manual import.", parent=top):
+                self.db.rebuild_rollup()
+                messagebox.showinfo("Success", "Daily rollup rebuilt!", parent=top)
+
+        ctk.CTkButton(btn_frame, text="Reset Stats", width=120, fg_color="transparent", border_width=1, cursor="hand2",
+                      command=reset).pack(side="right")
+
+        ctk.CTkButton(btn_frame, text="Rebuild Rollup", width=120, fg_color="transparent", border_width=1, cursor="hand2",
+                      command=rebuild_rollup).pack(side="right", padx=10)
+
+        ctk.CTkButton(btn_frame, text="Check Integrity", width=120, fg_color="transparent", border_width=1, cursor="hand2",
+                      command=self.open_integrity_window).pack(side="right")
+
+        return refresh
+
+    def open_integrity_window(self):
+        self.dialogs.show("integrity", "Ledger Integrity", "1000x600", self.build_integrity_window)
+
+    def build_integrity_window(self, top):
+        ctk.CTkLabel(top, text="Derived Leg Integrity", font=("Roboto Medium", 20),
+                 text_color=self.colors["accent"]).pack(pady=(20, 5))
+
+        summary_lbl = ctk.CTkLabel(top, text="Press Check to scan every derived-leg chain", font=("Segoe UI", 12), text_color="#bdc3c7")
+        summary_lbl.pack(pady=(0, 10))
+
+        table_frame = ctk.CTkFrame(top, fg_color="transparent")
+        table_frame.pack(fill="both", expand=True, padx=20)
+
+        cols = ("Check", "ID", "Parent", "Date", "Store", "Detail")
+        widths = (230, 80, 80, 90, 130, 330)
+        tree = ttk.Treeview(table_frame, columns=cols, show="headings", selectmode="browse")
+        for col, width in zip(cols, widths):
+            tree.heading(col, text=col)
+            tree.column(col, width=width, anchor="w")
+
+        scrollbar = ctk.CTkScrollbar(table_frame, orientation="vertical", command=tree.yview)
+        scrollbar.pack(side="right", fill="y")
+        tree.configure(yscroll=scrollbar.set)
+        tree.pack(fill="both", expand=True, side="left")
+
+        btn_frame = ctk.CTkFrame(top, fg_color="transparent")
+        btn_frame.pack(fill="x", padx=20, pady=15)
+
+        #The scan takes a few seconds on millions of rows, so it only runs on a Check click (not on every open)
+        def run_check():
+            top.configure(cursor="watch")
+            top.update_idletasks()
+            try:
+                report = self.db.check_integrity(limit=200)
+            finally:
+                top.configure(cursor="")
+
+            for row in tree.get_children():
+                tree.delete(row)
+
+            for kind, entry in report.items():
+                if not entry["count"]:
+                    continue
+                tree.insert("", "end", values=(f"{INTEGRITY_CHECKS[kind]} ({entry['count']:,})", "", "", "", "", ""), tags=("total_row",))
+                for row_id, parent_id, t_date, store, detail in entry["rows"]:
+                    tree.insert("", "end", values=("", row_id, parent_id or "", t_date, store or "", detail))
+
+            total = sum(entry["count"] for entry in report.values())
+            summary_lbl.configure(text="Every chain matches its rules and rates" if not total else
+                                  f"{total:,} problem(s) found, drifted amounts can be recalculated from their parent")
+
+        def fix_drift():
+            if messagebox.askyesno("Fix Amounts", "Recalculate every drifted leg from its parent amount and recorded rate?", parent=top):
+                updated = self.db.fix_leg_drift()
+                messagebox.showinfo("Success", f"{updated:,} legs recalculated.", parent=top)
+                run_check()
+                self.view_records()
+
         tree.tag_configure("total_row", background=self.colors["accent"], foreground="white", font=("Segoe UI", 11, "bold"))
 
+        ctk.CTkButton(btn_frame, text="Fix Amounts", width=120, fg_color="transparent", border_width=1, cursor="hand2",
+                      command=fix_drift).pack(side="right")
+
+        ctk.CTkButton(btn_frame, text="Check", width=120, cursor="hand2",
+                      command=run_check).pack(side="right", padx=10)
+
+        #Re-showing the dialog keeps the last report
+        return lambda: None
+
     def open_daily_reconciliation_window(self):
-        # 1. Window Setup
-        top = ctk.CTkToplevel(self.root)
-        top.title("Daily Reconciliation")
-        top.geometry("1100x700") 
-        top.grab_set()
-        top.focus()
+        self.dialogs.show("recon", "Daily Reconciliation", "1100x700", self.build_reconciliation_window)
 
+    def build_reconciliation_window(self, top):
         # --- Section 1: Header (Setup & Target) ---
         header_frame = ctk.CTkFrame(top, fg_color=self.colors["header"], height=120, corner_radius=0)
         header_frame.pack(fill="x")
@@ -1006,14 +1144,14 @@ class StoreApp:
 
         ctk.CTkLabel(setup_frame, text="Branch:", font=("Segoe UI", 12, "bold"), text_color="#bdc3c7").grid(row=0, column=0, sticky="w")
 
-        self.recon_branch = ctk.CTkComboBox(setup_frame, values=self.db.get_store_names(), state="readonly", width=150)
-        self.recon_branch.set(self.db.get_store_names()[0])
+        self.recon_branch = ctk.CTkComboBox(setup_frame, values=[], state="readonly", width=150)
         self.recon_branch.grid(row=0, column=1, padx=10)
 
         ctk.CTkLabel(setup_frame, text="Date:", font=("Segoe UI", 12, "bold"), text_color="#bdc3c7").grid(row=1, column=0, sticky="w", pady=(10,0))
 
         self.recon_date = DateEntry(setup_frame, width=15, background="#1f538d", foreground='white', borderwidth=0, font=("Segoe UI", 12), date_pattern='yyyy-mm-dd')
         self.recon_date.grid(row=1, column=1, padx=10, pady=(10,0), ipady=5)
+        self.recon_date.bind("<<DateEntrySelected>>", self.recalc_sales_difference)
 
         # --- THE NEW BUTTONS SECTION ---
         btn_frame = ctk.CTkFrame(header_frame, fg_color="transparent")
@@ -1027,6 +1165,10 @@ class StoreApp:
         ctk.CTkButton(btn_frame, text="💾 Save Target", fg_color="#27ae60", hover_color="#219a52", font=("Segoe UI", 12, "bold"), width=120,
                   command=self.save_daily_sales_target).pack(pady=5)
 
+        # Catching up on several days / branches
+        ctk.CTkButton(btn_frame, text="🗂 Bulk Mode", fg_color="#8e44ad", hover_color="#9b59b6", font=("Segoe UI", 12, "bold"), width=120,
+                  command=self.open_bulk_reconciliation_window).pack(pady=5)
+
 
         # Right Side: The Target Input
         target_frame = ctk.CTkFrame(header_frame, fg_color="transparent")
@@ -1052,8 +1194,8 @@ class StoreApp:
         self.footfall_entry = ctk.CTkEntry(target_frame, placeholder_text="e.g. 120", width=120, font=("Segoe UI", 12))
         self.footfall_entry.grid(row=1, column=2, padx=10, pady=(0, 10), sticky="w")
         
-        # Bind to recalculate
-        self.target_entry.bind("<KeyRelease>", self.recalc_sales_difference)
+        # Bind to recalculate (only the target changed)
+        self.target_entry.bind("<KeyRelease>", lambda event: self.on_recon_target_key())
 
         # --- Section 2: The Envelopes (The Count) ---
         envelopes_container = ctk.CTkFrame(top, fg_color="transparent")
@@ -1061,6 +1203,7 @@ class StoreApp:
 
         # FIX 2: Create the dictionary that your logic is looking for
         self.recon_inputs = {"env1": {}, "env2": {}}
+        self.recon_render_job = None
 
         def build_envelope_grid(parent, title, key):
             frame = ctk.CTkFrame(parent, fg_color=self.colors["card"], corner_radius=15)
@@ -1084,8 +1227,8 @@ class StoreApp:
                 entry = ctk.CTkEntry(frame, font=("Segoe UI", 12), width=180, justify="right", placeholder_text="0.00")
                 entry.grid(row=i+2, column=1, pady=10, padx=10)
                 
-                # FIX 3: Bind to the correct function name
-                entry.bind("<KeyRelease>", self.recalc_sales_difference)
+                # FIX 3: Only the cell that changed is re-parsed
+                entry.bind("<KeyRelease>", lambda event, env=key, tag=tag: self.on_recon_cell_key(env, tag))
 
                 # Store the widget so your logic can find it!
                 self.recon_inputs[key][tag] = entry
@@ -1118,6 +1261,214 @@ class StoreApp:
                                            command=self.submit_sale)
         self.btn_recon_confirm.pack(anchor="e")
 
+        return self.reset_reconciliation
+
+    #Every open starts a new count: today, empty envelopes, confirm disabled until something is typed
+    def reset_reconciliation(self):
+        stores = self.db.get_store_names()
+        self.recon_branch.configure(values=stores)
+        if self.recon_branch.get() not in stores:
+            self.recon_branch.set(stores[0])
+
+        self.recon_date.set_date(datetime.now())
+
+        for entry in [self.target_entry, self.receipts_entry, self.footfall_entry] + [e for tags in self.recon_inputs.values() for e in tags.values()]:
+            entry.delete(0, tk.END)
+
+        if self.recon_render_job is not None:
+            self.root.after_cancel(self.recon_render_job)
+            self.recon_render_job = None
+
+        #The rate of the recon date is read once per load, keystrokes never hit SQLite
+        self.recon_model = ReconModel(self.db.get_rate_on(self.recon_date.get()))
+        self.recon_rendered = None
+
+        self.apply_tax_var.set(1)
+        self.lbl_total_counted.configure(text="Total Counted: 0 LBP")
+        self.lbl_difference.configure(text="Difference: 0 LBP", text_color="white")
+        self.btn_recon_confirm.configure(state="disabled", fg_color="#7f8c8d")
+
+    def open_bulk_reconciliation_window(self):
+        self.dialogs.show("bulk_recon", "Bulk Reconciliation", "1300x750", self.build_bulk_reconciliation_window)
+
+    def build_bulk_reconciliation_window(self, top):
+        # --- Header: range + actions ---
+        header_frame = ctk.CTkFrame(top, fg_color=self.colors["header"], corner_radius=0)
+        header_frame.pack(fill="x")
+
+        ctk.CTkLabel(header_frame, text="From:", font=("Segoe UI", 12, "bold"), text_color="#bdc3c7").pack(side="left", padx=(20, 5), pady=20)
+        bulk_from = DateEntry(header_frame, width=12, background="#1f538d", foreground='white', borderwidth=0, font=("Segoe UI", 12), date_pattern='yyyy-mm-dd')
+        bulk_from.pack(side="left", padx=5, ipady=4)
+
+        ctk.CTkLabel(header_frame, text="To:", font=("Segoe UI", 12, "bold"), text_color="#bdc3c7").pack(side="left", padx=(15, 5))
+        bulk_to = DateEntry(header_frame, width=12, background="#1f538d", foreground='white', borderwidth=0, font=("Segoe UI", 12), date_pattern='yyyy-mm-dd')
+        bulk_to.pack(side="left", padx=5, ipady=4)
+
+        apply_main_var = ctk.IntVar(value=1)
+
+        grid_frame = ctk.CTkScrollableFrame(top, fg_color=self.colors["card"])
+        grid_frame.pack(fill="both", expand=True, padx=20, pady=20)
+
+        money_cols = [
+            ("USD Cash", "USD ($)", "Cash"),
+            ("USD Card", "USD ($)", "Card"),
+            ("LBP Cash", "Lira (LBP)", "Cash"),
+            ("LBP Card", "Lira (LBP)", "Card"),
+        ]
+        headers = ["Branch", "Date", "Target (LBP)", "Receipts", "Footfall"] + [col[0] for col in money_cols] + ["Difference", "Post"]
+
+        #Rate of every day of the loaded range (filled by load_grid)
+        rates = {}
+        grid_rows = []
+
+        def update_row(row):
+            target = parse_amount(row["target"].get())
+            rate = rates[row["date"]]
+            counted = 0.0
+            for (label, curr, method), entry in zip(money_cols, row["money"]):
+                value = parse_amount(entry.get())
+                counted += value * rate if curr == "USD ($)" else value
+
+            difference = target - counted
+            color = "#27ae60" if abs(difference) < 100000 else "#c0392b"
+            row["diff"].configure(text=f"{difference:,.0f}", text_color=color)
+
+        def load_grid():
+            for widget in grid_frame.winfo_children():
+                widget.destroy()
+            grid_rows.clear()
+
+            start = bulk_from.get_date()
+            end = bulk_to.get_date()
+            if end < start:
+                messagebox.showerror("Error", "The end date is before the start date", parent=top)
+                return
+            if (end - start).days > 31:
+                messagebox.showwarning("Warning", "Please pick a range of 31 days or less", parent=top)
+                return
+
+            store_names = self.db.get_store_names()
+            branches = [b for b in self.physical_branches if b in store_names]
+            start_date = start.strftime("%Y-%m-%d")
+            end_date = end.strftime("%Y-%m-%d")
+
+            #All targets and metrics of the range in one query
+            saved = self.db.get_daily_targets_range(branches, start_date, end_date)
+            rates.clear()
+            rates.update(self.db.get_rates_range(start_date, end_date))
+
+            for col, text in enumerate(headers):
+                ctk.CTkLabel(grid_frame, text=text, font=("Segoe UI", 11, "bold"), text_color="#7f8c8d").grid(row=0, column=col, padx=4, pady=(5, 10))
+
+            grid_row = 1
+            for offset in range((end - start).days + 1):
+                t_date = (start + timedelta(days=offset)).strftime("%Y-%m-%d")
+
+                for branch in branches:
+                    target, receipts, footfall = saved.get((branch, t_date), (0, None, None))
+
+                    ctk.CTkLabel(grid_frame, text=branch, font=("Segoe UI", 11)).grid(row=grid_row, column=0, padx=4, sticky="w")
+                    ctk.CTkLabel(grid_frame, text=t_date, font=("Segoe UI", 11)).grid(row=grid_row, column=1, padx=4)
+
+                    row = {"branch": branch, "date": t_date}
+
+                    for col, (key, value, width) in enumerate([("target", f"{target:.0f}" if target else "", 110),
+                                                                ("receipts", "" if receipts is None else str(receipts), 70),
+                                                                ("footfall", "" if footfall is None else str(footfall), 70)], start=2):
+                        entry = ctk.CTkEntry(grid_frame, width=width, justify="right")
+                        if value:
+                            entry.insert(0, value)
+                        entry.grid(row=grid_row, column=col, padx=3, pady=3)
+                        row[key] = entry
+
+                    row["money"] = []
+                    for col in range(len(money_cols)):
+                        entry = ctk.CTkEntry(grid_frame, width=100, justify="right", placeholder_text="0.00")
+                        entry.grid(row=grid_row, column=5 + col, padx=3, pady=3)
+                        row["money"].append(entry)
+
+                    row["diff"] = ctk.CTkLabel(grid_frame, text="", font=("Consolas", 12, "bold"), width=110, anchor="e")
+                    row["diff"].grid(row=grid_row, column=9, padx=4)
+
+                    row["accept"] = ctk.IntVar(value=0)
+                    ctk.CTkCheckBox(grid_frame, text="", variable=row["accept"], width=24).grid(row=grid_row, column=10, padx=4)
+
+                    for entry in [row["target"]] + row["money"]:
+                        entry.bind("<KeyRelease>", lambda event, r=row: update_row(r))
+
+                    update_row(row)
+                    grid_rows.append(row)
+                    grid_row += 1
+
+        def post_accepted():
+            days = []
+            try:
+                for row in grid_rows:
+                    if not row["accept"].get():
+                        continue
+
+                    amounts = []
+                    for (label, curr, method), entry in zip(money_cols, row["money"]):
+                        value = entry.get().replace(",", "").strip()
+                        if value and float(value) > 0:
+                            amounts.append((curr, method, float(value)))
+
+                    receipts = row["receipts"].get().strip()
+                    footfall = row["footfall"].get().strip()
+
+                    days.append({
+                        "branch": row["branch"],
+                        "date": row["date"],
+                        "target": parse_amount(row["target"].get()),
+                        "receipts": int(receipts) if receipts else None,
+                        "footfall": int(footfall) if footfall else None,
+                        "amounts": amounts,
+                    })
+            except ValueError:
+                messagebox.showerror("Error", "Amounts must be numbers, receipts and footfall whole numbers", parent=top)
+                return
+
+            if not days:
+                messagebox.showwarning("Warning", "Tick the days you want to post first.", parent=top)
+                return
+
+            sales_count = sum(len(day["amounts"]) for day in days)
+            if not messagebox.askyesno("Confirm", f"Post {len(days)} branch-days ({sales_count} sales records)?", parent=top):
+                return
+
+            #One atomic write for everything, nothing is posted if any of it fails
+            try:
+                self.db.post_daily_batch(days, apply_main=apply_main_var.get() == 1)
+            except Exception as e:
+                messagebox.showerror("Error", f"Nothing was posted: {e}", parent=top)
+                return
+
+            messagebox.showinfo("Success", f"Posted {sales_count} sales records over {len(days)} branch-days!", parent=top)
+
+            for row in grid_rows:
+                if row["accept"].get():
+                    row["accept"].set(0)
+                    for entry in row["money"]:
+                        entry.delete(0, "end")
+                    update_row(row)
+
+            self.view_records()
+
+        ctk.CTkButton(header_frame, text="📥 Load Range", fg_color="#34495e", hover_color="#2c3e50", font=("Segoe UI", 12, "bold"), width=130,
+                      command=load_grid).pack(side="left", padx=20)
+
+        ctk.CTkButton(header_frame, text="POST ACCEPTED", fg_color="#27ae60", hover_color="#219a52", font=("Segoe UI", 13, "bold"), width=180, height=40,
+                      command=post_accepted).pack(side="right", padx=20)
+
+        ctk.CTkCheckBox(header_frame, text="Apply Main Taxes", variable=apply_main_var, font=("Segoe UI", 12)).pack(side="right", padx=10)
+
+        #Reopening keeps the range, a loaded grid is read again (targets may have been saved since, unposted amounts are dropped)
+        def refresh():
+            if grid_rows:
+                load_grid()
+
+        return refresh
+
     def load_daily_sales(self):
         branch_name = self.recon_branch.get()
         date = self.recon_date.get()
@@ -1186,35 +1537,52 @@ class StoreApp:
         except ValueError:
             messagebox.showerror("Error", "Invalid Number")
 
+    def on_recon_cell_key(self, env, tag):
+        if self.recon_model.set_cell(env, tag, self.recon_inputs[env][tag].get()):
+            self.schedule_recon_render()
+
+    def on_recon_target_key(self):
+        if self.recon_model.set_target(self.target_entry.get()):
+            self.schedule_recon_render()
+
+    #Fast typing only costs one render per frame
+    def schedule_recon_render(self):
+        if self.recon_render_job is None:
+            self.recon_render_job = self.root.after(16, self.render_recon)
+
+    #Full refresh: re-read every widget (after loading or saving a target, or picking another date)
     def recalc_sales_difference(self, event=None):
-        def get_val(entry_widget):
-            try:
-                val = entry_widget.get()
-                if not val: return 0.0
-                return float(val.replace(",", ""))
-            except ValueError:
-                return 0.0
+        self.recon_model.rate = self.db.get_rate_on(self.recon_date.get())
+        self.recon_model.set_target(self.target_entry.get())
 
-        real_amount = get_val(self.target_entry)
+        for env, tags in self.recon_inputs.items():
+            for tag, entry in tags.items():
+                self.recon_model.set_cell(env, tag, entry.get())
 
-        entered_amount = 0
-        rate = self.db.get_rate("exchange_rate")
+        self.render_recon()
 
-        for i in range(1,3):
-            usd_cash = get_val(self.recon_inputs[f"env{i}"]["usd_cash"])
-            LBP_cash = get_val(self.recon_inputs[f"env{i}"]["lbp_cash"])
-            usd_card = get_val(self.recon_inputs[f"env{i}"]["usd_card"])
-            LBP_card = get_val(self.recon_inputs[f"env{i}"]["lbp_card"])
-            total_env = LBP_cash + LBP_card + ((usd_cash + usd_card) * rate)
-            entered_amount += total_env
+    def render_recon(self):
+        self.recon_render_job = None
 
-        self.lbl_total_counted.configure(text=f"Total Counted: {entered_amount:,.0f} L.L")
+        #The window may have been closed while a render was pending
+        if not self.lbl_difference.winfo_exists():
+            return
+
+        entered_amount = self.recon_model.counted()
+        difference = self.recon_model.difference()
+        matched = abs(difference) < 100000
 
-        difference = real_amount - entered_amount
+        #Widgets are only reconfigured when what they show changes
+        rendered = (round(entered_amount), round(difference), matched)
+        if rendered == self.recon_rendered:
+            return
+        self.recon_rendered = rendered
+
+        self.lbl_total_counted.configure(text=f"Total Counted: {entered_amount:,.0f} L.L")
 
         self.lbl_difference.configure(text=f"Difference: {difference:,.0f} L.L")
 
-        if abs(difference) < 100000:
+        if matched:
             self.lbl_difference.configure(text_color="#27ae60")
             self.btn_recon_confirm.configure(state="normal", fg_color="#27ae60", hover_color="#27ae60")
         else :
@@ -1238,9 +1606,7 @@ class StoreApp:
 
         saved_count = 0
         
-        main_rate = self.db.get_rate("main_rate")
-        tva_rate = self.db.get_rate("tva_rate")
-        comm_rate = self.db.get_rate("comm_rate")
+        rates = self.db.get_posting_rates()
         apply_main = self.apply_tax_var.get()
 
         money_types = [
@@ -1250,40 +1616,33 @@ class StoreApp:
             ("lbp_card", "Lira (LBP)", "Card")
         ]
 
-        for i in range(1, 3):
-            env_key = f"env{i}"
-            
-            for key, curr, method in money_types:
-                try:
-                    widget = self.recon_inputs[env_key][key]
-                    val_str = widget.get().replace(",", "")
-                    
-                    if not val_str: continue
-                    
-                    amount = float(val_str)
-                    if amount <= 0: continue
+        #Every envelope line in one write: a single undo takes the whole submission back
+        try:
+            with self.db.write(f"Sales of {branch} {date}"):
+                for i in range(1, 3):
+                    env_key = f"env{i}"
 
+                    for key, curr, method in money_types:
+                        try:
+                            widget = self.recon_inputs[env_key][key]
+                            val_str = widget.get().replace(",", "")
 
-                    main_id = self.db.add_transactions(branch, date, "Income", "Sales", amount, curr, method)
-                    
-                    val_tva = round(amount * (tva_rate / 100), 2)
-                    self.db.add_transactions(branch, date, "Expense", f"TVA ({tva_rate:g}%)", val_tva, curr, method, parent_id=main_id)
-                    self.db.add_transactions("TVA Account", date, "Income", f"from {branch}", val_tva, curr, method, parent_id=main_id)
+                            if not val_str: continue
 
-                    if apply_main == 1:
-                        val_main = round(amount * (main_rate / 100), 2)
-                        self.db.add_transactions(branch, date, "Expense", f"Main ({main_rate:g}%)", val_main, curr, method, parent_id=main_id)
-                        self.db.add_transactions("Main Vault", date, "Income", f"from {branch}", val_main, curr, method, parent_id=main_id)
+                            amount = float(val_str)
+                            if amount <= 0: continue
 
-                    if method == "Card":
-                        val_comm = round(amount * (comm_rate / 100), 2)
-                        self.db.add_transactions(branch, date, "Expense", f"Card Commission ({comm_rate:g}%)", val_comm, curr, method, parent_id=main_id)
-                        self.db.add_transactions("Bank Commission", date, "Income", f"from {branch}", val_comm, curr, method, parent_id=main_id)
 
-                    saved_count += 1
+                            self.db.post_transaction(branch, date, "Income", "Sales", amount, curr, method,
+                                                     apply_main=apply_main == 1, rates=rates)
 
-                except ValueError:
-                    continue
+                            saved_count += 1
+
+                        except ValueError:
+                            continue
+        except ClosedPeriodError as e:
+            messagebox.showerror("Closed Year", str(e))
+            return
 
         if saved_count > 0:
             messagebox.showinfo("Success", f"Posted {saved_count} sales records!")
@@ -1292,11 +1651,11 @@ class StoreApp:
             messagebox.showwarning("Warning", "No amounts were entered.")
 
     def open_analytics_window(self):
-        # 1. Create the Window
-        dash_win = ctk.CTkToplevel(self.root)
-        dash_win.title("📊 Physical Retail Analytics")
-        dash_win.geometry("950x700")
-        dash_win.grab_set() # Forces user to focus on this window
+        self.dialogs.show("analytics", "📊 Physical Retail Analytics", "1100x750", self.build_analytics_window)
+
+    def build_analytics_window(self, dash_win):
+        # Report or comparison on screen (redrawn on reopen, from the cache unless the data changed)
+        self.analytics_view = None
 
         # ==========================================
         # TOP BAR: Filters & Controls
@@ -1327,6 +1686,17 @@ class StoreApp:
                                      foreground='white', borderwidth=2, date_pattern='yyyy-mm-dd')
         self.analytics_end.pack(side="left", padx=(0, 20), ipady=4)
 
+        # Granularity (Auto picks the finest one that fits the chart)
+        ctk.CTkLabel(filter_frame, text="View:", font=("Segoe UI", 12, "bold")).pack(side="left", padx=(0, 10))
+        self.analytics_granularity = ctk.CTkComboBox(
+            filter_frame,
+            values=["Auto", "Day", "Week", "Month", "Year"],
+            state="readonly",
+            width=90
+        )
+        self.analytics_granularity.pack(side="left", padx=(0, 20))
+        self.analytics_granularity.set("Auto")
+
         # Generate Button
         generate_btn = ctk.CTkButton(
             filter_frame, 
@@ -1338,6 +1708,17 @@ class StoreApp:
         )
         generate_btn.pack(side="right")
 
+        # Compare Button (every physical branch side by side)
+        compare_btn = ctk.CTkButton(
+            filter_frame,
+            text="Compare Branches",
+            font=("Segoe UI", 12, "bold"),
+            fg_color="#8e44ad",
+            hover_color="#9b59b6",
+            command=self.generate_branch_comparison
+        )
+        compare_btn.pack(side="right", padx=(0, 10))
+
         # ==========================================
         # MIDDLE ROW: KPI Cards
         # ==========================================
@@ -1378,8 +1759,15 @@ class StoreApp:
         self.graph_placeholder = ctk.CTkLabel(self.graph_frame, text="Select a date range and click Generate Report.", text_color="gray")
         self.graph_placeholder.pack(expand=True)
 
+        def refresh():
+            if self.analytics_view is not None:
+                self.analytics_view()
+
+        return refresh
+
 
     def generate_analytics(self):
+        self.analytics_view = self.generate_analytics
         try:
             # 1. Grab user inputs
             branch = self.analytics_branch.get()
@@ -1388,95 +1776,31 @@ class StoreApp:
             start_date = self.analytics_start.get_date().strftime('%Y-%m-%d')
             end_date = self.analytics_end.get_date().strftime('%Y-%m-%d')
 
-            # 2. Extract Data using Pandas directly from your SQLite connection
-            query = "SELECT * FROM daily_metrics"
-            df = pd.read_sql_query(query, self.db.conn)
-
-            # If database is totally empty, stop here
-            if df.empty:
-                self.kpi_footfall.configure(text="0")
-                self.kpi_conversion.configure(text="0.0%")
-                return
-
-            # 3. Filter by Date Range
-            df['date'] = pd.to_datetime(df['date'])
-            mask = (df['date'] >= start_date) & (df['date'] <= end_date)
-            df = df.loc[mask]
+            # 2. Figures from the daily rollup, bucketed by SQL (one row per day/week/month/year)
+            wanted = self.analytics_granularity.get().lower()
+            branches = self.physical_branches if branch == "All Physical Stores" else [branch]
 
-            # 4. Filter by Physical Branches
-            if branch == "All Physical Stores":
-                df = df[df['branch'].isin(self.physical_branches)]
-            else:
-                df = df[df['branch'] == branch]
+            # Served from the cache until the sales, metrics or rate change
+            granularity, rows, totals = self.analytics_cache.get(
+                ["report", branch, start_date, end_date, wanted],
+                lambda: branch_report(self.db, branches, start_date, end_date, wanted, mirror=self.refreshed_mirror()))
 
-            # ==========================================
-            # 5. Calculate KPIs (Including ATV)
-            # ==========================================
-            total_footfall = int(df['footfall'].sum()) if not df.empty else 0
-            total_receipts = int(df['receipts'].sum()) if not df.empty else 0
+            period_label = "Daily" if granularity == "day" else f"{granularity.capitalize()}ly"
+            if wanted != "auto" and granularity != wanted:
+                print(f"Analytics: too many {wanted}s in range, showing by {granularity}")
 
-            # Conversion Rate
-            if total_footfall > 0:
-                conv_rate = (total_receipts / total_footfall) * 100
-            else:
-                conv_rate = 0.0
-
-            # Average Transaction Value (ATV)
-            # Grab the revenue from your sales table
-            # Average Transaction Value (ATV)
-            try:
-                sales_query = "SELECT * FROM daily_sales" 
-                sales_df = pd.read_sql_query(sales_query, self.db.conn)
-                
-                if not sales_df.empty:
-                    sales_df['date'] = pd.to_datetime(sales_df['date'])
-                    sales_mask = (sales_df['date'] >= start_date) & (sales_df['date'] <= end_date)
-                    sales_df = sales_df.loc[sales_mask]
-                    
-                    # ==========================================
-                    # --- NEW: Dynamic ID Mapping ---
-                    # ==========================================
-                    stores_df = pd.read_sql_query("SELECT * FROM stores", self.db.conn)
-                    
-                    id_col = 'store_id' if 'store_id' in stores_df.columns else 'id'
-                    dynamic_store_map = dict(zip(stores_df['name'], stores_df[id_col]))
-                    
-                    if branch == "All Physical Stores":
-                        physical_ids = [dynamic_store_map[b] for b in self.physical_branches if b in dynamic_store_map]
-                        sales_df = sales_df[sales_df['store_id'].isin(physical_ids)]
-                    else:
-                        if branch in dynamic_store_map:
-                            real_id = dynamic_store_map[branch]
-                            sales_df = sales_df[sales_df['store_id'] == real_id]
-                        else:
-                            sales_df = pd.DataFrame() 
-                    # ==========================================
-                        
-                    total_revenue = sales_df['amount'].sum() 
-                    
-                    if total_receipts > 0:
-                        atv = total_revenue / total_receipts
-                    else:
-                        atv = 0
-                else:
-                    atv = 0
-            except Exception as e:
-                print(f"Could not calculate ATV: {e}")
-                atv = 0
+            df = pd.DataFrame(rows, columns=["date", "amount", "receipts", "footfall", "index_usd"])
+            df['date'] = pd.to_datetime(df['date'])
 
             # ==========================================
             # 6. Update the UI Cards
             # ==========================================
-            self.kpi_footfall.configure(text=f"{total_footfall:,}")
-            self.kpi_conversion.configure(text=f"{conv_rate:.1f}%")
-            
-            # --- NEW: Convert ATV to USD ---
-            exchange_rate = self.db.get_rate("exchange_rate") # Current market rate (update this if the rate changes)
-            
-            if atv > 0:
-                atv_usd = atv / exchange_rate
-                # Display with a dollar sign and 2 decimal places for cents (e.g., $37.89)
-                self.kpi_atv.configure(text=f"${atv_usd:,.2f}")
+            self.kpi_footfall.configure(text=f"{totals['footfall']:,}")
+            self.kpi_conversion.configure(text=f"{totals['conversion']:.1f}%")
+
+            # ATV in USD, with 2 decimal places for cents (e.g., $37.89)
+            if totals['atv_usd'] > 0:
+                self.kpi_atv.configure(text=f"${totals['atv_usd']:,.2f}")
             else:
                 self.kpi_atv.configure(text="--")
 
@@ -1484,8 +1808,10 @@ class StoreApp:
             # 7. DRAW THE GRAPH
             # ==========================================
             
-            # Group data by date (Crucial for "All Stores" so it sums the traffic for each day)
-            daily_data = df.groupby('date')[['footfall', 'receipts']].sum().reset_index()
+            # Already one row per period (the rollup query sums the branches)
+            daily_data = df
+            annotate = len(daily_data) <= ANNOTATE_MAX_POINTS
+            marker_size = 6 if annotate else 3
 
             # Destroy the placeholder text or old graph if it exists
             for widget in self.graph_frame.winfo_children():
@@ -1498,33 +1824,26 @@ class StoreApp:
 
             if not daily_data.empty:
                 # Plot the lines
-                ax.plot(daily_data['date'], daily_data['footfall'], marker='o', color='#3498db', label='Footfall', linewidth=2)
-                ax.plot(daily_data['date'], daily_data['receipts'], marker='s', color='#2ecc71', label='Receipts', linewidth=2)
-
-                # --- NEW: Add exact values on top of the points ---
-                # Label Footfall points (Blue)
-                for index, row in daily_data.iterrows():
-                    ax.annotate(f"{int(row['footfall'])}", 
-                                (row['date'], row['footfall']), 
-                                textcoords="offset points", 
-                                xytext=(0, 8), # Push the text 8 pixels UP from the dot
-                                ha='center', color='#3498db', fontsize=9, fontweight='bold')
-                    
-                # Label Receipts points (Green)
-                for index, row in daily_data.iterrows():
-                    ax.annotate(f"{int(row['receipts'])}", 
-                                (row['date'], row['receipts']), 
-                                textcoords="offset points", 
-                                xytext=(0, 8), 
-                                ha='center', color='#2ecc71', fontsize=9, fontweight='bold')
-                # --------------------------------------------------
+                ax.plot(daily_data['date'], daily_data['footfall'], marker='o', markersize=marker_size, color='#3498db', label='Footfall', linewidth=2)
+                ax.plot(daily_data['date'], daily_data['receipts'], marker='s', markersize=marker_size, color='#2ecc71', label='Receipts', linewidth=2)
+
+                # Exact values on top of the points (only when there are few enough to read)
+                if annotate:
+                    for column, color in (('footfall', '#3498db'), ('receipts', '#2ecc71')):
+                        for x, y in zip(daily_data['date'], daily_data[column]):
+                            ax.annotate(f"{int(y)}",
+                                        (x, y),
+                                        textcoords="offset points",
+                                        xytext=(0, 8), # Push the text 8 pixels UP from the dot
+                                        ha='center', color=color, fontsize=9, fontweight='bold')
 
                 # Style the axes and text for dark mode
                 ax.tick_params(colors='white')
                 for spine in ax.spines.values():
                     spine.set_color('#7f8c8d')
                 
-                ax.set_title(f"Traffic vs. Receipts: {branch}", color='white', pad=10)
+                ax.xaxis.set_major_formatter(mdates.DateFormatter(DATE_FORMATS[granularity]))
+                ax.set_title(f"{period_label} Traffic vs. Receipts: {branch}", color='white', pad=10)
                 ax.legend(facecolor='#2b2b2b', edgecolor='#7f8c8d', labelcolor='white')
                 
                 # Auto-rotate the dates on the bottom so they don't overlap
@@ -1539,27 +1858,10 @@ class StoreApp:
             canvas.get_tk_widget().pack(fill="both", expand=True)
 
             # ==========================================
-            # 7. Calculate Daily Index Data
+            # 7. Index Data: (Revenue / Exchange Rate) / Footfall, computed by branch_report
             # ==========================================
             try:
-                # Group data by date
-                daily_traffic = df.groupby('date')[['footfall', 'receipts']].sum().reset_index()
-                
-                # Group sales if they exist, otherwise create empty table
-                if not sales_df.empty:
-                    daily_revenue = sales_df.groupby('date')['amount'].sum().reset_index()
-                else:
-                    daily_revenue = pd.DataFrame(columns=['date', 'amount'])
-
-                # Merge the two tables together by date
-                merged_daily = pd.merge(daily_traffic, daily_revenue, on='date', how='left')
-                merged_daily['amount'] = merged_daily['amount'].fillna(0)
-
-                # Calculate Index: (Revenue / Exchange Rate) / Footfall
-                merged_daily['index_usd'] = merged_daily.apply(
-                    lambda row: (row['amount'] / exchange_rate) / row['footfall'] if row['footfall'] > 0 else 0, 
-                    axis=1
-                )
+                merged_daily = df
 
                 # ==========================================
                 # 8. Render the Index Column Graph
@@ -1569,13 +1871,15 @@ class StoreApp:
                 ax_index.set_facecolor('#2b2b2b')
 
                 # Draw the bars (Gold color) and save them to a variable
-                bars = ax_index.bar(merged_daily['date'], merged_daily['index_usd'], color='#f1c40f', width=0.6)
+                bars = ax_index.bar(merged_daily['date'], merged_daily['index_usd'], color='#f1c40f', width=BAR_WIDTH_DAYS[granularity])
                 
-                # --- NEW: Auto-label the exact USD values on top of the bars ---
-                ax_index.bar_label(bars, fmt='$%.2f', padding=4, color='white', fontsize=9, fontweight='bold')
+                # Exact USD values on top of the bars (only when there are few enough to read)
+                if annotate:
+                    ax_index.bar_label(bars, fmt='$%.2f', padding=4, color='white', fontsize=9, fontweight='bold')
                 
                 # Style the graph
-                ax_index.set_title(f'Daily Index (USD per Visitor): {branch}', color='white', fontsize=12)
+                ax_index.xaxis.set_major_formatter(mdates.DateFormatter(DATE_FORMATS[granularity]))
+                ax_index.set_title(f'{period_label} Index (USD per Visitor): {branch}', color='white', fontsize=12)
                 ax_index.tick_params(axis='x', colors='white', rotation=45)
                 ax_index.tick_params(axis='y', colors='white')
                 ax_index.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, loc: f"${x:,.2f}"))
@@ -1590,6 +1894,9 @@ class StoreApp:
                 canvas_index = FigureCanvasTkAgg(fig_index, master=self.graph_frame) 
                 canvas_index.draw()
                 canvas_index.get_tk_widget().pack(fill="both", expand=True, pady=(20, 0))
+
+                # pyplot keeps every figure it made until closed (the canvas keeps its own reference)
+                plt.close(fig_index)
                 
             except Exception as e:
                 print(f"Could not render Index graph: {e}")
@@ -1597,6 +1904,85 @@ class StoreApp:
         except Exception as e:
             print(f"Analytics Error: {e}")
 
+    def generate_branch_comparison(self):
+        self.analytics_view = self.generate_branch_comparison
+        try:
+            start_date = self.analytics_start.get_date().strftime('%Y-%m-%d')
+            end_date = self.analytics_end.get_date().strftime('%Y-%m-%d')
+
+            # One grouped query for every branch (no report per branch)
+            wanted = self.analytics_granularity.get().lower()
+            granularity, ranking, series = self.analytics_cache.get(
+                ["compare", start_date, end_date, wanted],
+                lambda: compare_branches(self.db, self.physical_branches, start_date, end_date, wanted, mirror=self.refreshed_mirror()))
+
+            # KPI cards show the whole network
+            total_sales_usd = sum(row["sales_usd"] for row in ranking)
+            total_receipts = sum(row["receipts"] for row in ranking)
+            total_footfall = sum(row["footfall"] for row in ranking)
+
+            self.kpi_footfall.configure(text=f"{total_footfall:,}")
+            self.kpi_conversion.configure(text=f"{(total_receipts / total_footfall * 100) if total_footfall > 0 else 0:.1f}%")
+            self.kpi_atv.configure(text=f"${total_sales_usd / total_receipts:,.2f}" if total_receipts > 0 else "--")
+
+            for widget in self.graph_frame.winfo_children():
+                widget.destroy()
+
+            if not ranking:
+                ctk.CTkLabel(self.graph_frame, text="No Data Found for this Range", text_color="gray").pack(expand=True)
+                return
+
+            # ==========================================
+            # Ranked table (best USD per visitor first)
+            # ==========================================
+            cols = ("Rank", "Branch", "Sales (USD)", "Receipts", "Footfall", "Conversion", "ATV (USD)", "Index (USD)")
+            table = ttk.Treeview(self.graph_frame, columns=cols, show="headings", height=len(ranking), selectmode="none")
+            for col in cols:
+                table.heading(col, text=col)
+                table.column(col, width=160 if col == "Branch" else 100, anchor="w" if col == "Branch" else "e")
+
+            for rank, row in enumerate(ranking, start=1):
+                table.insert("", "end", values=(rank, row["branch"], f"${row['sales_usd']:,.0f}", f"{row['receipts']:,}",
+                                                f"{row['footfall']:,}", f"{row['conversion']:.1f}%", f"${row['atv_usd']:,.2f}", f"${row['index_usd']:,.2f}"))
+            table.pack(fill="x", pady=(0, 20))
+
+            # ==========================================
+            # Small multiples: one index chart per branch, same scale
+            # ==========================================
+            n_cols = min(3, len(ranking))
+            n_rows = -(-len(ranking) // n_cols)
+            fig, axes = plt.subplots(n_rows, n_cols, figsize=(10, 2.6 * n_rows), facecolor='#2b2b2b', sharey=True, squeeze=False)
+            period_label = "Daily" if granularity == "day" else f"{granularity.capitalize()}ly"
+
+            for ax in axes.flat:
+                ax.set_visible(False)
+
+            for ax, row in zip(axes.flat, ranking):
+                points = series[row["branch"]]
+                dates = pd.to_datetime([period for period, _ in points])
+
+                ax.set_visible(True)
+                ax.set_facecolor('#2b2b2b')
+                ax.bar(dates, [k["index_usd"] for _, k in points], color='#f1c40f', width=BAR_WIDTH_DAYS[granularity])
+                ax.set_title(f"{row['branch']}  (${row['index_usd']:,.2f})", color='white', fontsize=10)
+                ax.xaxis.set_major_formatter(mdates.DateFormatter(DATE_FORMATS[granularity]))
+                ax.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=4))
+                ax.tick_params(colors='white', labelsize=8)
+                ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, loc: f"${x:,.0f}"))
+                for spine in ax.spines.values():
+                    spine.set_color('#555555')
+
+            fig.suptitle(f"{period_label} Index (USD per Visitor) by Branch", color='white', fontsize=12)
+            fig.tight_layout()
+
+            canvas = FigureCanvasTkAgg(fig, master=self.graph_frame)
+            canvas.draw()
+            canvas.get_tk_widget().pack(fill="both", expand=True)
+            plt.close(fig)
+
+        except Exception as e:
+            print(f"Comparison Error: {e}")
+
     def toggle_category_state(self, choice=None):
         current_type = self.type_combo.get()
         current_store = self.store_combo.get()
@@ -1648,11 +2034,46 @@ class StoreApp:
             row_data = self.tree.item(selected_item)['values']
             record_id = row_data[0]
 
-            self.db.delete_smart_chain(record_id)
+            try:
+                self.db.delete_smart_chain(record_id)
+            except StaleRecordError:
+                messagebox.showwarning("Warning", "This record was already deleted on another workstation")
+                self.view_records()
+                return
+            except ClosedPeriodError as e:
+                messagebox.showerror("Closed Year", str(e))
+                return
 
             self.view_records()
             messagebox.showinfo("Succes", "Record and linked taxes deleted")
 
+    def undo_last(self):
+        self.replay_last(self.db.undo, "Undo")
+
+    def redo_last(self):
+        self.replay_last(self.db.redo, "Redo")
+
+    def replay_last(self, step, title):
+        try:
+            label = step()
+        except StaleRecordError as e:
+            messagebox.showwarning(title, f"{e}\n\nIt was edited after this change.")
+            return
+        except ClosedPeriodError as e:
+            messagebox.showerror("Closed Year", str(e))
+            return
+
+        if label is None:
+            messagebox.showinfo(title, f"Nothing to {title.lower()}.")
+            return
+        self.view_records()
+
+    #The buttons say what the next undo / redo would take back
+    def update_undo_buttons(self):
+        undo, redo = self.db.get_undo_labels()
+        self.undo_btn.configure(state="normal" if undo else "disabled", text=f"↶ Undo {undo[:UNDO_LABEL_CHARS]}" if undo else "↶ Undo")
+        self.redo_btn.configure(state="normal" if redo else "disabled", text=f"↷ Redo {redo[:UNDO_LABEL_CHARS]}" if redo else "↷ Redo")
+
     def add_records(self):
         store = self.store_combo.get()
         t_type = self.type_combo.get()
@@ -1674,37 +2095,9 @@ class StoreApp:
             val = float(amt)
             today = date_val
 
-            main_id = self.db.add_transactions(store, today, t_type, cat, val, cur, paym, parent_id = None, description=desc)
-
-            if cat == "Cost of goods" and t_type == "Expense":
-                freight_rate = self.db.get_rate("freight_rate")
-                self.db.add_transactions("Cost of goods", today, "Income", f"from {store}", val, cur, paym, parent_id = main_id)
-                amt_freight = round(val * (freight_rate / 100), 2)
-                self.db.add_transactions(store, today, "Expense", "Freight", amt_freight, cur, paym, parent_id = main_id)
-                self.db.add_transactions("Freight", today, "Income", f"from {store}", amt_freight, cur, paym, parent_id = main_id)
-
-            if cat == "Main" and t_type == "Expense" :
-                self.db.add_transactions("Main Vault", today, "Income", f"from {store}", val, cur, paym, parent_id = main_id)
-
-            if t_type == "Income" and cat == "Sales":
-                main_rate = self.db.get_rate("main_rate")
-                tva_rate = self.db.get_rate("tva_rate")
-                card_rate = self.db.get_rate("comm_rate")
-                main_skip = self.no_main_var.get()
-
-                if main_skip == 0:
-                    amount_main = round(val * (main_rate / 100), 2)
-                    self.db.add_transactions(store, today, "Expense", f"Main ({main_rate:g}%)", amount_main, cur, paym, parent_id = main_id)
-                    self.db.add_transactions("Main Vault", today, "Income", f"from {store}", amount_main, cur, paym, parent_id = main_id)
-
-                amount_tva = round(val * (tva_rate / 100), 2)
-                self.db.add_transactions(store, today, "Expense", f"TVA ({tva_rate:g}%)", amount_tva, cur, paym, parent_id = main_id)
-                self.db.add_transactions("TVA Account", today, "Income", f"from {store}", amount_tva, cur, paym, parent_id = main_id)
-
-                if paym == "Card":
-                    amount_card = round(val * (card_rate / 100), 2)
-                    self.db.add_transactions(store, today, "Expense", f"Card Commission ({card_rate:g}%)", amount_card, cur, paym, parent_id = main_id)
-                    self.db.add_transactions("Bank Commission", today, "Income", f"from {store}", amount_card, cur, paym, parent_id = main_id)
+            #Derived legs (Main, TVA, Commission, Freight...) come from the posting rules in database.py
+            self.db.post_transaction(store, today, t_type, cat, val, cur, paym, description=desc,
+                                     apply_main=self.no_main_var.get() == 0)
 
             messagebox.showinfo("Succes", "Transaction Saved!")
 
@@ -1718,17 +2111,14 @@ class StoreApp:
             self.view_records()
         except ValueError:
             messagebox.showerror("Error", "Amount must be a number")
+        except ClosedPeriodError as e:
+            messagebox.showerror("Closed Year", str(e))
 
     
     #Important for tree display, and filters
     def view_records(self):
         store_name = self.store_combo.get()
 
-        for row in self.tree.get_children():
-            self.tree.delete(row)
-
-        rows = self.db.get_transactions(store_name)
-
         f_type = self.filter_type.get()
         f_cat = self.filter_cat.get()
         f_curr = self.filter_curr.get()
@@ -1736,103 +2126,120 @@ class StoreApp:
         start_date = self.date_from.get()
         end_date = self.date_to.get()
 
-        total_usd_cash = 0
-        total_usd_card = 0
-        total_lbp_cash = 0
-        total_lbp_card = 0
+        #The range is compared as day numbers in SQL, a half typed date is refused here
+        try:
+            for text in (start_date, end_date):
+                if text:
+                    datetime.strptime(text, "%Y-%m-%d")
+        except ValueError:
+            messagebox.showerror("Error", "Dates must be yyyy-mm-dd.")
+            return
 
-        self.tree.tag_configure("oddrow", background="#2b2b2b", foreground="white")
-        self.tree.tag_configure("evenrow", background="#383838", foreground="white")
+        #Kept for the page / sort changes and the export, so they always match what the totals show
+        self.ledger_query = (store_name, f_type, f_cat, f_curr, f_paym, start_date, end_date, store_name in self.system_accounts)
+        self.ledger_page = 0
+        self.load_ledger_page()
 
-        count = 0
+        #Totals are summed by SQL (from the daily rollup when no category filter is set)
+        totals = self.ledger_cache.totals(self.ledger_query)
 
-        self.current_data = []
+        total_usd_cash = totals.get(("USD ($)", "Cash"), (0, 0))[0] or 0
+        total_usd_card = totals.get(("USD ($)", "Card"), (0, 0))[0] or 0
+        total_lbp_cash = totals.get(("Lira (LBP)", "Cash"), (0, 0))[0] or 0
+        total_lbp_card = totals.get(("Lira (LBP)", "Card"), (0, 0))[0] or 0
 
-        for row in rows:
-            t_type = row[2]
-            categ = row[3]
-            date = row[1]
-            curr = row[5]
-            paym = row[6]
+        report = f"USD Cash: ${total_usd_cash:,.2f} | USD Card ${total_usd_card:,.2f}\n LBP Cash: {total_lbp_cash:,.0f} L.L | LBP Card: {total_lbp_card:,.0f} L.L"
+        self.status_label.configure(text=report)
 
-            if f_type != "All" and t_type != f_type:
-                continue
+        #LBP amounts are converted at the rate of their own day (see get_ledger_totals)
+        grand_total_usd = sum(total_usd or 0 for _, total_usd in totals.values())
+        self.grand_total_label.configure(text=f"Grand Total: ${grand_total_usd:,.2f}")
+        self.update_undo_buttons()
+        self.schedule_prefetch()
+
+    #Once the window is idle, the most used branches are loaded with the filters on screen
+    #(category reset the way a branch switch resets it), one branch per idle slot
+    def schedule_prefetch(self):
+        if self.prefetch_job is not None:
+            self.root.after_cancel(self.prefetch_job)
+            self.prefetch_job = None
+        if PREFETCH_BRANCHES <= 0 or self.ledger_query is None:
+            return
 
-            if start_date and date < start_date:
-                continue
+        store_name, f_type, _, f_curr, f_paym, start_date, end_date, _ = self.ledger_query
+        queries = []
+        for store in self.ledger_cache.most_used(PREFETCH_BRANCHES + 1):
+            if store != store_name and len(queries) < PREFETCH_BRANCHES:
+                f_cat = self.category_filter_values(store, f_type)[0][0]
+                queries.append((store, f_type, f_cat, f_curr, f_paym, start_date, end_date, store in self.system_accounts))
+
+        def step():
+            self.prefetch_job = None
+            while queries:
+                if self.ledger_cache.prefetch(queries.pop(0), self.ledger_sort, self.ledger_desc):
+                    self.prefetch_job = self.root.after_idle(step)
+                    return
 
-            if end_date and date > end_date:
-                continue
+        if queries:
+            self.prefetch_job = self.root.after(PREFETCH_DELAY_MS, step)
 
-            if f_curr != "All" and curr != f_curr:
-                continue
+    #Filtering, sorting and paging happen in SQL, system accounts also match their "from {branch}" incomes
+    #One extra row is fetched to know if there is a next page (no count over the whole branch)
+    #Pages already seen with the same filters and data come from the ledger cache
+    def load_ledger_page(self):
+        rows = self.ledger_cache.page(self.ledger_query, self.ledger_sort, self.ledger_desc, self.ledger_page)
+        has_next = len(rows) > LEDGER_PAGE_SIZE
 
-            if f_paym != "All" and paym != f_paym:
-                continue
+        self.tree.delete(*self.tree.get_children())
 
-            if f_cat != "All" and f_cat.strip() != "":
-                
-                if f_cat == "Exchange In/Out":
-                    if categ not in ["Exchange In", "Exchange Out"]:
-                        continue
-                        
-                elif f_cat == "Bank Transfer In/Out":
-                    if categ not in ["Bank Transfer Out", "Bank Transfer In"]:
-                        continue        
-                else:
-                    is_fuzzy_match = f_cat.lower() in categ.lower()
-                    
-                    is_from_match = (store_name in self.system_accounts) and (categ == f"from {f_cat}")
-                    
-                    if not (is_fuzzy_match or is_from_match):
-                        continue
+        self.tree.tag_configure("oddrow", background="#2b2b2b", foreground="white")
+        self.tree.tag_configure("evenrow", background="#383838", foreground="white")
 
-            
+        for count, row in enumerate(rows[:LEDGER_PAGE_SIZE]):
+            if count % 2 == 0:
+                self.tree.insert("", "end", values=row, tags=("evenrow",))
+            else:
+                self.tree.insert("", "end", values=row, tags=("oddrow",))
 
-            self.current_data.append(row)
-            if count < 300:
-                if count % 2 == 0:
-                    self.tree.insert("", "end", values=row, tags=("evenrow",))
-                else:
-                    self.tree.insert("", "end", values=row, tags=("oddrow",))
-            
-            count += 1
+        self.page_label.configure(text=f"Page {self.ledger_page + 1}")
+        self.prev_page_btn.configure(state="normal" if self.ledger_page > 0 else "disabled")
+        self.next_page_btn.configure(state="normal" if has_next else "disabled")
 
-            try:
-                amount = float(row[4])
-                curr = row[5]
-                paym = row[6]
-
-                if curr == "USD ($)":
-                    if paym == "Cash":
-                        if t_type == "Income" : total_usd_cash += amount
-                        else : total_usd_cash -= amount
-                    elif paym == "Card":
-                        if t_type == "Income" : total_usd_card += amount
-                        else : total_usd_card -= amount
-                elif curr == "Lira (LBP)":
-                    if paym == "Cash":
-                        if t_type == "Income" : total_lbp_cash += amount
-                        else : total_lbp_cash -= amount
-                    elif paym == "Card":
-                        if t_type == "Income" : total_lbp_card += amount
-                        else : total_lbp_card -= amount
-            except ValueError:
-                pass
+    def change_ledger_page(self, step):
+        if self.ledger_query is None or self.ledger_page + step < 0:
+            return
+        self.ledger_page += step
+        self.load_ledger_page()
 
+    #Same column again flips the direction, a new column starts descending for dates/amounts and ascending for text
+    def sort_ledger(self, key):
+        if key == self.ledger_sort:
+            self.ledger_desc = not self.ledger_desc
+        else:
+            self.ledger_sort = key
+            self.ledger_desc = key in ("date", "amount")
 
-        report = f"USD Cash: ${total_usd_cash:,.2f} | USD Card ${total_usd_card:,.2f}\n LBP Cash: {total_lbp_cash:,.0f} L.L | LBP Card: {total_lbp_card:,.0f} L.L"
-        self.status_label.configure(text=report)
-        current_rate = self.db.get_rate("exchange_rate")
+        self.update_sort_headings()
+        if self.ledger_query is not None:
+            self.ledger_page = 0
+            self.load_ledger_page()
 
-        grand_total_usd = total_usd_cash + (total_lbp_cash / current_rate) + total_usd_card + (total_lbp_card / current_rate) if current_rate > 0 else 0
-        self.grand_total_label.configure(text=f"Grand Total: ${grand_total_usd:,.2f}")
+    def update_sort_headings(self):
+        for col, key in HEADING_SORTS.items():
+            arrow = (" ▼" if self.ledger_desc else " ▲") if key == self.ledger_sort else ""
+            self.tree.heading(col, text=col + arrow)
 
 
     def update_filter_dropdown(self, event=None):
-        current_store = self.store_combo.get()
-        f_type = self.filter_type.get()
+        new_values, combo_state = self.category_filter_values(self.store_combo.get(), self.filter_type.get())
+
+        self.filter_cat.configure(values=new_values, state=combo_state)
+        self.filter_cat.set(new_values[0])
+
+        self.view_records()
 
+    #Category filter choices of a branch for a type filter, and if the combo can be typed in
+    def category_filter_values(self, current_store, f_type):
         new_values = ["All"]
 
         extra_filters = ["Exchange In/Out", "Bank Transfer In/Out"]
@@ -1875,10 +2282,7 @@ class StoreApp:
                 else:
                     new_values += self.category_list + ["Sales", "Investment"] + extra_filters
 
-        self.filter_cat.configure(values=new_values, state=combo_state)
-        self.filter_cat.set(new_values[0])
-
-        self.view_records()
+        return new_values, combo_state
     
     def export_to_excel(self):
         filename = filedialog.asksaveasfilename(
@@ -1891,8 +2295,8 @@ class StoreApp:
         if not filename:
             return
         
-        store_name = self.store_combo.get()
-        rows = self.current_data
+        #Every row of the current filters and sort, not only the page on screen
+        rows = self.db.get_ledger_rows(*self.ledger_query, sort=self.ledger_sort, descending=self.ledger_desc) if self.ledger_query else []
 
         if not rows:
             messagebox.showwarning("Warning", "No data to export")
@@ -1941,7 +2345,23 @@ class StoreApp:
 
 
 if __name__ == "__main__":
+    #Opt-in UI profiling: python main.py --profile (or STORE_PROFILE=1), threshold with STORE_PROFILE_MS
+    profiler = None
+    if "--profile" in sys.argv or os.environ.get("STORE_PROFILE"):
+        from uiprofile import UIProfiler
+        profiler = UIProfiler(threshold_ms=float(os.environ.get("STORE_PROFILE_MS", 100)))
+        profiler.install()
+
     root = ctk.CTk()
-    app = StoreApp(root)
+
+    if profiler:
+        with profiler.measure("StoreApp.__init__"):
+            app = StoreApp(root)
+    else:
+        app = StoreApp(root)
+
     root.mainloop()
+
+    if profiler:
+        profiler.dump()
     
\ No newline at end of file
@@ -0,0 +1,181 @@
+import re
+import time
+from collections import deque
+
+#Latency buckets (upper bounds in ms) for the per query histograms
+BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000, float("inf")]
+
+#Statements slower than this are logged with their EXPLAIN QUERY PLAN
+SLOW_QUERY_MS = 100
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES_RE = re.compile(r"\s+")
+
+
+#Turns a statement into its "shape" so queries that only differ by values are grouped together
+def query_shape(sql):
+    shape = _STRING_RE.sub("?", sql)
+    shape = _NUMBER_RE.sub("?", shape)
+    shape = _IN_LIST_RE.sub("(?, ...)", shape)
+    return _SPACES_RE.sub(" ", shape).strip()
+
+
+class QueryStats:
+    def __init__(self, slow_ms=SLOW_QUERY_MS, keep_slow=50):
+        self.slow_ms = slow_ms
+        self.shapes = {}
+        self.slow_queries = deque(maxlen=keep_slow)
+        self._shape_cache = {}
+
+    def shape_of(self, sql):
+        shape = self._shape_cache.get(sql)
+        if shape is None:
+            shape = query_shape(sql)
+            if len(self._shape_cache) < 5000:
+                self._shape_cache[sql] = shape
+        return shape
+
+    def record(self, shape, elapsed_ms):
+        entry = self.shapes.get(shape)
+        if entry is None:
+            entry = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "buckets": [0] * len(BUCKETS_MS)}
+            self.shapes[shape] = entry
+
+        entry["calls"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+        for i, bound in enumerate(BUCKETS_MS):
+            if elapsed_ms <= bound:
+                entry["buckets"][i] += 1
+                break
+
+    def log_slow(self, shape, elapsed_ms, plan):
+        self.slow_queries.append({"time": time.strftime("%H:%M:%S"), "ms": round(elapsed_ms, 1), "query": shape, "plan": plan})
+        print(f"Slow query ({elapsed_ms:,.0f} ms): {shape}")
+        for line in plan:
+            print(f"    {line}")
+
+    #Upper bound of the bucket holding the given percentile
+    @staticmethod
+    def percentile(entry, pct):
+        target = entry["calls"] * pct / 100
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, entry["buckets"]):
+            seen += count
+            if seen >= target:
+                return min(bound, entry["max_ms"])
+        return entry["max_ms"]
+
+    #One dict per query shape, slowest (total time) first
+    def snapshot(self):
+        rows = []
+        for shape, entry in self.shapes.items():
+            rows.append({
+                "query": shape,
+                "calls": entry["calls"],
+                "total_ms": round(entry["total_ms"], 2),
+                "avg_ms": round(entry["total_ms"] / entry["calls"], 3),
+                "p95_ms": round(self.percentile(entry, 95), 3),
+                "max_ms": round(entry["max_ms"], 3),
+                "histogram": dict(zip([f"<={b:g}ms" for b in BUCKETS_MS], entry["buckets"])),
+            })
+        rows.sort(key=lambda row: row["total_ms"], reverse=True)
+        return rows
+
+    def reset(self):
+        self.shapes.clear()
+        self.slow_queries.clear()
+
+
+#Drop-in wrapper around a sqlite3 cursor that times every statement
+#SQLite steps lazily, so the fetch time is added to the statement that produced the rows
+class InstrumentedCursor:
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._cursor = conn.cursor()
+        self.stats = stats
+        self._pending = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _start(self, sql, params, many):
+        self._finish()
+        self._pending = [self.stats.shape_of(sql), sql, params, many, 0.0]
+
+    def _add(self, started):
+        if self._pending is not None:
+            self._pending[4] += (time.perf_counter() - started) * 1000
+
+    def _finish(self):
+        if self._pending is None:
+            return
+
+        shape, sql, params, many, elapsed_ms = self._pending
+        self._pending = None
+        self.stats.record(shape, elapsed_ms)
+
+        if elapsed_ms >= self.stats.slow_ms:
+            self.stats.log_slow(shape, elapsed_ms, [] if many else self.explain(sql, params))
+
+    def explain(self, sql, params=()):
+        try:
+            plan = self._conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            return [row[-1] for row in plan]
+        except Exception as e:
+            return [f"(no plan: {e})"]
+
+    def execute(self, sql, params=()):
+        self._start(sql, params, many=False)
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(sql, params)
+        finally:
+            self._add(started)
+        #Statements without a result set are done already
+        if self._cursor.description is None:
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._start(sql, (), many=True)
+        started = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, seq_of_params)
+        finally:
+            self._add(started)
+            self._finish()
+        return self
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._add(started)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._add(started)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._add(started)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
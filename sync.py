@@ -0,0 +1,359 @@
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import sys
+import time
+import urllib.request
+from datetime import datetime
+
+from database import DatabaseManager, JOURNAL_TABLES
+
+#Branch databases -> head office database, from the change journal (see write() in database.py)
+#A site's changeset is every journal row after the last sequence the head office merged, its site id is a
+#random number kept in its settings (see site_id). The first changeset of a site is a snapshot of its rows (older rows were
+#never journaled), later ones only carry what changed: a few hundred bytes per posting once gzipped
+#
+#Merging is idempotent: the head office keeps the last sequence merged per site in sync_sites, a changeset
+#that was already merged is skipped and one that would leave a gap is refused. Site transaction ids are
+#mapped to head office ids in sync_ids (every site counts from 1), stores are matched by name
+#
+#Not in the journal, so not synced: bulk loads (datagen) after the snapshot and the year archiving.
+#Archive years on the head office itself, its balances keep every row
+#
+#Usage: python sync.py --db store.db export [--dir outbox] [--name "Tripoli"]
+#       python sync.py --db head_office.db merge outbox/*.json.gz
+#       python sync.py --db store.db push --url http://head-office:8765 [--token secret]
+#       python sync.py --db head_office.db status
+
+FORMAT = 1
+SNAPSHOT_ROWS = 50_000
+
+
+#Made on the first sync, so branch databases copied from one file before that each get their own
+#(a copy made after its first sync has to delete the sync_site_id setting). A database that already synced
+#under its epoch, which was the site id before, keeps it so the head office still knows it
+def site_id(db):
+    db.c.execute("SELECT value FROM settings WHERE key = 'sync_site_id'")
+    row = db.c.fetchone()
+    if row:
+        return int(row[0])
+
+    epoch = db.get_data_versions([])[0]
+    with db.write(journal=False):
+        db.c.execute("SELECT count(*) FROM sync_sites WHERE site_id = ?", (epoch,))
+        site = epoch if db.c.fetchone()[0] else random.getrandbits(48)
+        db.c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('sync_site_id', ?)", (site,))
+        db.c.execute("SELECT value FROM settings WHERE key = 'sync_site_id'")
+        return int(db.c.fetchone()[0])
+
+
+#Name given at the first export (--name), the machine name otherwise
+def site_name(db):
+    db.c.execute("SELECT name FROM sync_sites WHERE site_id = ?", (site_id(db),))
+    row = db.c.fetchone()
+    return row[0] if row and row[0] else platform.node()
+
+
+#Last change of the site merged here (or exported, for our own site id), None when it never synced
+def sync_position(db, site):
+    db.c.execute("SELECT last_seq FROM sync_sites WHERE site_id = ?", (site,))
+    row = db.c.fetchone()
+    return row[0] if row else None
+
+
+#{"site_id", "site_name", "snapshot", "from_seq", "to_seq", "columns", "stores", "changes": [[seq, table, op, image], ...]}
+#op is "I" / "U" (image = the row after) or "D" (image = the row before, only its key is used)
+#after_seq None makes a snapshot: every row as an insert at the journal position it was read at
+def build_changeset(db, after_seq, name=None):
+    db.c.execute("SELECT id, name FROM stores")
+    stores = dict(db.c.fetchall())
+
+    #One read transaction, so the snapshot and the journal position it ends at match
+    #(a caller that already has one open keeps it, and its work is not committed here)
+    own_transaction = not db.conn.in_transaction
+    if own_transaction:
+        db.c.execute("BEGIN")
+    try:
+        db.c.execute("SELECT IFNULL(MAX(id), 0) FROM journal")
+        to_seq = db.c.fetchone()[0]
+
+        changes = []
+        if after_seq is None:
+            for table, (_, columns) in JOURNAL_TABLES.items():
+                #Parents before their legs (lower ids), so the merge can map parent_id as it goes
+                db.c.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {', '.join(JOURNAL_TABLES[table][0])}")
+                while True:
+                    rows = db.c.fetchmany(SNAPSHOT_ROWS)
+                    if not rows:
+                        break
+                    changes.extend([to_seq, table, "I", list(row)] for row in rows)
+        else:
+            db.c.execute("SELECT id, tbl, op, old, new FROM journal WHERE id > ? AND id <= ? ORDER BY id", (after_seq, to_seq))
+            changes = [[seq, table, op, json.loads(old if op == "D" else new)] for seq, table, op, old, new in db.c.fetchall()]
+    finally:
+        if own_transaction:
+            db.conn.commit()
+
+    return {"format": FORMAT, "site_id": site_id(db), "site_name": name or site_name(db),
+            "snapshot": after_seq is None, "from_seq": after_seq or 0, "to_seq": to_seq, "created_at": datetime.now().isoformat(timespec="seconds"),
+            "columns": {table: columns for table, (_, columns) in JOURNAL_TABLES.items()},
+            "stores": stores, "changes": changes}
+
+
+def pack(changeset):
+    return gzip.compress(json.dumps(changeset, separators=(",", ":")).encode("utf-8"))
+
+
+def unpack(data):
+    changeset = json.loads(gzip.decompress(data) if data[:2] == b"\x1f\x8b" else data)
+    if changeset.get("format") != FORMAT:
+        raise ValueError(f"Unknown changeset format: {changeset.get('format')}")
+    return changeset
+
+
+def write_changeset(changeset, directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"sync_{changeset['site_id']}_{changeset['from_seq']:010d}-{changeset['to_seq']:010d}.json.gz")
+    with open(path + ".tmp", "wb") as file:
+        file.write(pack(changeset))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def read_changeset(path):
+    with open(path, "rb") as file:
+        return unpack(file.read())
+
+
+#Merges one site's changeset into this database in a single transaction: (rows applied, rows skipped)
+#Changes at or below what was already merged from the site are skipped, a changeset starting after it is refused
+#A snapshot is always applied whole (its rows are upserts), that is how a site is sent again with --snapshot
+def merge_changeset(db, changeset):
+    site = changeset["site_id"]
+    if site == site_id(db):
+        raise ValueError("This changeset comes from this database")
+
+    started = time.perf_counter()
+    applied = skipped = 0
+
+    with db.write(journal=False):
+        position = sync_position(db, site)
+        if not changeset["snapshot"] and changeset["from_seq"] > (position or 0):
+            raise ValueError(f"Changes {(position or 0) + 1}..{changeset['from_seq']} of site {changeset['site_name']} are missing, "
+                             f"merge or export them first")
+
+        store_ids = map_stores(db, changeset["stores"])
+        #Ids mapped during this merge, a leg finds its parent here instead of in sync_ids
+        ids = {}
+        #Legs sent before their parent (undoing a delete puts the legs back first): parent source id -> {leg source id: row}
+        waiting = {}
+        for seq, table, op, image in changeset["changes"]:
+            if not changeset["snapshot"] and position is not None and seq <= position or table not in JOURNAL_TABLES:
+                skipped += 1
+                continue
+
+            row = dict(zip(changeset["columns"][table], image))
+            row["store_id"] = store_ids.get(str(row["store_id"]))
+            if table == "transactions":
+                merge_transaction(db, site, op, row, ids, waiting)
+            else:
+                merge_daily(db, table, op, row)
+            applied += 1
+
+        #A leg without its parent would count as a posting of its own, the whole changeset is refused instead
+        if waiting:
+            legs = sorted(leg for legs in waiting.values() for leg in legs)
+            raise ValueError(f"Transactions {', '.join(map(str, legs[:10]))} of site {changeset['site_name']} belong to "
+                             f"parents that were never sent, export a snapshot of the site (--snapshot)")
+
+        db.c.execute("""
+            INSERT INTO sync_sites (site_id, name, last_seq, synced_at) VALUES (?,?,?,?)
+            ON CONFLICT (site_id) DO UPDATE SET name = excluded.name, last_seq = MAX(last_seq, excluded.last_seq), synced_at = excluded.synced_at
+        """, (site, changeset["site_name"], changeset["to_seq"], datetime.now().isoformat(timespec="seconds")))
+        if applied:
+            db.bump_version("transactions", "daily_sales", "daily_metrics")
+
+    print(f"Merged {applied:,} changes from {changeset['site_name']} ({skipped:,} already merged) "
+          f"in {(time.perf_counter() - started) * 1000:,.0f} ms")
+    return applied, skipped
+
+
+#Site store id (as text, json keys) -> store id here, stores this database doesn't have yet are added
+def map_stores(db, stores):
+    mapping = {}
+    for source_id, name in stores.items():
+        db.c.execute("SELECT MIN(id) FROM stores WHERE name = ?", (name,))
+        local_id = db.c.fetchone()[0]
+        if local_id is None:
+            db.c.execute("INSERT INTO stores (name) VALUES (?)", (name,))
+            local_id = db.c.lastrowid
+            print(f"Sync: added store {name}")
+        mapping[str(source_id)] = local_id
+    return mapping
+
+
+def local_transaction_id(db, site, source_id, ids):
+    if source_id is None:
+        return None
+    if source_id in ids:
+        return ids[source_id]
+    db.c.execute("SELECT local_id FROM sync_ids WHERE site_id = ? AND source_id = ?", (site, source_id))
+    row = db.c.fetchone()
+    return row[0] if row else None
+
+
+#Inserts and updates are both upserts on the mapped id, so a row sent twice (snapshot then journal) lands once
+#A leg whose parent isn't mapped yet waits for it, the newest change of a waiting leg replaces the older one
+def merge_transaction(db, site, op, row, ids, waiting):
+    source_id = row.pop("id")
+    for parent, legs in list(waiting.items()):
+        legs.pop(source_id, None)
+        if not legs:
+            del waiting[parent]
+    local_id = local_transaction_id(db, site, source_id, ids)
+
+    if op == "D":
+        if local_id is not None:
+            db.c.execute("DELETE FROM transactions WHERE id = ?", (local_id,))
+            db.c.execute("DELETE FROM sync_ids WHERE site_id = ? AND source_id = ?", (site, source_id))
+            ids[source_id] = None
+        return
+
+    parent_id = local_transaction_id(db, site, row["parent_id"], ids)
+    if row["parent_id"] is not None and parent_id is None:
+        waiting.setdefault(row["parent_id"], {})[source_id] = row
+        return
+    row["parent_id"] = parent_id
+
+    columns = [column for column in JOURNAL_TABLES["transactions"][1] if column in row]
+    if local_id is not None:
+        db.c.execute(f"UPDATE transactions SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?",
+                     [row[column] for column in columns] + [local_id])
+        #Mapped but no longer here (removed on this side): a snapshot puts it back under a new id
+        if db.c.rowcount == 0:
+            local_id = None
+    if local_id is None:
+        db.c.execute(f"INSERT INTO transactions ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                     [row[column] for column in columns])
+        ids[source_id] = db.c.lastrowid
+        db.c.execute("INSERT OR REPLACE INTO sync_ids (site_id, source_id, local_id) VALUES (?,?,?)", (site, source_id, ids[source_id]))
+
+    for leg_id, leg in waiting.pop(source_id, {}).items():
+        merge_transaction(db, site, "I", {**leg, "id": leg_id}, ids, waiting)
+
+
+def merge_daily(db, table, op, row):
+    if op == "D":
+        db.c.execute(f"DELETE FROM {table} WHERE store_id = ? AND date = ?", (row["store_id"], row["date"]))
+        return
+
+    columns = [column for column in JOURNAL_TABLES[table][1] if column in row]
+    values = [column for column in columns if column not in JOURNAL_TABLES[table][0]]
+    db.c.execute(f"""
+        INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})
+        ON CONFLICT (store_id, date) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in values)}
+    """, [row[column] for column in columns])
+
+
+#Asks the head office (api_server.py) where this site is, sends what comes after it: (changes sent, bytes sent)
+def push(db, url, token=None, name=None):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    site = site_id(db)
+
+    request = urllib.request.Request(f"{url.rstrip('/')}/sync/state?site={site}", headers=headers)
+    with urllib.request.urlopen(request) as response:
+        position = json.load(response)["last_seq"]
+
+    changeset = build_changeset(db, position, name)
+    if position is not None and not changeset["changes"]:
+        return 0, 0
+
+    data = pack(changeset)
+    request = urllib.request.Request(f"{url.rstrip('/')}/sync/changeset", data=data, method="POST",
+                                     headers={**headers, "Content-Type": "application/json", "Content-Encoding": "gzip"})
+    with urllib.request.urlopen(request) as response:
+        json.load(response)
+    record_sent(db, changeset)
+    return len(changeset["changes"]), len(data)
+
+
+#Remembered like a merge of our own site id, the next export starts after it (--snapshot sends every row again)
+def record_sent(db, changeset):
+    with db.write(journal=False):
+        db.c.execute("""
+            INSERT INTO sync_sites (site_id, name, last_seq, synced_at) VALUES (?,?,?,?)
+            ON CONFLICT (site_id) DO UPDATE SET name = excluded.name, last_seq = excluded.last_seq, synced_at = excluded.synced_at
+        """, (changeset["site_id"], changeset["site_name"], changeset["to_seq"], changeset["created_at"]))
+
+
+def cmd_export(args):
+    db = DatabaseManager(args.db)
+    after = None if args.snapshot else args.after if args.after is not None else sync_position(db, site_id(db))
+    changeset = build_changeset(db, after, args.name)
+    if after is not None and not changeset["changes"]:
+        print("Nothing new to export")
+        return
+
+    path = write_changeset(changeset, args.dir)
+    record_sent(db, changeset)
+    print(f"Exported {len(changeset['changes']):,} changes to {path} ({os.path.getsize(path):,} bytes)")
+
+
+def cmd_merge(args):
+    db = DatabaseManager(args.db)
+    #Oldest first, so a site's files go in order when several are waiting
+    for path in sorted(args.files):
+        try:
+            merge_changeset(db, read_changeset(path))
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"{path}: {e}")
+
+
+def cmd_push(args):
+    db = DatabaseManager(args.db)
+    sent, size = push(db, args.url, args.token, args.name)
+    print(f"Pushed {sent:,} changes ({size:,} bytes)" if sent else "Head office is up to date")
+
+
+def cmd_status(args):
+    db = DatabaseManager(args.db)
+    own = site_id(db)
+    print(f"This database is site {own}")
+    for site, name, last_seq, synced_at in db.get_sync_sites():
+        print(f"  {name or '?':<20} site {site:<16} up to change {last_seq:<10,} {synced_at}{' (exported)' if site == own else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync branch databases into a head office database")
+    parser.add_argument("--db", default="store.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Write the changes since the last export to a .json.gz file")
+    export.add_argument("--dir", default="outbox")
+    export.add_argument("--name", default=None, help="Site name shown on the head office (machine name otherwise)")
+    export.add_argument("--after", type=int, default=None, help="Start after this change instead of the last export")
+    export.add_argument("--snapshot", action="store_true", help="Every row, like the first export")
+    export.set_defaults(func=cmd_export)
+
+    merge = commands.add_parser("merge", help="Merge changeset files (already merged ones are skipped)")
+    merge.add_argument("files", nargs="+")
+    merge.set_defaults(func=cmd_merge)
+
+    push_cmd = commands.add_parser("push", help="Send the changes to a head office api_server.py")
+    push_cmd.add_argument("--url", required=True)
+    push_cmd.add_argument("--token", default=os.environ.get("STORE_API_TOKEN", ""))
+    push_cmd.add_argument("--name", default=None)
+    push_cmd.set_defaults(func=cmd_push)
+
+    status = commands.add_parser("status", help="Sites merged into this database and how far")
+    status.set_defaults(func=cmd_status)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
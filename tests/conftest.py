@@ -0,0 +1,42 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DatabaseManager
+
+#Schema and seed rows of a store.db made by the first release (before any migration)
+BASELINE_SCHEMA = """
+    CREATE TABLE stores (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT);
+    CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, store_id INTEGER, parent_id INTEGER, date TEXT, type TEXT,
+                               category TEXT, amount REAL, currency TEXT, payment_method TEXT, description TEXT);
+    CREATE TABLE settings (key TEXT PRIMARY KEY, value REAL);
+    CREATE TABLE daily_sales (date TEXT, store_id INTEGER, amount REAL, PRIMARY KEY (store_id, date));
+    CREATE TABLE daily_metrics (branch TEXT, date TEXT, receipts INTEGER, footfall INTEGER, PRIMARY KEY (branch, date));
+    CREATE INDEX idx_store_date ON transactions(store_id, date);
+    CREATE INDEX idx_parent ON transactions(parent_id);
+
+    INSERT INTO stores (name) VALUES ('LeMall Dbayye'), ('City Center'), ('City Mall'), ('Koura Branch'), ('Main Vault'),
+                                     ('TVA Account'), ('Bank Commission'), ('Cost of goods'), ('Freight');
+    INSERT INTO settings VALUES ('main_rate', 15), ('tva_rate', 7), ('comm_rate', 3), ('freight_rate', 33), ('exchange_rate', 89500);
+"""
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def db(tmp_path):
+    manager = DatabaseManager(str(tmp_path / "store.db"))
+    yield manager
+    manager.conn.close()
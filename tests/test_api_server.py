@@ -0,0 +1,42 @@
+import asyncio
+import json
+
+from api_server import ApiServer
+
+
+#Sends raw request bytes, returns (status, payload) of the first response
+async def exchange(server, request):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    writer.write(request)
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = int([line for line in head.decode("latin-1").split("\r\n") if line.lower().startswith("content-length")][0].split(":")[1])
+    payload = json.loads(await reader.readexactly(length))
+    writer.close()
+    return int(head.split()[1]), payload
+
+
+def run(db_path, *requests):
+    async def scenario():
+        server = await ApiServer(db_path, pool_size=1).start(port=0)
+        try:
+            return [await exchange(server, request) for request in requests]
+        finally:
+            await server.stop()
+    return asyncio.run(scenario())
+
+
+def test_post_and_read_back(tmp_path):
+    body = json.dumps({"branch": "City Mall", "date": "2024-03-01", "receipts": 12, "footfall": 80}).encode()
+    posted, read = run(str(tmp_path / "store.db"),
+                       b"POST /daily-metrics HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body),
+                       b"GET /daily-metrics?branch=City%20Mall&date=2024-03-01 HTTP/1.1\r\n\r\n")
+    assert posted[0] in (200, 201)
+    assert read == (200, {"branch": "City Mall", "date": "2024-03-01", "receipts": 12, "footfall": 80})
+
+
+def test_malformed_content_length_is_a_bad_request(tmp_path):
+    for length in (b"abc", b"-5"):
+        [(status, payload)] = run(str(tmp_path / "store.db"), b"POST /transactions HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\n")
+        assert status == 400
+        assert "Content-Length" in payload["error"]
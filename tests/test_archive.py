@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from database import ClosedPeriodError
+
+
+def balances(db):
+    return {row[:3]: round(row[3], 2) for row in db.get_balance_summary() if round(row[3], 2)}
+
+
+def view(db, start, end):
+    return db.get_ledger_rows("City Mall", start_date=start, end_date=end, sort="date"), db.get_ledger_totals("City Mall", start_date=start, end_date=end)
+
+
+@pytest.fixture
+def ledger(db):
+    for year in (2023, 2024, 2025):
+        db.post_transaction("City Mall", f"{year}-02-10", "Income", "Sales", 1000, "USD ($)", "Card")
+        db.post_transaction("City Mall", f"{year}-06-15", "Income", "Sales", 45000000, "LBP (L.L)", "Cash")
+        db.post_transaction("City Mall", f"{year}-11-30", "Expense", "Rent", 300, "USD ($)", "Cash")
+    return db
+
+
+def test_archived_years_read_back_the_same(ledger):
+    db = ledger
+    before = balances(db)
+    ranges = [("2023-01-01", "2025-12-31"), ("2024-03-01", "2025-12-31"), ("2025-01-01", "")]
+    views = {span: view(db, *span) for span in ranges}
+
+    assert db.archive_year(2023) > 0
+    assert db.archive_year(2024) > 0
+    assert [year for year, _ in db.get_archived_years()] == [2023, 2024]
+    assert os.path.exists(os.path.join(db.db_dir, "archives", "store_2023.db"))
+
+    #The carry forward rows keep the balances, the attached years give the same ledger rows and totals
+    assert balances(db) == before
+    for span in ranges:
+        rows, totals = view(db, *span)
+        assert rows == views[span][0]
+        assert totals.keys() == views[span][1].keys()
+        for key, (total, total_usd) in totals.items():
+            assert total == pytest.approx(views[span][1][key][0])
+            assert total_usd == pytest.approx(views[span][1][key][1])
+
+
+def test_archived_years_are_closed(ledger):
+    db = ledger
+    with pytest.raises(ValueError):
+        db.archive_year(2024)
+
+    db.archive_year(2023)
+    with pytest.raises(ValueError):
+        db.archive_year(2023)
+    with pytest.raises(ClosedPeriodError):
+        db.post_transaction("City Mall", "2023-05-01", "Income", "Sales", 10, "USD ($)", "Cash")
+
+    row = db.get_ledger_rows("City Mall", start_date="2024-01-01")[0]
+    with pytest.raises(ClosedPeriodError):
+        db.update_transaction_full(row[0], "2023-12-31", row[3], row[4], row[7])
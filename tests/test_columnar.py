@@ -0,0 +1,77 @@
+from datetime import date
+
+import pytest
+
+import columnar
+from analytics import category_breakdown
+from datagen import LedgerGenerator
+from database import PHYSICAL_BRANCHES
+
+pytestmark = pytest.mark.skipif(not columnar.available(), reason="the columnar mirror needs numpy")
+
+RANGE = ("2024-03-01", "2024-03-10")
+
+
+def same_totals(mirror_rows, sql_rows):
+    assert [category for category, _ in mirror_rows] == [category for category, _ in sql_rows]
+    for (_, mirrored), (_, total) in zip(mirror_rows, sql_rows):
+        assert mirrored == pytest.approx(total)
+
+
+#Same structure, floats equal up to rounding
+def assert_close(left, right):
+    if isinstance(left, (list, tuple)):
+        assert len(left) == len(right)
+        for a, b in zip(left, right):
+            assert_close(a, b)
+    elif isinstance(left, dict):
+        assert left.keys() == right.keys()
+        for key in left:
+            assert_close(left[key], right[key])
+    elif isinstance(left, float):
+        assert left == pytest.approx(right)
+    else:
+        assert left == right
+
+
+@pytest.fixture
+def mirror(db, tmp_path):
+    LedgerGenerator(db, seed=3, start=date(2024, 3, 1), days=10).run()
+    return columnar.ColumnarMirror(db, str(tmp_path / "store_columns"))
+
+
+def test_mirror_matches_sql(db, mirror):
+    assert mirror.refresh() > 0
+    same_totals(category_breakdown(db, PHYSICAL_BRANCHES, *RANGE, mirror=mirror), category_breakdown(db, PHYSICAL_BRANCHES, *RANGE))
+
+
+def test_refresh_appends_new_rows_and_rebuilds_after_a_delete(db, mirror):
+    mirror.refresh()
+    assert mirror.refresh() == 0
+
+    db.post_transaction("City Mall", "2024-03-05", "Expense", "Rent", 500, "USD ($)", "Cash")
+    assert mirror.refresh() == 1
+    same_totals(category_breakdown(db, PHYSICAL_BRANCHES, *RANGE, mirror=mirror), category_breakdown(db, PHYSICAL_BRANCHES, *RANGE))
+
+    db.c.execute("SELECT count(*) FROM transactions")
+    count = db.c.fetchone()[0]
+    db.c.execute("SELECT MAX(id) FROM transactions WHERE parent_id IS NULL")
+    db.delete_smart_chain(db.c.fetchone()[0])
+    assert mirror.refresh() == count - 1
+    same_totals(category_breakdown(db, PHYSICAL_BRANCHES, *RANGE, mirror=mirror), category_breakdown(db, PHYSICAL_BRANCHES, *RANGE))
+
+
+@pytest.mark.parametrize("granularity", ["day", "week", "month", "year"])
+def test_branch_figures_match_the_rollup(db, mirror, granularity):
+    from analytics import branch_report, compare_branches
+    mirror.refresh()
+    span = ("2024-02-20", "2024-03-08")
+
+    sql_rows = db.get_branch_rollup(PHYSICAL_BRANCHES, *span, granularity)
+    mirror_rows = mirror.branch_rollup(PHYSICAL_BRANCHES, *span, granularity)
+    assert [row[:2] for row in mirror_rows] == [row[:2] for row in sql_rows]
+    for mirrored, row in zip(mirror_rows, sql_rows):
+        assert mirrored[2:] == pytest.approx([value or 0 for value in row[2:]])
+
+    for report in (branch_report, compare_branches):
+        assert_close(report(db, PHYSICAL_BRANCHES, *span, granularity, mirror=mirror), report(db, PHYSICAL_BRANCHES, *span, granularity))
@@ -0,0 +1,35 @@
+def day(receipts=None, footfall=None, amount=100.0):
+    return {"branch": "City Mall", "date": "2024-03-01", "target": 500.0, "receipts": receipts, "footfall": footfall,
+            "amounts": [("USD ($)", "Cash", amount)]}
+
+
+def test_blank_metrics_keep_the_saved_ones(db):
+    db.post_daily_batch([day(receipts=12, footfall=80)])
+    db.post_daily_batch([day()])
+    assert db.get_daily_metrics("City Mall", "2024-03-01") == (12, 80)
+
+    db.post_daily_batch([day(footfall=95)])
+    assert db.get_daily_metrics("City Mall", "2024-03-01") == (12, 95)
+
+
+def test_blank_metrics_add_no_row(db):
+    db.post_daily_batch([day()])
+    db.c.execute("SELECT count(*) FROM daily_metrics")
+    assert db.c.fetchone()[0] == 0
+
+
+def test_ids_of_deleted_rows_are_not_handed_out_again(db):
+    parent = db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    db.c.execute("SELECT MAX(id) FROM transactions")
+    highest = db.c.fetchone()[0]
+    db.delete_smart_chain(parent)
+
+    db.post_daily_batch([day(amount=50.0)])
+    db.c.execute("SELECT MIN(id) FROM transactions")
+    assert db.c.fetchone()[0] > highest
+
+    #Undoing the batch and then the delete puts the chain back under its own ids
+    db.undo()
+    db.undo()
+    db.c.execute("SELECT MAX(id) FROM transactions WHERE parent_id IS NULL")
+    assert db.c.fetchone()[0] == parent
@@ -0,0 +1,45 @@
+from datetime import date
+
+import pytest
+
+from datagen import LedgerGenerator
+
+
+def test_generated_ledger_passes_the_integrity_check(db):
+    written = LedgerGenerator(db, seed=1, start=date(2024, 3, 1), days=3).run()
+    assert written > 0
+    assert all(entry["count"] == 0 for entry in db.check_integrity().values())
+
+
+def test_failed_run_rolls_back_and_restores_synchronous(db, monkeypatch):
+    db.c.execute("PRAGMA synchronous")
+    synchronous = db.c.fetchone()[0]
+    generator = LedgerGenerator(db, seed=1, start=date(2024, 3, 1), days=3)
+
+    def broken():
+        raise RuntimeError("insert failed")
+    monkeypatch.setattr(generator, "flush", broken)
+
+    with pytest.raises(RuntimeError):
+        generator.run()
+
+    assert not db.conn.in_transaction
+    db.c.execute("PRAGMA synchronous")
+    assert db.c.fetchone()[0] == synchronous
+    db.c.execute("SELECT count(*) FROM daily_sales")
+    assert db.c.fetchone()[0] == 0
+
+
+def test_ids_start_after_rows_posted_since_construction(db):
+    parent = db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    db.delete_smart_chain(parent)
+    generator = LedgerGenerator(db, seed=1, start=date(2024, 3, 1), days=1)
+
+    #Another workstation posts after the generator was made
+    db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    db.c.execute("SELECT MAX(id) FROM transactions")
+    highest = db.c.fetchone()[0]
+
+    written = generator.run()
+    db.c.execute("SELECT count(*) FROM transactions WHERE id > ?", (highest,))
+    assert db.c.fetchone()[0] == written > 0
@@ -0,0 +1,47 @@
+import sqlite3
+
+import pytest
+
+from database import DatabaseManager, from_day, to_day
+
+
+@pytest.mark.parametrize("text, day", [("1970-01-01", 0), ("1969-12-31", -1), ("2024-02-29", 19782), ("2024-03-01", 19783)])
+def test_day_numbers_round_trip(text, day):
+    assert to_day(text) == day
+    assert from_day(day) == text
+
+
+def test_empty_and_malformed_dates():
+    assert to_day("") is None
+    assert from_day(None) == ""
+    with pytest.raises(ValueError):
+        to_day("01/03/2024")
+
+
+def test_ledger_filter_bounds_are_whole_days(db):
+    for t_date in ["2024-02-28", "2024-02-29", "2024-03-01", "2024-03-02"]:
+        db.add_transactions("City Mall", t_date, "Income", "Sales", 10, "USD ($)", "Cash")
+
+    where, params = db.ledger_filter("City Mall", start_date="2024-02-29", end_date="2024-03-01")
+    assert params == ["City Mall", 19782, 19783]
+    db.c.execute(f"SELECT date FROM transactions t WHERE {where} ORDER BY date", params)
+    assert [from_day(day) for day, in db.c.fetchall()] == ["2024-02-29", "2024-03-01"]
+
+    rows = db.get_ledger_rows("City Mall", start_date="2024-02-29", end_date="2024-03-01", sort="date", descending=False)
+    assert [row[1] for row in rows] == ["2024-02-29", "2024-03-01"]
+    assert db.get_transaction(rows[0][0])[3] == "2024-02-29"
+
+
+def test_text_dates_of_an_old_file_become_day_numbers(baseline_db):
+    conn = sqlite3.connect(baseline_db)
+    conn.execute("INSERT INTO transactions (store_id, date, type, category, amount, currency, payment_method) VALUES (3, '2024-02-29', 'Income', 'Rent', 10, 'USD ($)', 'Cash')")
+    conn.execute("INSERT INTO daily_sales VALUES ('2024-02-29', 3, 500)")
+    conn.commit()
+    conn.close()
+
+    db = DatabaseManager(baseline_db)
+    db.c.execute("SELECT date, typeof(date) FROM transactions UNION ALL SELECT date, typeof(date) FROM daily_sales")
+    assert db.c.fetchall() == [(19782, "integer"), (19782, "integer")]
+    assert [row[1] for row in db.get_ledger_rows("City Mall", start_date="2024-02-29", end_date="2024-02-29")] == ["2024-02-29"]
+    assert db.get_daily_sale("City Mall", "2024-02-29") == 500
+    db.conn.close()
@@ -0,0 +1,42 @@
+import pytest
+
+
+#Rate changes on past days, as update_rate would have recorded them back then
+def set_rates(db, rates):
+    with db.write():
+        db.c.executemany("INSERT OR REPLACE INTO exchange_rates (date, rate) VALUES (?, ?)", rates.items())
+        db.bump_version("exchange_rates")
+
+
+def test_rate_in_effect_on_a_date(db):
+    set_rates(db, {"2024-03-01": 90000, "2024-03-05": 100000})
+
+    assert db.get_rate_on("2024-03-04") == 90000
+    assert db.get_rate_on("2024-03-05") == 100000
+    assert db.get_rates_range("2024-03-04", "2024-03-06") == {"2024-03-04": 90000, "2024-03-05": 100000, "2024-03-06": 100000}
+
+
+@pytest.mark.parametrize("category", ["All", "Sales"])
+def test_lbp_totals_use_the_rate_of_their_day(db, category):
+    set_rates(db, {"2024-03-01": 90000, "2024-03-05": 100000})
+    db.post_transaction("Koura Branch", "2024-03-02", "Income", "Sales", 900000, "LBP (L.L)", "Cash")
+    db.post_transaction("Koura Branch", "2024-03-06", "Income", "Sales", 1000000, "LBP (L.L)", "Cash")
+
+    #Totals through the rollup (no category) and through the raw rows (category filter) agree, the legs are expenses
+    total, total_usd = db.get_ledger_totals("Koura Branch", "Income", category)[("LBP (L.L)", "Cash")]
+    assert total == 1900000
+    assert total_usd == pytest.approx(10 + 10)
+
+    #A new rate from today on leaves the past days as they were
+    db.update_rate("exchange_rate", 50000)
+    assert db.get_ledger_totals("Koura Branch", "Income", category)[("LBP (L.L)", "Cash")][1] == pytest.approx(20)
+
+
+def test_sales_in_usd_use_the_rate_of_their_day(db):
+    set_rates(db, {"2024-03-01": 90000, "2024-03-05": 100000})
+    db.save_daily_sale("City Mall", "2024-03-02", 450000)
+    db.save_daily_sale("City Mall", "2024-03-06", 500000)
+
+    rows = db.get_daily_rollup(["City Mall"], "2024-03-01", "2024-03-31", "month")
+    assert [(period, sales) for period, sales, _, _, _ in rows] == [("2024-03-01", 950000)]
+    assert rows[0][4] == pytest.approx(5 + 5)
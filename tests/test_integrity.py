@@ -0,0 +1,58 @@
+def counts(db):
+    return {kind: entry["count"] for kind, entry in db.check_integrity().items() if entry["count"]}
+
+
+def leg(db, parent, role, t_type="Expense"):
+    db.c.execute("SELECT id, amount FROM transactions WHERE parent_id = ? AND leg_role = ? AND type = ?", (parent, role, t_type))
+    return db.c.fetchone()
+
+
+#Damage done straight to the file, the way an old tool or a half-applied import would leave it
+def damage(db, query, params):
+    db.c.execute(query, params)
+    db.conn.commit()
+
+
+def test_clean_postings_pass(db):
+    db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Card")
+    db.post_transaction("City Mall", "2024-03-01", "Expense", "Cost of goods", 400, "USD ($)", "Cash")
+    db.post_transaction("Koura Branch", "2024-03-02", "Income", "Sales", 900000, "LBP (L.L)", "Cash", apply_main=False)
+    assert counts(db) == {}
+
+
+def test_orphans_drift_and_missing_legs_are_found(db):
+    drifted = db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Card")
+    orphaned = db.post_transaction("City Center", "2024-03-01", "Income", "Sales", 200, "USD ($)", "Cash")
+    short = db.post_transaction("Koura Branch", "2024-03-02", "Income", "Sales", 300, "USD ($)", "Card")
+
+    tva_id, tva_amount = leg(db, drifted, "tva")
+    damage(db, "UPDATE transactions SET amount = ? WHERE id = ?", (tva_amount + 5, tva_id))
+    damage(db, "DELETE FROM transactions WHERE id = ?", (orphaned,))
+    damage(db, "DELETE FROM transactions WHERE id = ?", (leg(db, short, "comm", "Income")[0],))
+
+    db.c.execute("SELECT count(*) FROM transactions WHERE parent_id = ?", (orphaned,))
+    orphans = db.c.fetchone()[0]
+    assert orphans == 4
+    assert counts(db) == {"drift": 1, "orphan": orphans, "missing": 1}
+
+    report = db.check_integrity(limit=1)
+    assert len(report["orphan"]["rows"]) == 1
+    assert report["drift"]["rows"][0][:2] == (tva_id, drifted)
+    assert report["missing"]["rows"][0][0] == short
+
+
+def test_fix_leg_drift(db):
+    parent = db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Card")
+    db.post_transaction("City Mall", "2024-03-02", "Expense", "Cost of goods", 400, "USD ($)", "Cash")
+    tva_id, tva_amount = leg(db, parent, "tva")
+    comm_id, comm_amount = leg(db, parent, "comm", "Income")
+    damage(db, "UPDATE transactions SET amount = amount * 2 WHERE id IN (?, ?)", (tva_id, comm_id))
+    assert counts(db) == {"drift": 2}
+
+    assert db.fix_leg_drift() == 2
+    assert counts(db) == {}
+    assert (leg(db, parent, "tva"), leg(db, parent, "comm", "Income")) == ((tva_id, tva_amount), (comm_id, comm_amount))
+
+    #The fix is one undoable change
+    db.undo()
+    assert counts(db) == {"drift": 2}
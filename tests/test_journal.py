@@ -0,0 +1,54 @@
+import pytest
+
+from database import DatabaseManager, StaleRecordError
+
+
+def balances(db):
+    return [row for row in db.get_balance_summary() if row[3]]
+
+
+def ledger(db):
+    db.c.execute("SELECT id, store_id, parent_id, date, type, category, amount, currency, payment_method, description FROM transactions ORDER BY id")
+    return db.c.fetchall()
+
+
+def test_undo_and_redo_round_trip(db):
+    db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    before = ledger(db), balances(db)
+
+    parent = db.post_transaction("City Mall", "2024-03-02", "Income", "Sales", 250, "USD ($)", "Card")
+    after = ledger(db), balances(db)
+    assert db.get_undo_labels()[0] is not None
+
+    db.undo()
+    assert (ledger(db), balances(db)) == before
+    db.redo()
+    assert (ledger(db), balances(db)) == after
+
+    #A delete and its undo bring the whole chain back with the same ids
+    db.delete_smart_chain(parent)
+    db.undo()
+    assert (ledger(db), balances(db)) == after
+
+
+def test_new_change_ends_the_redo_chain(db):
+    db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    db.undo()
+    db.post_transaction("City Mall", "2024-03-01", "Expense", "Rent", 40, "USD ($)", "Cash")
+    assert db.get_undo_labels()[1] is None
+    assert db.redo() is None
+
+
+def test_undo_refuses_a_row_changed_since(tmp_path):
+    path = str(tmp_path / "store.db")
+    first, second = DatabaseManager(path), DatabaseManager(path)
+    parent = first.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+
+    #A change the journal never saw (another workstation's tool writing straight to the file)
+    second.c.execute("UPDATE transactions SET amount = 120 WHERE id = ?", (parent,))
+    second.conn.commit()
+
+    with pytest.raises(StaleRecordError):
+        first.undo()
+    assert ledger(first) == ledger(second)
+    assert first.get_undo_labels()[0] is not None
@@ -0,0 +1,49 @@
+from ledger_cache import LedgerCache
+
+QUERY = ("City Mall", "All", "All", "All", "All", "", "", False)
+
+
+def test_repeat_lookups_skip_sql(db):
+    db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    cache = LedgerCache(db)
+
+    rows, totals = cache.page(QUERY, "date", True, 0), cache.totals(QUERY)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert cache.page(QUERY, "date", True, 0) == rows and cache.totals(QUERY) == totals
+    assert cache.hits == 2
+
+
+def test_writes_and_undo_invalidate(db):
+    cache = LedgerCache(db)
+    assert cache.page(QUERY, "date", True, 0) == []
+
+    parent = db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    assert parent in [row[0] for row in cache.page(QUERY, "date", True, 0)]
+    assert cache.totals(QUERY) == db.get_ledger_totals(*QUERY)
+
+    db.undo()
+    assert cache.page(QUERY, "date", True, 0) == []
+
+
+def test_views_are_evicted_least_recently_used_first(db):
+    cache = LedgerCache(db, max_views=2)
+    other = ("Koura Branch",) + QUERY[1:]
+    third = ("City Center",) + QUERY[1:]
+
+    cache.totals(QUERY)
+    cache.totals(other)
+    cache.totals(QUERY)
+    cache.totals(third)
+    assert list(cache.views) == [QUERY, third]
+
+
+def test_prefetch_fills_the_first_page_once(db):
+    cache = LedgerCache(db)
+    cache.used("Koura Branch")
+    cache.used("Koura Branch")
+    cache.used("City Mall")
+    assert cache.most_used(1) == ["Koura Branch"]
+
+    other = ("Koura Branch",) + QUERY[1:]
+    assert cache.prefetch(other, "date", True)
+    assert not cache.prefetch(other, "date", True)
@@ -0,0 +1,83 @@
+import sqlite3
+
+from database import DatabaseManager
+
+
+def fill_baseline(path):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        INSERT INTO transactions (store_id, parent_id, date, type, category, amount, currency, payment_method)
+        VALUES (3, NULL, '2024-03-01', 'Income', 'Sales', 100, 'USD ($)', 'Cash'),
+               (3, 1, '2024-03-01', 'Expense', 'TVA (7%)', 7, 'USD ($)', 'Cash'),
+               (3, NULL, '2024-03-02', 'Expense', 'Rent', 50000, 'Lira (LBP)', 'Card');
+        INSERT INTO daily_sales VALUES ('2024-03-01', 3, 100);
+        INSERT INTO daily_metrics VALUES ('City Mall', '2024-03-01', 12, 80), ('Closed Branch', '2024-03-01', 1, 2);
+    """)
+    conn.commit()
+    conn.close()
+
+
+def test_baseline_database_opens_and_keeps_its_totals(baseline_db):
+    fill_baseline(baseline_db)
+    db = DatabaseManager(baseline_db)
+
+    balances = {(name, currency, method): total for name, currency, method, total in db.get_balance_summary()}
+    assert balances[("City Mall", "USD ($)", "Cash")] == 93
+    assert balances[("City Mall", "Lira (LBP)", "Card")] == -50000
+
+    assert db.get_daily_metrics("City Mall", "2024-03-01") == (12, 80)
+    db.c.execute("SELECT branch FROM daily_metrics_unmatched")
+    assert db.c.fetchall() == [("Closed Branch",)]
+
+    #Derived legs got their role back from the category
+    db.c.execute("SELECT leg_role FROM transactions WHERE id = 2")
+    assert db.c.fetchone()[0] == "tva"
+    db.conn.close()
+
+
+def test_migrations_run_once(baseline_db, capsys):
+    fill_baseline(baseline_db)
+    DatabaseManager(baseline_db).conn.close()
+    capsys.readouterr()
+
+    db = DatabaseManager(baseline_db)
+    assert "Database upgraded" not in capsys.readouterr().out
+    db.c.execute("SELECT count(*) FROM daily_rollup")
+    assert db.c.fetchone()[0] > 0
+    db.conn.close()
+
+
+def test_empty_rollup_is_rebuilt(baseline_db):
+    fill_baseline(baseline_db)
+    db = DatabaseManager(baseline_db)
+    #A rollup left empty by a failed build
+    db.c.execute("DELETE FROM daily_rollup")
+    db.c.execute("DELETE FROM settings WHERE key = 'rollup_built'")
+    db.conn.commit()
+    db.conn.close()
+
+    db = DatabaseManager(baseline_db)
+    assert ("City Mall", "USD ($)", "Cash", 93) in db.get_balance_summary()
+    db.conn.close()
+
+
+def test_failed_leg_role_backfill_is_raised_and_retried(baseline_db, monkeypatch):
+    fill_baseline(baseline_db)
+
+    def broken(self):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(DatabaseManager, "backfill_leg_roles", broken)
+        try:
+            DatabaseManager(baseline_db)
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise AssertionError("the backfill error was swallowed")
+
+    #The columns went with the rollback, so the next start does the whole migration
+    db = DatabaseManager(baseline_db)
+    db.c.execute("SELECT leg_role FROM transactions WHERE id = 2")
+    assert db.c.fetchone()[0] == "tva"
+    db.conn.close()
@@ -0,0 +1,56 @@
+#Rows of daily_rollup that hold something (a delete leaves its zeroed row behind)
+def rollup(db):
+    db.c.execute("""
+        SELECT store_id, date, currency, method, ROUND(income, 2), ROUND(expense, 2), sales, receipts, footfall FROM daily_rollup
+        WHERE ROUND(income, 2) != 0 OR ROUND(expense, 2) != 0 OR sales != 0 OR receipts != 0 OR footfall != 0
+        ORDER BY store_id, date, currency, method
+    """)
+    return db.c.fetchall()
+
+
+#What the triggers kept up to date against a rebuild from the raw tables
+def assert_matches_raw(db):
+    kept = rollup(db)
+    with db.write(journal=False):
+        db.fill_rollup()
+    assert kept == rollup(db)
+
+
+def test_rollup_follows_updates_deletes_and_undo(db):
+    first = db.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Card")
+    second = db.post_transaction("Koura Branch", "2024-03-02", "Income", "Sales", 2500000, "LBP (L.L)", "Cash")
+    db.post_transaction("City Mall", "2024-03-02", "Expense", "Rent", 40, "USD ($)", "Cash")
+    db.save_daily_sale("City Mall", "2024-03-01", 120)
+    db.save_daily_metrics("City Mall", "2024-03-01", 14, 90)
+    assert_matches_raw(db)
+
+    #An edit moves the parent and its legs to another day with a new amount
+    db.update_transaction_full(first, "2024-03-03", "Sales", 180, "moved")
+    db.save_daily_sale("City Mall", "2024-03-01", 150)
+    db.save_daily_metrics("City Mall", "2024-03-01", 16, 95)
+    assert_matches_raw(db)
+
+    db.delete_smart_chain(second)
+    assert_matches_raw(db)
+
+    for _ in range(3):
+        db.undo()
+        assert_matches_raw(db)
+    db.redo()
+    assert_matches_raw(db)
+
+
+def test_balances_are_the_raw_sums(db):
+    parent = db.post_transaction("City Center", "2024-03-01", "Income", "Sales", 250, "USD ($)", "Card")
+    db.post_transaction("City Center", "2024-03-04", "Expense", "Rent", 75, "USD ($)", "Card")
+    db.update_transaction_full(parent, "2024-03-01", "Sales", 300, None)
+    db.undo()
+
+    db.c.execute("""
+        SELECT s.name, t.currency, t.payment_method, ROUND(SUM(CASE WHEN t.type = 'Income' THEN t.amount ELSE -t.amount END), 2)
+        FROM transactions t JOIN stores s ON t.store_id = s.id
+        GROUP BY s.name, t.currency, t.payment_method
+    """)
+    raw = {row[:3]: row[3] for row in db.c.fetchall() if row[3]}
+    summary = {row[:3]: round(row[3], 2) for row in db.get_balance_summary() if round(row[3], 2)}
+    assert summary == raw
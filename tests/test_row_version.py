@@ -0,0 +1,48 @@
+import pytest
+
+from database import DatabaseManager, StaleRecordError
+
+
+#Two workstations on the same file, each with the record open in its edit window
+@pytest.fixture
+def workstations(tmp_path):
+    path = str(tmp_path / "store.db")
+    first, second = DatabaseManager(path), DatabaseManager(path)
+    yield first, second
+    first.conn.close()
+    second.conn.close()
+
+
+def test_edit_of_a_changed_record_is_refused(workstations):
+    first, second = workstations
+    parent = first.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Card")
+    seen = first.get_transaction(parent)[12]
+    assert second.get_transaction(parent)[12] == seen
+
+    second.update_transaction_full(parent, "2024-03-01", "Sales", 120, "fixed on the other workstation", expected_version=seen)
+    assert second.get_transaction(parent)[12] == seen + 1
+
+    with pytest.raises(StaleRecordError):
+        first.update_transaction_full(parent, "2024-03-01", "Sales", 150, None, expected_version=seen)
+    assert first.get_transaction(parent)[6] == 120
+    assert first.conn.in_transaction is False
+
+    #Reopened with the new version, the edit goes through
+    first.update_transaction_full(parent, "2024-03-01", "Sales", 150, None, expected_version=first.get_transaction(parent)[12])
+    assert second.get_transaction(parent)[6] == 150
+
+
+def test_delete_of_a_changed_or_deleted_record_is_refused(workstations):
+    first, second = workstations
+    parent = first.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Card")
+    seen = first.get_transaction(parent)[12]
+
+    second.update_transaction_full(parent, "2024-03-02", "Sales", 100, None, expected_version=seen)
+    with pytest.raises(StaleRecordError):
+        first.delete_smart_chain(parent, expected_version=seen)
+    first.c.execute("SELECT count(*) FROM transactions WHERE parent_id = ?", (parent,))
+    assert first.c.fetchone()[0] > 0
+
+    second.delete_smart_chain(parent, expected_version=seen + 1)
+    with pytest.raises(StaleRecordError):
+        first.delete_smart_chain(parent, expected_version=seen + 1)
@@ -0,0 +1,131 @@
+import shutil
+
+import pytest
+
+from database import DatabaseManager
+from sync import build_changeset, merge_changeset, pack, record_sent, site_id, sync_position, unpack
+
+
+def export(db):
+    changeset = build_changeset(db, sync_position(db, site_id(db)))
+    record_sent(db, changeset)
+    return unpack(pack(changeset))
+
+
+def balances(*dbs):
+    totals = {}
+    for db in dbs:
+        for name, currency, method, total in db.get_balance_summary():
+            key = (name, currency, method)
+            totals[key] = round(totals.get(key, 0) + total, 6)
+    return {key: total for key, total in totals.items() if total}
+
+
+@pytest.fixture
+def sites(tmp_path):
+    #Both branches start from copies of one file, like a new branch set up from the template
+    DatabaseManager(str(tmp_path / "template.db")).conn.close()
+    shutil.copy(tmp_path / "template.db", tmp_path / "a.db")
+    shutil.copy(tmp_path / "template.db", tmp_path / "b.db")
+    opened = [DatabaseManager(str(tmp_path / name)) for name in ("a.db", "b.db", "head.db")]
+    yield opened
+    for db in opened:
+        db.conn.close()
+
+
+def test_copied_databases_get_their_own_site_id(sites):
+    a, b, head = sites
+    assert len({site_id(a), site_id(b), site_id(head)}) == 3
+    assert site_id(a) == site_id(a)
+
+
+def test_snapshot_then_deltas_add_up_at_head_office(sites):
+    a, b, head = sites
+    a.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    b.post_transaction("Koura Branch", "2024-03-01", "Income", "Sales", 250, "USD ($)", "Card")
+    merge_changeset(head, export(a))
+    merge_changeset(head, export(b))
+    assert balances(head) == balances(a, b)
+
+    a.post_transaction("City Mall", "2024-03-02", "Expense", "Rent", 40, "USD ($)", "Cash")
+    delta = export(a)
+    assert not delta["snapshot"]
+    merge_changeset(head, delta)
+    assert balances(head) == balances(a, b)
+
+    #Merging the same changeset again changes nothing
+    assert merge_changeset(head, delta)[0] == 0
+    assert balances(head) == balances(a, b)
+
+
+def test_gap_and_own_changeset_are_refused(sites):
+    a, _, head = sites
+    merge_changeset(head, export(a))
+    a.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    export(a)
+    a.post_transaction("City Mall", "2024-03-02", "Income", "Sales", 100, "USD ($)", "Cash")
+
+    with pytest.raises(ValueError):
+        merge_changeset(head, export(a))
+    with pytest.raises(ValueError):
+        merge_changeset(a, build_changeset(a, None))
+
+
+def test_undone_delete_keeps_legs_on_their_parent(sites):
+    a, _, head = sites
+    a.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    merge_changeset(head, export(a))
+
+    a.c.execute("SELECT MIN(id) FROM transactions")
+    a.delete_smart_chain(a.c.fetchone()[0])
+    a.undo()
+    merge_changeset(head, export(a))
+
+    assert balances(head) == balances(a)
+    head.c.execute("SELECT count(*) FROM transactions WHERE parent_id IS NULL")
+    assert head.c.fetchone()[0] == 1
+
+
+def test_leg_without_parent_is_refused(sites):
+    a, _, head = sites
+    a.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    changeset = export(a)
+    changeset["changes"] = [change for change in changeset["changes"] if change[1] != "transactions" or change[3][2] is not None]
+
+    with pytest.raises(ValueError):
+        merge_changeset(head, changeset)
+    head.c.execute("SELECT count(*) FROM transactions")
+    assert head.c.fetchone()[0] == 0
+
+
+def test_site_that_synced_under_its_epoch_keeps_it(db):
+    epoch = db.get_data_versions([])[0]
+    db.c.execute("INSERT INTO sync_sites (site_id, name, last_seq) VALUES (?, 'Tripoli', 12)", (epoch,))
+    db.conn.commit()
+    assert site_id(db) == epoch
+    assert sync_position(db, site_id(db)) == 12
+
+
+def test_snapshot_is_applied_again(sites):
+    a, _, head = sites
+    a.post_transaction("City Mall", "2024-03-01", "Income", "Sales", 100, "USD ($)", "Cash")
+    merge_changeset(head, export(a))
+
+    #Lost on the head office, sent again as a snapshot
+    head.c.execute("DELETE FROM transactions WHERE amount = 100")
+    head.conn.commit()
+    snapshot = build_changeset(a, None)
+    assert merge_changeset(head, snapshot)[0] == len(snapshot["changes"])
+    assert balances(head) == balances(a)
+    head.c.execute("SELECT count(*) FROM transactions")
+    assert head.c.fetchone()[0] == len(a.c.execute("SELECT id FROM transactions").fetchall())
+
+
+def test_export_inside_a_caller_transaction_leaves_it_open(sites):
+    a, _, _ = sites
+    a.c.execute("BEGIN")
+    a.c.execute("INSERT INTO stores (name) VALUES ('Pending Branch')")
+    build_changeset(a, None)
+    assert a.conn.in_transaction
+    a.conn.rollback()
+    assert "Pending Branch" not in a.get_store_names()
@@ -0,0 +1,132 @@
+import cProfile
+import json
+import os
+import time
+import tkinter
+from contextlib import contextmanager
+
+#Opt-in profiler for the Tk mainloop
+#Every Tk callback (button commands, bindings, after jobs) goes through tkinter.CallWrapper,
+#so timing it there tells us which handler froze the window and for how long
+
+BLOCK_THRESHOLD_MS = 100
+
+
+#Readable name for a callback: "StoreApp.view_records", "after:StoreApp.recalc_sales_difference"...
+def handler_name(func):
+    code = getattr(func, "__code__", None)
+
+    #after() wraps the job in a local callit(), the real job sits in its closure
+    if code is not None and getattr(func, "__qualname__", "").endswith("after.<locals>.callit") and func.__closure__:
+        cells = dict(zip(code.co_freevars, (cell.cell_contents for cell in func.__closure__)))
+        if "func" in cells:
+            return f"after:{handler_name(cells['func'])}"
+
+    owner = getattr(func, "__self__", None)
+    if owner is not None:
+        #CTk widgets route their command through an internal method, report the command instead
+        command = getattr(owner, "_command", None)
+        if callable(command) and command is not func:
+            return handler_name(command)
+        return f"{type(owner).__name__}.{func.__name__}"
+
+    name = getattr(func, "__qualname__", None) or type(func).__name__
+    module = getattr(func, "__module__", "") or ""
+    if name == "<lambda>" and code is not None:
+        return f"<lambda {os.path.basename(code.co_filename)}:{code.co_firstlineno}>"
+    return name if module in ("__main__", "main") else f"{module}.{name}"
+
+
+class UIProfiler:
+    def __init__(self, threshold_ms=BLOCK_THRESHOLD_MS, out_dir="profiles", use_cprofile=True):
+        self.threshold_ms = threshold_ms
+        self.out_dir = out_dir
+        self.handlers = {}
+        self.blocked = []
+        self.profile = cProfile.Profile() if use_cprofile else None
+        self._original_call = None
+        self.started = time.time()
+
+    def install(self):
+        if self._original_call is not None:
+            return
+
+        profiler = self
+        original_call = tkinter.CallWrapper.__call__
+        self._original_call = original_call
+
+        def timed_call(wrapper, *args):
+            started = time.perf_counter()
+            try:
+                return original_call(wrapper, *args)
+            finally:
+                profiler.record(handler_name(wrapper.func), (time.perf_counter() - started) * 1000)
+
+        tkinter.CallWrapper.__call__ = timed_call
+
+        if self.profile is not None:
+            self.profile.enable()
+
+    def uninstall(self):
+        if self._original_call is None:
+            return
+        tkinter.CallWrapper.__call__ = self._original_call
+        self._original_call = None
+
+        if self.profile is not None:
+            self.profile.disable()
+
+    #For work done outside a callback (ex: building StoreApp before the mainloop starts)
+    @contextmanager
+    def measure(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - started) * 1000)
+
+    def record(self, name, elapsed_ms):
+        entry = self.handlers.get(name)
+        if entry is None:
+            entry = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "blocked": 0}
+            self.handlers[name] = entry
+
+        entry["calls"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+        if elapsed_ms >= self.threshold_ms:
+            entry["blocked"] += 1
+            self.blocked.append({"time": time.strftime("%H:%M:%S"), "handler": name, "ms": round(elapsed_ms, 1)})
+            print(f"UI blocked {elapsed_ms:,.0f} ms in {name}")
+
+    #Worst handlers first
+    def summary(self):
+        rows = [{"handler": name, **entry, "total_ms": round(entry["total_ms"], 2), "max_ms": round(entry["max_ms"], 2)}
+                for name, entry in self.handlers.items()]
+        rows.sort(key=lambda row: row["max_ms"], reverse=True)
+        return rows
+
+    #Writes the session next to each other:
+    #  .prof    -> cProfile stats (snakeviz, flameprof, gprof2dot, pstats)
+    #  .folded  -> "mainloop;handler total_ms" lines for flamegraph.pl / speedscope
+    #  .json    -> per handler calls/total/max/blocked + every blocking event
+    def dump(self):
+        self.uninstall()
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(self.started))
+        base = os.path.join(self.out_dir, f"ui_{stamp}")
+
+        if self.profile is not None:
+            self.profile.dump_stats(f"{base}.prof")
+
+        with open(f"{base}.folded", "w", encoding="utf-8") as file:
+            for name, entry in self.handlers.items():
+                frames = ";".join(part.replace(";", ",") for part in ["mainloop"] + name.split(":"))
+                file.write(f"{frames} {max(1, round(entry['total_ms']))}\n")
+
+        with open(f"{base}.json", "w", encoding="utf-8") as file:
+            json.dump({"threshold_ms": self.threshold_ms, "handlers": self.summary(), "blocked": self.blocked}, file, indent=2)
+
+        print(f"UI profile written to {base}.prof / .folded / .json")
+        return base